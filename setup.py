@@ -28,5 +28,5 @@ setup(
     packages=["usepa_cti"],
     include_package_data=True,
     install_requires=['numpy', 'matplotlib', 'pandas', 'scipy', 'xlrd'],
-    extras_require={'dev': ['sphinx', 'bump2version']}
+    extras_require={'dev': ['sphinx', 'bump2version'], 'numexpr': ['numexpr']}
 )
\ No newline at end of file
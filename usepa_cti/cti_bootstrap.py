@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_bootstrap.py
+================
+
+Bootstrap confidence intervals for window bin results and fleet (cross-file) results
+
+Resamples are generated as batched NumPy index matrices (one row per resample) so each batch of resamples is evaluated
+with a handful of vectorized operations.  Batches may optionally be farmed out to a process pool, one pool is started
+on first use and reused for every bin and file.
+
+Bin windows are resampled in blocks of the windows that start within one block time span, in time order, so that
+overlapping windows are resampled together even though the windows of a bin are not contiguous in time.
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import os
+import atexit
+import warnings
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+max_batch_elements = 4e6  # maximum number of elements in a resample index matrix batch, limits memory use
+
+
+def time_block_lengths(start_times, block_secs):
+    """
+    Get the number of windows in the block that starts at each window, a block holds the windows that start within
+    ``block_secs`` of its first window
+
+    :param start_times: window start times (seconds), in time order
+    :param block_secs: block time span (seconds), 0 = one window per block
+    :return: integer array of block lengths, one per window, at least 1
+    """
+    start_times = np.asarray(start_times, dtype=float)
+    block_ends = np.searchsorted(start_times, start_times + block_secs, side='left')
+    return np.maximum(1, block_ends - np.arange(len(start_times)))
+
+
+def block_bootstrap_indices(block_lengths, num_resamples, rng):
+    """
+    Generate moving block bootstrap indices, each resample is built from blocks of consecutive samples starting at
+    random samples so that correlation between neighboring samples (e.g. overlapping windows) is preserved within
+    each resample.  The last block of each resample is cut short so each resample has one index per sample
+
+    :param block_lengths: number of consecutive samples in the block starting at each sample, see
+        ``time_block_lengths()``, all ones = ordinary bootstrap
+    :param num_resamples: number of resamples (rows) to generate
+    :param rng: ``numpy.random.Generator`` to draw block starts from
+    :return: integer index matrix of shape (num_resamples, num_samples)
+    """
+    block_lengths = np.asarray(block_lengths, dtype=int)
+    num_samples = len(block_lengths)
+
+    # draw block starts until every resample has at least num_samples samples
+    block_starts = np.empty((num_resamples, 0), dtype=int)
+    totals = np.zeros(num_resamples, dtype=int)
+    while (totals < num_samples).any():
+        num_blocks = int(np.ceil((num_samples - totals.min()) / block_lengths.mean()))
+        new_starts = rng.integers(0, num_samples, size=(num_resamples, num_blocks))
+        block_starts = np.hstack([block_starts, new_starts])
+        totals += block_lengths[new_starts].sum(axis=1)
+
+    # number of samples used from each block, the blocks past the end of the resample are not used
+    lengths = block_lengths[block_starts]
+    block_offsets = np.cumsum(lengths, axis=1) - lengths
+    used = np.clip(num_samples - block_offsets, 0, lengths).ravel()
+
+    block_first_index = np.repeat(np.cumsum(used) - used, used)
+    indices = np.repeat(block_starts.ravel(), used) + np.arange(used.sum()) - block_first_index
+    return indices.reshape(num_resamples, num_samples)
+
+
+def _bin_resample_batch(numerator, denominator, values, block_lengths, num_resamples, pctiles, seed):
+    """
+    Evaluate one batch of bin resamples
+
+    :param numerator: window numerator values (e.g. NOx grams), in time order
+    :param denominator: window denominator values (e.g. CO2 grams or work), in time order
+    :param values: window brake-specific values (e.g. NOx g/hp-hr) for percentiles, in time order
+    :param block_lengths: number of consecutive windows in the bootstrap block starting at each window
+    :param num_resamples: number of resamples in the batch
+    :param pctiles: list of percentiles to evaluate
+    :param seed: random seed or ``numpy.random.SeedSequence`` for the batch
+    :return: (ratio_resamples, pctile_resamples) tuple, shapes (num_resamples,) and (len(pctiles), num_resamples)
+    """
+    rng = np.random.default_rng(seed)
+    idx = block_bootstrap_indices(block_lengths, num_resamples, rng)
+    ratios = numerator[idx].sum(axis=1) / denominator[idx].sum(axis=1)
+    pctile_values = np.percentile(values[idx], pctiles, axis=1)
+    return ratios, pctile_values
+
+
+_pool = None  # (process id, number of workers, process pool) tuple, the pool is reused for every bin and file
+
+
+def _shutdown_pool():
+    """
+    Shut down this process's process pool, if any
+    """
+    global _pool
+    if _pool is not None and _pool[0] == os.getpid():
+        _pool[2].shutdown(cancel_futures=True)
+    _pool = None
+
+
+atexit.register(_shutdown_pool)
+
+
+def _run_batches(func, batch_args, num_workers):
+    """
+    Run batch function calls in-process or in the process pool, the pool is started on first use and restarted if
+    the number of workers changes.  A pool inherited from a parent process is not used
+
+    :param func: top level (picklable) batch function
+    :param batch_args: list of argument tuples, one per batch
+    :param num_workers: number of worker processes, 0 or 1 to run in-process
+    :return: list of batch results, in batch order
+    """
+    global _pool
+    if num_workers > 1 and len(batch_args) > 1:
+        if _pool is None or _pool[:2] != (os.getpid(), num_workers):
+            _shutdown_pool()
+            _pool = (os.getpid(), num_workers, ProcessPoolExecutor(max_workers=num_workers))
+        return list(_pool[2].map(func, *zip(*batch_args)))
+    else:
+        return [func(*args) for args in batch_args]
+
+
+def _batch_sizes(num_resamples, num_samples):
+    """
+    Split resamples into batches that limit the size of the resample index matrix
+
+    :param num_resamples: total number of resamples
+    :param num_samples: number of samples per resample
+    :return: list of batch sizes
+    """
+    batch_size = int(max(1, min(num_resamples, max_batch_elements // max(1, num_samples))))
+    return [min(batch_size, num_resamples - i) for i in range(0, num_resamples, batch_size)]
+
+
+def bootstrap_bin_ci(bin_windows, numerator_chan, denominator_chan, value_chan, scale=1.0, block_secs=0,
+                     num_resamples=1000, pctiles=[70, 95], ci_pct=90, seed=None, num_workers=0):
+    """
+    Calculate bootstrap confidence intervals for a window bin emissions rate (sum of numerator / sum of denominator)
+    and for percentiles of the individual window emissions rates
+
+    :param bin_windows: pandas dataframe of windows in the bin, must contain a 'start_time' column
+    :param numerator_chan: name of window numerator column, e.g. 'Tailpipe NOX g'
+    :param denominator_chan: name of window denominator column, e.g. 'Tailpipe CO2 g' or 'Power hp-hr'
+    :param value_chan: name of window emissions rate column for percentiles, e.g. 'NOX g/hp-hr'
+    :param scale: bin rate scale factor, e.g. FTP CO2 g/hp-hr for CO2 normalization
+    :param block_secs: bootstrap block time span (seconds), typically the window length so that overlapping windows are
+        resampled together, 0 = ordinary bootstrap
+    :param num_resamples: number of bootstrap resamples
+    :param pctiles: list of window emissions rate percentiles to calculate intervals for
+    :param ci_pct: confidence interval width, percent
+    :param seed: random seed, for repeatable results
+    :param num_workers: number of worker processes, 0 or 1 to run in-process
+    :return: dict of {'rate': (lo, hi), pctile: (lo, hi), ...}, NaNs if the bin is empty
+    """
+    ci = {'rate': (np.nan, np.nan)}
+    for pctile in pctiles:
+        ci[pctile] = (np.nan, np.nan)
+
+    if len(bin_windows) == 0:
+        return ci
+
+    ordered = bin_windows.sort_values('start_time')
+    numerator = ordered[numerator_chan].values.astype(float)
+    denominator = ordered[denominator_chan].values.astype(float)
+    values = ordered[value_chan].values.astype(float)
+    block_lengths = time_block_lengths(ordered['start_time'].values, block_secs)
+
+    batch_sizes = _batch_sizes(num_resamples, len(values))
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    batch_args = [(numerator, denominator, values, block_lengths, batch_size, pctiles, batch_seed)
+                  for batch_size, batch_seed in zip(batch_sizes, seeds)]
+
+    batch_results = _run_batches(_bin_resample_batch, batch_args, num_workers)
+
+    ratios = np.concatenate([r[0] for r in batch_results]) * scale
+    pctile_values = np.concatenate([r[1] for r in batch_results], axis=1)
+
+    ci_limits = [(100 - ci_pct) / 2, 100 - (100 - ci_pct) / 2]
+    ci['rate'] = tuple(np.nanpercentile(ratios, ci_limits))
+    for i, pctile in enumerate(pctiles):
+        ci[pctile] = tuple(np.nanpercentile(pctile_values[i], ci_limits))
+
+    return ci
+
+
+def _fleet_resample_batch(values, num_resamples, seed):
+    """
+    Evaluate one batch of fleet (file) resamples
+
+    :param values: matrix of per-file results, shape (num_files, num_columns)
+    :param num_resamples: number of resamples in the batch
+    :param seed: random seed or ``numpy.random.SeedSequence`` for the batch
+    :return: (means, medians) tuple of resampled column statistics, each shape (num_resamples, num_columns)
+    """
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, values.shape[0], size=(num_resamples, values.shape[0]))
+    resampled = values[idx]
+    return np.nanmean(resampled, axis=1), np.nanmedian(resampled, axis=1)
+
+
+def bootstrap_fleet_ci(results_df, columns, num_resamples=1000, ci_pct=90, seed=None, num_workers=0):
+    """
+    Calculate bootstrap confidence intervals for the fleet mean and median of per-file results by resampling files
+
+    :param results_df: pandas dataframe of results, one row per file
+    :param columns: list of result column names to calculate intervals for
+    :param num_resamples: number of bootstrap resamples
+    :param ci_pct: confidence interval width, percent
+    :param seed: random seed, for repeatable results
+    :param num_workers: number of worker processes, 0 or 1 to run in-process
+    :return: pandas dataframe with one row per column and mean, median and confidence interval columns
+    """
+    values = results_df[columns].values.astype(float)
+
+    batch_sizes = _batch_sizes(num_resamples, values.size)
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    batch_args = [(values, batch_size, batch_seed) for batch_size, batch_seed in zip(batch_sizes, seeds)]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # all-NaN resamples are expected for sparse bins
+        batch_results = _run_batches(_fleet_resample_batch, batch_args, num_workers)
+        means = np.concatenate([r[0] for r in batch_results])
+        medians = np.concatenate([r[1] for r in batch_results])
+
+        ci_limits = [(100 - ci_pct) / 2, 100 - (100 - ci_pct) / 2]
+        mean_ci = np.nanpercentile(means, ci_limits, axis=0)
+        median_ci = np.nanpercentile(medians, ci_limits, axis=0)
+
+        fleet_ci = pd.DataFrame(index=pd.Index(columns, name='result'))
+        fleet_ci['file count'] = np.sum(~np.isnan(values), axis=0)
+        fleet_ci['mean'] = np.nanmean(values, axis=0)
+        fleet_ci['mean CI lo'] = mean_ci[0]
+        fleet_ci['mean CI hi'] = mean_ci[1]
+        fleet_ci['median'] = np.nanmedian(values, axis=0)
+        fleet_ci['median CI lo'] = median_ci[0]
+        fleet_ci['median CI hi'] = median_ci[1]
+
+    return fleet_ci
@@ -31,11 +31,6 @@ import os
 import glob
 from cti_plot import *
 
-import tkinter as tk
-from tkinter import filedialog
-
-tk.Tk().withdraw()  # hide empty tk windows
-
 
 def prep_calcs_dataframe(data_filename, data_source_profile, verbose=False, start_time=''):
     """
@@ -152,7 +147,20 @@ def prep_calcs_dataframe(data_filename, data_source_profile, verbose=False, star
     calcs_dataframe['dt_secs'] = calcs_dataframe['time_secs'].diff().fillna(0)
 
     # calculate engine speed, torque and poewr signals
+    calcs_dataframe = calc_engine_signals(source_dataframe, calcs_dataframe, data_profile)
+
+    return source_dataframe, calcs_dataframe
+
 
+def calc_engine_signals(source_dataframe, calcs_dataframe, data_profile):
+    """
+    Calculate engine speed, torque and power signals in the calcs dataframe from the source dataframe
+
+    :param source_dataframe: Pandas dataframe containing numeric source engine speed and torque signals
+    :param calcs_dataframe: Calculated values dataframe to add engine speed, torque and power signals to
+    :param data_profile: an object of class DataSourceProfile
+    :return: calcs_dataframe
+    """
     if data_profile.engine_speed_units == 'RPM':
         calcs_dataframe['engine_speed_rpm'] = source_dataframe[data_profile.engine_speed_signal]
     else:  # radians/sec to RPM
@@ -171,7 +179,125 @@ def prep_calcs_dataframe(data_filename, data_source_profile, verbose=False, star
         'engine_torque_Nm'] * convert.W2kW
     calcs_dataframe['engine_power_norm'] = calcs_dataframe['engine_power_kW'] / data_profile.engine_power_rating_kW
 
-    return source_dataframe, calcs_dataframe
+    return calcs_dataframe
+
+
+def iter_calcs_dataframe_chunks(data_filename, data_source_profile, chunk_rows, verbose=False):
+    """
+
+    Block-wise version of ``prep_calcs_dataframe()`` for data files too large to load at once.  Reads the data file
+    in blocks of chunk_rows rows and processes the time vector and engine speeds and powers, carrying the time
+    processing state across block boundaries.
+
+    .. note::
+
+        Midnight time wraps of base60 time signals are advanced by the median time step of the current block rather
+        than of the whole file
+
+    :param data_filename: Name of .csv file to process
+    :param data_source_profile: an object of class DataSourceProfile
+    :param chunk_rows: number of data rows per block
+    :param verbose: if True then optional outputs are printed to the console
+    :return: generator of (source_dataframe, calcs_dataframe) tuples, one per block
+    """
+
+    if data_source_profile.engine_power_rating_hp == 'filename_7_3':
+        data_profile = copy.deepcopy(data_source_profile)
+        data_profile = data_profile.get_power_rating(data_filename)
+    else:
+        data_profile = data_source_profile
+
+    print('\nprocessing ' + data_filename + ' in blocks of %d rows...' % chunk_rows)
+
+    if not data_filename.__contains__('.csv'):
+        raise Exception('Block-wise processing requires .csv data files')
+
+    if data_profile.header_row >= 1:
+        header_row = data_profile.header_row - 1  # excel is 1-indexed, pandas is 0-indexed so subtract 1
+    else:
+        header_row = None
+
+    # time processing state carried across blocks
+    first_chunk = True
+    time_zero = None
+    time_offset = None
+    time_wrap = 0
+    previous_time = None
+    previous_raw_time = 0
+    previous_clipped_time = 0.0
+    previous_time_secs = None
+
+    for source_dataframe in pd.read_csv(data_filename, header=header_row, dtype=object, chunksize=chunk_rows):
+
+        # drop rows between header and data, if there is a header
+        if first_chunk and data_profile.header_row is not None and \
+                (data_profile.first_data_row - data_profile.header_row > 1):
+            for i in range(data_profile.first_data_row - data_profile.header_row - 2,
+                           data_profile.first_data_row - data_profile.header_row - 1):
+                print('Dropping index %d' % i)
+                source_dataframe.drop(index=i, inplace=True)
+        first_chunk = False
+
+        # drop blank rows!
+        source_dataframe.dropna(axis='index', how='all', inplace=True)
+        if len(source_dataframe) == 0:
+            continue
+
+        source_dataframe.reset_index(drop=True, inplace=True)
+        source_dataframe.fillna(0, inplace=True)
+        source_dataframe.columns = source_dataframe.columns.str.replace('%', 'pct')
+
+        calcs_dataframe = pd.DataFrame()
+
+        source_dataframe[data_profile.time_signal] = pd.to_numeric(source_dataframe[data_profile.time_signal])
+        source_dataframe[data_profile.engine_speed_signal] = pd.to_numeric(
+            source_dataframe[data_profile.engine_speed_signal])
+        source_dataframe[data_profile.engine_torque_signal] = pd.to_numeric(
+            source_dataframe[data_profile.engine_torque_signal])
+
+        if data_profile.time_base == 'base60':
+            # parse crazy base 60 time signal that looks like HHMMSS
+            source_time = source_dataframe[data_profile.time_signal].values.astype(float)
+            time_hrs_x1000 = np.floor(source_time / 10000) * 10000
+            time_mins_x100 = np.floor((source_time - time_hrs_x1000) / 100) * 100
+            time_secs = source_time - time_hrs_x1000 - time_mins_x100
+            time = time_hrs_x1000 / 10000 * 3600 + time_mins_x100 / 100 * 60 + time_secs
+            if time_zero is None:
+                time_zero = time[0]
+            time = time - time_zero  # start at time zero
+
+            nominal_dt = np.nanmedian(np.diff(time)) if len(time) > 1 else 0
+            for t in range(len(time)):
+                if previous_time is not None and time[t] < previous_time:
+                    # calculate time wrap due to overflow at midnight = time gap plus nominal dt
+                    time_wrap = previous_time - time[t] + nominal_dt
+                time[t] = time[t] + time_wrap
+                previous_time = time[t]
+        else:  # base1
+            if time_offset is None:
+                time_offset = source_dataframe.loc[1, data_profile.time_signal]
+                if verbose:
+                    print('Time Offset = %d' % time_offset)
+            time = (source_dataframe[data_profile.time_signal] - time_offset).values.astype(float)
+
+        # eliminate time jumps, continuing the cumulative time from the previous block
+        clipped_dt = np.minimum(1 / data_source_profile.data_rate_Hz, np.diff(time, prepend=previous_raw_time))
+        previous_raw_time = time[-1]
+        time = np.cumsum(np.concatenate([[previous_clipped_time], clipped_dt]))[1:]
+        previous_clipped_time = time[-1]
+
+        calcs_dataframe['time_secs'] = time
+        source_dataframe[data_profile.time_signal] = time
+
+        # calculate data rate
+        if previous_time_secs is None:
+            previous_time_secs = time[0]
+        calcs_dataframe['dt_secs'] = np.diff(time, prepend=previous_time_secs)
+        previous_time_secs = time[-1]
+
+        calcs_dataframe = calc_engine_signals(source_dataframe, calcs_dataframe, data_profile)
+
+        yield source_dataframe, calcs_dataframe
 
 
 def prep_vehicle_speed(source_dataframe, calcs_dataframe, data_profile):
@@ -225,6 +351,81 @@ def scale_signal(source_dataframe, source_signal, source_signal_scale):
     return scaled_signal
 
 
+def _resample_segment(time, data, rate_Hz, method):
+    """
+    Resample one segment of data, without time gaps, onto a uniform time grid starting at its first time sample
+
+    :param time: numpy array of monotonically increasing sample times
+    :param data: numpy array of sample data, one row per sample
+    :param rate_Hz: data rate of the uniform output time grid
+    :param method: 'interp' for linear interpolation or 'mean' for block averaging, see ``resample_dataframe()``
+    :return: (time_grid, resampled data) tuple
+    """
+    time_grid = time[0] + np.arange(int(np.floor((time[-1] - time[0]) * rate_Hz)) + 1) / rate_Hz
+
+    # linear interpolation weights, shared by all columns
+    idx = np.clip(np.searchsorted(time, time_grid, side='right') - 1, 0, max(0, len(time) - 2))
+    idx_next = np.minimum(idx + 1, len(time) - 1)
+    dt = time[idx_next] - time[idx]
+    weight = np.divide(time_grid - time[idx], dt, out=np.zeros_like(dt), where=dt > 0)
+    resampled = data[idx] * (1 - weight[:, np.newaxis]) + data[idx_next] * weight[:, np.newaxis]
+
+    if method == 'mean':
+        # average all samples within +/- half a grid step of each grid point
+        block_num = np.floor((time - time[0]) * rate_Hz + 0.5).astype(int)
+        block_starts = np.flatnonzero(np.diff(block_num, prepend=-1))
+        block_counts = np.diff(np.append(block_starts, len(time)))
+        block_idx = block_num[block_starts]
+        in_grid = block_idx < len(time_grid)
+        block_sums = np.add.reduceat(data, block_starts, axis=0)
+        resampled[block_idx[in_grid]] = block_sums[in_grid] / block_counts[in_grid, np.newaxis]
+
+    return time_grid, resampled
+
+
+def resample_dataframe(df, time_chan, rate_Hz, method='interp', verbose=False, max_gap=0):
+    """
+    Resample the numeric columns of a dataframe onto a uniform time grid starting at the first time sample.
+
+    Time gaps longer than ``max_gap`` (e.g. ignition-off) are not interpolated across, the data either side of a gap is
+    resampled as a separate segment on its own grid starting at the segment's first sample, so the gap remains a
+    single time step in the resampled data
+
+    :param df: Pandas dataframe containing time-based data, time signal must be monotonically increasing
+    :param time_chan: name (i.e. column heading) of time channel
+    :param rate_Hz: data rate of the uniform output time grid
+    :param method: 'interp' for linear interpolation or 'mean' for block averaging of the samples centered on each
+        grid point (grid points without samples are interpolated)
+    :param verbose: if True then dropped non-numeric columns are printed to the console
+    :param max_gap: longest time step (seconds) interpolated across, 0 = no limit
+    :return: new dataframe of resampled numeric data with a fresh index
+    """
+    if method not in ['interp', 'mean']:
+        raise Exception('Invalid resample method "%s", expecting interp or mean' % method)
+
+    numeric_df = df.select_dtypes(include=[np.number])
+    if verbose:
+        for column in df.columns.difference(numeric_df.columns):
+            print('resample_dataframe dropping non-numeric signal %s' % column)
+
+    time = numeric_df[time_chan].values.astype(float)
+    data = numeric_df.values.astype(float)
+
+    if max_gap:
+        segment_starts = np.concatenate([[0], np.flatnonzero(np.diff(time) > max_gap) + 1])
+    else:
+        segment_starts = np.array([0])
+    segment_ends = np.append(segment_starts[1:], len(time))
+
+    segments = [_resample_segment(time[start:end], data[start:end], rate_Hz, method)
+                for start, end in zip(segment_starts, segment_ends)]
+
+    resampled_df = pd.DataFrame(np.concatenate([resampled for _, resampled in segments]), columns=numeric_df.columns)
+    resampled_df[time_chan] = np.concatenate([time_grid for time_grid, _ in segments])
+
+    return resampled_df
+
+
 class runtime_options(object):
     """
     Container class for runtime options
@@ -245,16 +446,43 @@ class runtime_options(object):
         self.idle_rpm_threshold = 0
         self.straight_average = False
         self.time_align_emissions = False
+        self.time_align_reference = 'power'
+        self.time_align_max_lag_secs = 20
         self.append_summary = False
 
 
-def handle_command_line_options(app_description='Generic CTI App', additional_args=[], additional_options=[]):
+def get_file_list(source_path, include_filter, exclude_filter):
+    """
+    Find the files in a folder that match one or more include filters and none of the exclude filters
+
+    :param source_path: path to folder containing files
+    :param include_filter: list of file filters, files to include/accept, e.g. ['*.csv']
+    :param exclude_filter: list of file filters, files to exclude/reject, e.g. ['*calcs.csv']
+    :return: (file list, include list, exclude list) tuple, file list is the set of included files not excluded
+    """
+    include_list = []
+    for file_filter in include_filter:
+        if file_filter is not np.nan:
+            include_list += glob.glob(source_path + os.sep + file_filter)
+
+    exclude_list = []
+    for file_filter in exclude_filter:
+        if file_filter is not np.nan:
+            exclude_list += glob.glob(source_path + os.sep + file_filter)
+
+    return set.difference(set(include_list), set(exclude_list)), include_list, exclude_list
+
+
+def handle_command_line_options(app_description='Generic CTI App', additional_args=[], additional_options=[],
+                                require_files=True):
     """
     Handle command line options shared across CTI processor scripts
 
     :param app_description: 'Generic CTI App'
     :param additional_args: None
     :param additional_options: Command-line options
+    :param require_files: if ``True`` then an exception is raised if no files match the file filters, e.g. ``False``
+        for a source folder that is watched for new files
     :return: ``runtime_options`` object
     """
     import argparse
@@ -295,6 +523,10 @@ def handle_command_line_options(app_description='Generic CTI App', additional_ar
 
     print('options.profile_filename = ' + options.profile_filename)
     if options.profile_filename == 'prompt':
+        # tkinter is only needed for the file browser, import on demand so headless and library use don't need it
+        import tkinter as tk
+        from tkinter import filedialog
+        tk.Tk().withdraw()  # hide empty tk windows
         options.profile_filename = filedialog.askopenfilename(title='Select CTI Data Source Profile',
                                                               initialdir=options.source_path,
                                                               filetypes=[('cti data source profile',
@@ -312,23 +544,15 @@ def handle_command_line_options(app_description='Generic CTI App', additional_ar
         options.data_profile = omdsp.DataSourceProfile(options.profile_filename)
 
     # build file list based on one or more file filters
-    options.file_list = []
-    for file_filter in options.file_include_filter:
-        if file_filter is not np.nan:
-            options.file_include_list += glob.glob(options.source_path + os.sep + file_filter)
-
-    for file_filter in options.file_exclude_filter:
-        if file_filter is not np.nan:
-            options.file_exclude_list += glob.glob(options.source_path + os.sep + file_filter)
-
-    options.file_list = set.difference(set(options.file_include_list), set(options.file_exclude_list))
+    options.file_list, options.file_include_list, options.file_exclude_list = \
+        get_file_list(options.source_path, options.file_include_filter, options.file_exclude_filter)
 
     # show file list
     if len(options.file_list) > 0:
         print('Found %d Files:' % len(options.file_list))
         for file_name in options.file_list:
             print('     ' + file_name)
-    else:
+    elif require_files:
         print(options.file_include_filter)
         raise Exception('No Files Selected, Check File Filter and Path')
     print()
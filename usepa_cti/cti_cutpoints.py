@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_cutpoints.py
+================
+
+Fast evaluation of window bin cutpoints using windows sorted by normalized CO2 rate and prefix sums of the window
+NOx, CO2 and work, so any set of cutpoints can be evaluated with a binary search instead of re-binning the windows
+
+.. code-block:: python
+
+    # example usage:
+    import cti_cutpoints as cutpoints
+    analyzer = cutpoints.CutpointAnalyzer(wp_window_df, co2_normalization=True, ftp_co2_gphphr=555)
+    bin_results = analyzer.evaluate([0.08, 0.25])
+    sweep_df = analyzer.sweep2(np.arange(0.01, 0.60, 0.01))
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+
+class CutpointAnalyzer(object):
+    """
+    Evaluate window bin NOx rates and window counts for arbitrary normalized CO2 rate cutpoints
+
+    Bins follow the ``tbw_processor`` convention, cutpoint bins are (previous cutpoint, cutpoint] with the first bin
+    starting above zero and the last bin containing everything above the final cutpoint.
+
+    """
+    def __init__(self, window_df, co2_normalization=False, ftp_co2_gphphr=555, rate_chan='Tailpipe CO2 rate norm'):
+        """
+        Create ``CutpointAnalyzer`` object, sort windows and calculate prefix sums
+
+        :param window_df: pandas dataframe of windows, must contain rate_chan, 'Tailpipe NOX g', 'Tailpipe CO2 g'
+            and 'Power hp-hr' columns
+        :param co2_normalization: if True then NOx g/hp-hr = NOx_g/CO2_g * ftp_co2_gphphr, else NOx_g/work_hp-hr
+        :param ftp_co2_gphphr: FTP CO2 g/hp-hr for CO2 normalization
+        :param rate_chan: name of the normalized CO2 rate column used to bin windows
+        """
+        self.co2_normalization = co2_normalization
+        self.ftp_co2_gphphr = ftp_co2_gphphr
+
+        order = np.argsort(window_df[rate_chan].values, kind='stable')
+        self.rates = window_df[rate_chan].values[order].astype(float)
+
+        # prefix sums with a leading zero, sum over sorted windows [a, b) = prefix[b] - prefix[a]
+        self.cum_nox_g = np.concatenate([[0], np.cumsum(window_df['Tailpipe NOX g'].values[order])])
+        self.cum_co2_g = np.concatenate([[0], np.cumsum(window_df['Tailpipe CO2 g'].values[order])])
+        self.cum_work_hphr = np.concatenate([[0], np.cumsum(window_df['Power hp-hr'].values[order])])
+
+        # windows at or below zero normalized CO2 rate are not in any bin, NaN rates sort last and are not binned
+        self.first_idx = np.searchsorted(self.rates, 0, side='right')
+        self.last_idx = np.count_nonzero(~np.isnan(self.rates))
+
+    def _cutpoint_idx(self, cutpoints_frac):
+        """
+        Find sorted window index boundaries for cutpoints
+
+        :param cutpoints_frac: scalar or array of normalized CO2 rate cutpoints
+        :return: index of the first window above each cutpoint
+        """
+        return np.maximum(self.first_idx, np.searchsorted(self.rates, cutpoints_frac, side='right'))
+
+    def bin_nox_gphphr(self, start_idx, end_idx):
+        """
+        Calculate bin NOx g/hp-hr for windows [start_idx, end_idx) of the sorted windows
+
+        :param start_idx: scalar or array of bin start indices
+        :param end_idx: scalar or array of bin end indices
+        :return: scalar or array of bin NOx g/hp-hr, NaN for empty bins
+        """
+        nox_g = self.cum_nox_g[end_idx] - self.cum_nox_g[start_idx]
+        if self.co2_normalization:
+            denominator = (self.cum_co2_g[end_idx] - self.cum_co2_g[start_idx]) / self.ftp_co2_gphphr
+        else:
+            denominator = self.cum_work_hphr[end_idx] - self.cum_work_hphr[start_idx]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(np.asarray(end_idx) > np.asarray(start_idx), nox_g / denominator, np.nan)
+
+    def evaluate(self, cutpoints_frac):
+        """
+        Evaluate bin NOx g/hp-hr and window counts for one set of cutpoints
+
+        :param cutpoints_frac: list of increasing normalized CO2 rate cutpoints, e.g. [0.08, 0.25]
+        :return: dict of bin results using the ``tbw_processor`` bin names, e.g. '0.0->8.0 NOX g/hp-hr'
+        """
+        bin_results = dict()
+        edges = np.concatenate([[self.first_idx], self._cutpoint_idx(np.asarray(cutpoints_frac, dtype=float)),
+                                [self.last_idx]])
+
+        previous_bin_frac = 0
+        bin_names = []
+        for cutpoint_frac in cutpoints_frac:
+            bin_names.append('%.1f->%.1f' % (previous_bin_frac * 100, cutpoint_frac * 100))
+            previous_bin_frac = cutpoint_frac
+        bin_names.append('>%.1f' % (previous_bin_frac * 100))
+
+        for bin_name, start_idx, end_idx in zip(bin_names, edges[:-1], edges[1:]):
+            bin_results[bin_name + ' NOX g/hp-hr'] = float(self.bin_nox_gphphr(start_idx, end_idx))
+            bin_results[bin_name + ' Window Count'] = int(end_idx - start_idx)
+
+        return bin_results
+
+    def sweep1(self, cutpoint_grid_frac):
+        """
+        Evaluate all single cutpoint (two bin) candidates on a grid
+
+        :param cutpoint_grid_frac: array of candidate normalized CO2 rate cutpoints
+        :return: pandas dataframe, one row per candidate cutpoint
+        """
+        cutpoint_grid_frac = np.asarray(cutpoint_grid_frac, dtype=float)
+        cut_idx = self._cutpoint_idx(cutpoint_grid_frac)
+
+        sweep_df = pd.DataFrame({'cutpoint 1 pct': cutpoint_grid_frac * 100})
+        sweep_df['low bin NOX g/hp-hr'] = self.bin_nox_gphphr(self.first_idx, cut_idx)
+        sweep_df['low bin Window Count'] = cut_idx - self.first_idx
+        sweep_df['high bin NOX g/hp-hr'] = self.bin_nox_gphphr(cut_idx, self.last_idx)
+        sweep_df['high bin Window Count'] = self.last_idx - cut_idx
+
+        return sweep_df
+
+    def sweep2(self, cutpoint_grid_frac):
+        """
+        Evaluate all two cutpoint (three bin) candidates on a grid, for every pair of increasing cutpoints
+
+        :param cutpoint_grid_frac: array of candidate normalized CO2 rate cutpoints
+        :return: pandas dataframe, one row per candidate cutpoint pair
+        """
+        cutpoint_grid_frac = np.asarray(cutpoint_grid_frac, dtype=float)
+        cut1, cut2 = np.meshgrid(cutpoint_grid_frac, cutpoint_grid_frac, indexing='ij')
+        valid = cut1 < cut2
+        cut1 = cut1[valid]
+        cut2 = cut2[valid]
+        cut1_idx = self._cutpoint_idx(cut1)
+        cut2_idx = self._cutpoint_idx(cut2)
+
+        sweep_df = pd.DataFrame({'cutpoint 1 pct': cut1 * 100, 'cutpoint 2 pct': cut2 * 100})
+        sweep_df['low bin NOX g/hp-hr'] = self.bin_nox_gphphr(self.first_idx, cut1_idx)
+        sweep_df['low bin Window Count'] = cut1_idx - self.first_idx
+        sweep_df['mid bin NOX g/hp-hr'] = self.bin_nox_gphphr(cut1_idx, cut2_idx)
+        sweep_df['mid bin Window Count'] = cut2_idx - cut1_idx
+        sweep_df['high bin NOX g/hp-hr'] = self.bin_nox_gphphr(cut2_idx, self.last_idx)
+        sweep_df['high bin Window Count'] = self.last_idx - cut2_idx
+
+        return sweep_df
+
+
+def plot_sweep2_heatmap(sweep_df, value_chan, title_str=''):
+    """
+    Plot a two cutpoint sweep result as a heatmap of cutpoint 2 versus cutpoint 1
+
+    :param sweep_df: pandas dataframe from ``CutpointAnalyzer.sweep2()``
+    :param value_chan: name of the sweep result column to plot, e.g. 'mid bin NOX g/hp-hr'
+    :param title_str: plot title
+    :return: (figure, axis) tuple
+    """
+    heatmap_df = sweep_df.pivot(index='cutpoint 2 pct', columns='cutpoint 1 pct', values=value_chan)
+
+    fig, ax1 = plt.subplots()
+    image = ax1.pcolormesh(heatmap_df.columns.values, heatmap_df.index.values, heatmap_df.values, shading='nearest')
+    fig.colorbar(image, ax=ax1, label=value_chan)
+    ax1.set_xlabel('Cutpoint 1 (% max CO2 rate)', fontsize=9)
+    ax1.set_ylabel('Cutpoint 2 (% max CO2 rate)', fontsize=9)
+    ax1.set_title(title_str, fontsize=9)
+    ax1.grid(True)
+
+    return fig, ax1
@@ -26,6 +26,7 @@ import pandas as pd
 import numpy as np
 import cti_unit_conversions as convert
 import cti_file_io as file_io
+from cti_signal_plan import SignalMappingPlan
 
 class DataSourceProfile(object):
     """
@@ -61,6 +62,7 @@ class DataSourceProfile(object):
         self.destination_signal_list = list()
         self.source_signal_list = list()
         self.source_signal_scale = list()
+        self.signal_plan = None
         self.load_data_source_profile(profile_filename)
 
     def read_parameter(self, index_str, allrows=False):
@@ -139,6 +141,10 @@ class DataSourceProfile(object):
         self.source_signal_list.replace(np.nan, '', inplace=True)
         self.source_signal_scale        = self.read_parameter('Signal Scale', allrows=True)
 
+        # compile signal table once, the plan is reused for every data file
+        self.signal_plan = SignalMappingPlan(self.destination_signal_list, self.source_signal_list,
+                                             self.source_signal_scale)
+
         if self.engine_power_rating_hp != 'filename_7_3':
             if self.engine_power_rating_units == 'KW':
                 self.engine_power_rating_kW = self.engine_power_rating_hp
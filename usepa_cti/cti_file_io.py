@@ -26,6 +26,12 @@ import sys
 import os
 import shutil
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 
 def delete_folder(dstfolder):
     """
@@ -131,6 +137,99 @@ def get_parent_foldername(filepathnameext):
     return get_filename(get_filepath(filepathnameext))
 
 
+def get_temp_filename(filename):
+    """
+    Returns a hidden temporary file name in the same folder and with the same extension as the given file, unique to
+    this process, e.g. /somepath/somefile.csv -> /somepath/.somefile.1234.tmp.csv
+
+    :param filename: file name, including path to file as required
+    :return: temporary file name, including path
+    """
+    path, filenameext = os.path.split(filename)
+    name, ext = os.path.splitext(filenameext)
+    return os.path.join(path, '.%s.%d.tmp%s' % (name, os.getpid(), ext))
+
+
+def replace_file(srcfile, dstfile):
+    """
+    Atomically move a file into place, replacing any existing file, e.g. to publish a completed temporary file
+
+    :param srcfile: source file name, including path, must be on the same file system as the destination
+    :param dstfile: destination file name, including path
+    """
+    dstpath = get_filepath(dstfile)
+    if dstpath:
+        validate_folder(dstpath)
+    os.replace(srcfile, dstfile)
+
+
+def promote_folder(srcfolder, dstfolder):
+    """
+    Move all files from a staging folder into a destination folder, one atomic rename per file, keeping the folder
+    structure.  The emptied staging folders are removed
+
+    :param srcfolder: pathname of staging folder, must be on the same file system as the destination
+    :param dstfolder: pathname of destination folder
+    """
+    for root, folders, files in os.walk(srcfolder, topdown=False):
+        relpath = os.path.relpath(root, srcfolder)
+        for filenameext in files:
+            replace_file(os.path.join(root, filenameext), os.path.normpath(os.path.join(dstfolder, relpath,
+                                                                                       filenameext)))
+        if root != srcfolder:
+            os.rmdir(root)
+
+
+class FileLock(object):
+    """
+    Advisory lock on a file for use as a context manager, held by locking a hidden '.lock' file in the file's folder.
+    Processes that use ``FileLock`` on files in the same folder take turns, the file itself is not locked against
+    other access.  One lock file serves every file in the folder so runs don't leave a lock file per output file
+    behind.  Locks are not re-entrant, don't lock a file while holding the lock on another file in the same folder
+
+    .. code-block:: python
+
+        with FileLock('output/results_summary.csv'):
+            # read, update and replace results_summary.csv
+            ...
+
+    """
+    def __init__(self, filename):
+        """
+        Create ``FileLock`` object
+
+        :param filename: file name to lock, including path to file as required
+        """
+        self.lock_filename = os.path.join(os.path.dirname(filename), '.lock')
+        self.lock_file = None
+
+    def __enter__(self):
+        path = get_filepath(self.lock_filename)
+        if path:
+            validate_folder(path)
+        self.lock_file = open(self.lock_filename, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    self.lock_file.seek(0)
+                    msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_LOCK, 1)  # retries for about 10 seconds
+                    break
+                except OSError:
+                    pass
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.lock_file.close()
+        self.lock_file = None
+
+
 def network_copyfile(remote_path, srcfile):
     """
     Copy file to remote path
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_operating_modes.py
+======================
+
+Operating-mode segmentation, labels every sample as idle, cruise or transient and calculates the fraction of time
+each window spends in each mode
+
+Samples are first labeled from vehicle speed and, optionally, engine speed:
+
+    * idle: vehicle speed below ``idle_speed_mph`` and engine speed at or below ``idle_rpm_threshold`` (if set)
+    * cruise: vehicle speed at or above ``cruise_speed_mph`` (if set)
+    * transient: everything else
+
+The labels are then run-length encoded and runs shorter than a minimum duration take the mode of the previous run
+(hysteresis), so brief excursions do not split a mode.  Window mode fractions are calculated from prefix sums of the
+time spent in each mode, all steps are vectorized.
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import numpy as np
+
+IDLE = 0
+CRUISE = 1
+TRANSIENT = 2
+
+mode_names = ['Idle', 'Cruise', 'Transient']
+
+
+def run_lengths(labels):
+    """
+    Run-length encode a label array
+
+    :param labels: numpy array of labels
+    :return: (run starts, run lengths, run labels) tuple of numpy arrays
+    """
+    if len(labels) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), labels[:0]
+
+    starts = np.flatnonzero(np.diff(labels, prepend=labels[0] - 1))
+    lengths = np.diff(np.append(starts, len(labels)))
+
+    return starts, lengths, labels[starts]
+
+
+def sample_durations(time_secs, max_dt):
+    """
+    Calculate the time step from each sample to the next, longer time gaps are shortened to ``max_dt`` the same as
+    window durations
+
+    :param time_secs: numpy array of sample times (seconds), monotonically increasing
+    :param max_dt: maximum time step (seconds)
+    :return: numpy array of sample durations (seconds), the last sample has no duration
+    """
+    return np.append(np.minimum(np.diff(time_secs), max_dt), 0)
+
+
+def label_operating_modes(time_secs, vehicle_speed_mph, engine_speed_rpm=None, idle_speed_mph=1.0,
+                          cruise_speed_mph=0.0, idle_rpm_threshold=0.0, min_duration_secs=0.0, max_dt=1.0):
+    """
+    Label every sample as idle, cruise or transient with minimum-duration hysteresis
+
+    :param time_secs: numpy array of sample times (seconds), monotonically increasing
+    :param vehicle_speed_mph: numpy array of vehicle speed (MPH)
+    :param engine_speed_rpm: optional numpy array of engine speed (RPM), required if ``idle_rpm_threshold`` is set
+    :param idle_speed_mph: idle vehicle speed threshold, idle below this speed
+    :param cruise_speed_mph: cruise vehicle speed threshold, cruise at or above this speed, 0 = no cruise mode
+    :param idle_rpm_threshold: idle engine speed threshold, idle at or below this engine speed, 0 = vehicle speed only
+    :param min_duration_secs: runs of a mode shorter than this (seconds) take the mode of the previous run
+    :param max_dt: maximum time step (seconds), longer time gaps are shortened to this
+    :return: numpy int array of modes, ``IDLE``, ``CRUISE`` or ``TRANSIENT``
+    """
+    vehicle_speed_mph = np.asarray(vehicle_speed_mph, dtype=float)
+
+    modes = np.full(len(vehicle_speed_mph), TRANSIENT, dtype=int)
+    if cruise_speed_mph:
+        modes[vehicle_speed_mph >= cruise_speed_mph] = CRUISE
+
+    idle = vehicle_speed_mph < idle_speed_mph
+    if idle_rpm_threshold:
+        if engine_speed_rpm is None:
+            raise Exception('engine speed is required for an idle RPM threshold')
+        idle &= np.asarray(engine_speed_rpm, dtype=float) <= idle_rpm_threshold
+    modes[idle] = IDLE
+
+    if min_duration_secs and len(modes):
+        starts, lengths, run_modes = run_lengths(modes)
+        run_durations = np.add.reduceat(sample_durations(np.asarray(time_secs, dtype=float), max_dt), starts)
+
+        # short runs take the mode of the most recent long run, leading short runs the mode of the first long run
+        long_runs = run_durations >= min_duration_secs
+        if np.any(long_runs):
+            run_idx = np.where(long_runs, np.arange(len(starts)), -1)
+            run_idx = np.maximum.accumulate(run_idx)
+            run_idx[run_idx < 0] = np.flatnonzero(long_runs)[0]
+            modes = np.repeat(run_modes[run_idx], lengths)
+
+    return modes
+
+
+def window_mode_fractions(time_secs, modes, window_start_times, window_end_times, max_dt=1.0):
+    """
+    Calculate the fraction of each window's duration spent in each operating mode using prefix sums of mode time
+
+    :param time_secs: numpy array of sample times (seconds), monotonically increasing
+    :param modes: numpy int array of modes from ``label_operating_modes()``
+    :param window_start_times: numpy array of window start times, sample times as from ``find_windows()``
+    :param window_end_times: numpy array of window end times, sample times as from ``find_windows()``
+    :param max_dt: maximum time step (seconds), longer time gaps are shortened to this
+    :return: dict of mode name: numpy array of window mode fractions, e.g. {'Idle': array([...]), ...}
+    """
+    time_secs = np.asarray(time_secs, dtype=float)
+    durations = sample_durations(time_secs, max_dt)
+
+    start_idx = np.searchsorted(time_secs, window_start_times, side='left')
+    end_idx = np.searchsorted(time_secs, window_end_times, side='left')
+
+    total_time = np.concatenate([[0], np.cumsum(durations)])
+    window_durations = total_time[end_idx] - total_time[start_idx]
+
+    fractions = dict()
+    for mode, mode_name in enumerate(mode_names):
+        mode_time = np.concatenate([[0], np.cumsum(np.where(modes == mode, durations, 0))])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fractions[mode_name] = (mode_time[end_idx] - mode_time[start_idx]) / window_durations
+
+    return fractions
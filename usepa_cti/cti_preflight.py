@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_preflight.py
+================
+
+Pre-flight check of source data files before batch processing, reads only the header and a small sample of each file
+so problems (missing signals, bad time base, unparseable power rating) are found before the expensive processing pass
+
+Files are checked in parallel when more than one worker is requested.  The result is a report dataframe, one row per
+file, and a filtered list of the files that passed.
+
+.. code-block:: bash
+
+    python cti_preflight.py --source_path sample_data --hdiut --preflight_workers 4
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import os
+import copy
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import cti_file_io as file_io
+
+# destination signals required for time-based window processing, a missing source signal for any of these is an error
+required_destination_signals = ['Tailpipe NOX g/s', 'Tailpipe CO2 g/s', 'Vehicle Speed MPH']
+
+
+def _read_sample(data_filename, data_profile, sample_rows):
+    """
+    Read source data file header and first sample rows, measure average bytes per data row
+
+    :param data_filename: name of file to read
+    :param data_profile: ``DataSourceProfile`` object
+    :param sample_rows: number of data rows to read
+    :return: (sample dataframe, bytes per row) tuple, bytes per row is ``None`` for non-csv files
+    """
+    if data_profile.header_row >= 1:
+        header_row = data_profile.header_row - 1  # excel is 1-indexed, pandas is 0-indexed so subtract 1
+    else:
+        header_row = None
+
+    # skip any rows between header and data, same as prep_calcs_dataframe()
+    num_skip_rows = max(0, data_profile.first_data_row - data_profile.header_row - 1)
+    num_rows = sample_rows + num_skip_rows
+
+    if data_filename.__contains__('.csv'):
+        sample_df = pd.read_csv(data_filename, header=header_row, dtype=object, nrows=num_rows)
+
+        # measure bytes per data row from the raw text of the sample rows
+        with open(data_filename, 'rb') as f:
+            lines = [f.readline() for _ in range(num_rows + (header_row + 1 if header_row is not None else 0))]
+        data_lines = [line for line in lines[-sample_rows:] if line.strip()]
+        bytes_per_row = np.mean([len(line) for line in data_lines]) if data_lines else None
+    else:
+        sample_df = pd.read_excel(data_filename, header=header_row, dtype=object, nrows=num_rows)
+        bytes_per_row = None
+
+    sample_df = sample_df.iloc[num_skip_rows:]
+    sample_df = sample_df.dropna(axis='index', how='all')
+    sample_df.columns = sample_df.columns.str.replace('%', 'pct')
+
+    return sample_df, bytes_per_row
+
+
+def _check_time_base(time_signal, data_profile):
+    """
+    Check sample time signal against the data source profile time base and data rate
+
+    :param time_signal: pandas series of sample time signal values
+    :param data_profile: ``DataSourceProfile`` object
+    :return: (list of errors, list of warnings, sample median time step secs) tuple
+    """
+    errors = []
+    warnings = []
+
+    time = pd.to_numeric(time_signal, errors='coerce').values.astype(float)
+    if np.any(np.isnan(time)):
+        errors.append('non-numeric time signal "%s"' % data_profile.time_signal)
+        return errors, warnings, np.nan
+
+    if data_profile.time_base == 'base60':
+        # parse base 60 time signal that looks like HHMMSS
+        time_hrs = np.floor(time / 10000)
+        time_mins = np.floor((time - time_hrs * 10000) / 100)
+        time_secs = time - time_hrs * 10000 - time_mins * 100
+        if np.any(time_mins >= 60) or np.any(time_secs >= 60) or np.any(time_hrs >= 24):
+            errors.append('time signal "%s" is not base60 HHMMSS' % data_profile.time_signal)
+            return errors, warnings, np.nan
+        time = time_hrs * 3600 + time_mins * 60 + time_secs
+
+    dt = np.diff(time)
+    if len(dt) == 0:
+        errors.append('not enough data rows')
+        return errors, warnings, np.nan
+
+    # a single negative step may be a base60 midnight wrap
+    if np.count_nonzero(dt < 0) > (1 if data_profile.time_base == 'base60' else 0):
+        errors.append('time signal "%s" is not increasing' % data_profile.time_signal)
+
+    median_dt = float(np.median(dt[dt >= 0])) if np.any(dt >= 0) else np.nan
+    if data_profile.data_rate_Hz and not (0.5 / data_profile.data_rate_Hz <= median_dt <= 2 / data_profile.data_rate_Hz):
+        warnings.append('median time step %g secs does not match profile data rate %g Hz' %
+                        (median_dt, data_profile.data_rate_Hz))
+
+    return errors, warnings, median_dt
+
+
+def preflight_file(data_filename, data_profile, hdiut=True, sample_rows=100):
+    """
+    Check one source data file using its header and a small data sample
+
+    :param data_filename: name of file to check
+    :param data_profile: ``DataSourceProfile`` object
+    :param hdiut: if True then HDIUT time, engine speed, engine torque and vehicle speed signals are required
+    :param sample_rows: number of data rows to read
+    :return: dict of check results for the report
+    """
+    result = {'file': data_filename, 'status': 'fail', 'errors': '', 'warnings': '', 'size MB': np.nan,
+              'engine_power_rating_hp': np.nan, 'median dt secs': np.nan, 'est rows': np.nan, 'est memory MB': np.nan}
+    errors = []
+    warnings = []
+
+    if not file_io.file_exists(data_filename):
+        result['errors'] = "couldn't access file"
+        return result
+
+    file_size = os.path.getsize(data_filename)
+    result['size MB'] = file_size / 1e6
+
+    # check engine power rating, from the filename if required
+    try:
+        file_profile = copy.deepcopy(data_profile).get_power_rating(data_filename)
+        if not file_profile.engine_power_rating_hp > 0:
+            errors.append('engine power rating %s is not positive' % file_profile.engine_power_rating_hp)
+        else:
+            result['engine_power_rating_hp'] = file_profile.engine_power_rating_hp
+    except (ValueError, TypeError):
+        errors.append('could not parse engine power rating from filename')
+
+    try:
+        sample_df, bytes_per_row = _read_sample(data_filename, data_profile, sample_rows)
+    except Exception as e:
+        errors.append('could not read file: %s' % str(e).replace('\n', ' '))
+        result['errors'] = '; '.join(errors)
+        return result
+
+    # check required signals
+    if hdiut:
+        for signal in [data_profile.time_signal, data_profile.engine_speed_signal, data_profile.engine_torque_signal,
+                       data_profile.vehicle_speed_signal]:
+            if signal not in sample_df.columns:
+                errors.append('missing signal "%s"' % signal)
+
+    # profile signal scaling is only used for HDIUT and vehMPH files, same as tbw_processor()
+    if hdiut or data_filename.__contains__('vehMPH'):
+        for destination_signal, source_signals in data_profile.signal_plan.required_source_signals().items():
+            for source_signal in source_signals:
+                if source_signal not in sample_df.columns:
+                    if destination_signal in required_destination_signals:
+                        errors.append('missing signal "%s" for %s' % (source_signal, destination_signal))
+                    else:
+                        warnings.append('missing signal "%s" for %s' % (source_signal, destination_signal))
+
+    # check time base
+    if hdiut and data_profile.time_signal in sample_df.columns:
+        time_errors, time_warnings, result['median dt secs'] = \
+            _check_time_base(sample_df[data_profile.time_signal], data_profile)
+        errors += time_errors
+        warnings += time_warnings
+
+    # estimate row count and in-memory size, source data is loaded as object dtype
+    if bytes_per_row:
+        result['est rows'] = int(file_size / bytes_per_row)
+        if len(sample_df) > 0:
+            memory_per_row = sample_df.memory_usage(index=False, deep=True).sum() / len(sample_df)
+            result['est memory MB'] = result['est rows'] * memory_per_row / 1e6
+
+    result['errors'] = '; '.join(errors)
+    result['warnings'] = '; '.join(warnings)
+    if not errors:
+        result['status'] = 'ok'
+
+    return result
+
+
+def preflight_files(file_list, data_profile, hdiut=True, sample_rows=100, num_workers=0):
+    """
+    Check source data files, in parallel if num_workers > 1
+
+    :param file_list: list of file names to check
+    :param data_profile: ``DataSourceProfile`` object
+    :param hdiut: if True then HDIUT time, engine speed, engine torque and vehicle speed signals are required
+    :param sample_rows: number of data rows to read from each file
+    :param num_workers: number of worker processes, 0 or 1 to run in-process
+    :return: (report dataframe, list of files that passed) tuple
+    """
+    file_list = sorted(file_list)
+
+    if num_workers > 1 and len(file_list) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(preflight_file, file_list, [data_profile] * len(file_list),
+                                        [hdiut] * len(file_list), [sample_rows] * len(file_list)))
+    else:
+        results = [preflight_file(data_filename, data_profile, hdiut, sample_rows) for data_filename in file_list]
+
+    report_df = pd.DataFrame(results)
+    passed_file_list = report_df.loc[report_df['status'] == 'ok', 'file'].tolist()
+
+    return report_df, passed_file_list
+
+
+def print_preflight_summary(report_df):
+    """
+    Print pre-flight pass/fail counts and failure reasons
+
+    :param report_df: report dataframe from ``preflight_files()``
+    """
+    failed_df = report_df.loc[report_df['status'] != 'ok']
+    print('\nPre-flight: %d of %d files passed, largest file %.1f MB estimated in-memory size' %
+          (len(report_df) - len(failed_df), len(report_df), report_df['est memory MB'].max()))
+    for _, row in failed_df.iterrows():
+        print('    FAILED %s: %s' % (row['file'], row['errors']))
+    print()
+
+
+# command line arguments for pre-flight checks, shared with cti_process_TBW.py
+preflight_args = [
+    "parser.add_argument('--preflight_sample_rows', type=str, help='Number of data rows read from each file by the pre-flight check [default: 100]', default='100')",
+    "parser.add_argument('--preflight_workers', type=str, help='Number of pre-flight check worker processes, 0 = in-process [default: 0]', default='0')",
+]
+
+preflight_options = ["options.preflight_sample_rows = args.preflight_sample_rows",
+                     "options.preflight_workers = args.preflight_workers",
+                     ]
+
+
+# entry point for script when called from command line
+if __name__ == '__main__':
+    import cti_common as cti
+
+    additional_args = [
+        "parser.add_argument('--hdiut', action='store_true', help='Data comes from EPA Heavy-Duty In-Use Testing')",
+    ] + preflight_args
+
+    additional_options = ["options.hdiut = args.hdiut",
+                          ] + preflight_options
+
+    # process script-specific and common (see cti_common.py) command line options
+    options = cti.handle_command_line_options(
+        app_description='Pre-flight Check, checks source data files before batch processing',
+        additional_args=additional_args,
+        additional_options=additional_options)
+
+    report_df, passed_file_list = preflight_files(options.file_list, options.data_profile, options.hdiut,
+                                                  int(options.preflight_sample_rows), int(options.preflight_workers))
+    print_preflight_summary(report_df)
+
+    report_filename = options.output_path + os.sep + 'preflight_report.csv'
+    report_df.to_csv(report_filename, index=False)
+    print('wrote %s' % report_filename)
+
+    file_list_filename = options.output_path + os.sep + 'preflight_file_list.txt'
+    with open(file_list_filename, 'w') as f:
+        f.write('\n'.join(passed_file_list) + '\n')
+    print('wrote %s' % file_list_filename)
@@ -3,7 +3,7 @@
 cti_process_TBW.py
 ==================
 
-Process time-based windows for NOx emissions
+Process time-based windows for NOx emissions, and optionally other tailpipe emissions species in the same pass
 
 .. note::
 
@@ -17,8 +17,16 @@ Process time-based windows for NOx emissions
 """
 
 import os
+import sys
+import re
+import io
+import time
+import contextlib
+import csv
 import copy
+import functools
 from datetime import datetime
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -32,6 +40,17 @@ import cti_common as cti
 from cti_plot import *
 import cti_window_processor as wp
 import cti_unit_conversions as convert
+import cti_bootstrap as bootstrap
+import cti_cutpoints as cutpoints
+import cti_window_store as window_store
+import cti_preflight as preflight
+import cti_scheduler as scheduler
+import cti_progress as progress
+import cti_sketch as sketch
+import cti_results_db as results_db
+import cti_time_align as time_align
+import cti_operating_modes as operating_modes
+import cti_signal_table as signal_table
 
 # ------------------------------------- #
 
@@ -42,21 +61,1264 @@ pctile_increment_pct = 5
 pctile_range = np.arange(0, 105, pctile_increment_pct).tolist()
 
 
+# command line arguments for window binning and bin results, shared with cti_rebin_TBW.py
+tbw_bin_args = [
+    "parser.add_argument('--idle_speed_thresh_mph', type=str, help='Speed threshhold for idle bin below this speed [default: 1]', default='1')",
+    "parser.add_argument('--ftp_co2_gphphr', type=str, help='FTP CO2 g/hp-hr for this engine', default='')",
+    "parser.add_argument('--co2_normalization', action='store_true', help='NOx g/hp-hr = NOx_g/CO2_g * CO2_g/FTP_hp-hr')",
+    "parser.add_argument('--true_idle_bin', action='store_true', help='Add extra bin for true idle (vehicle speed < idle_speed_thresh_mph mph for entire window)')",
+    "parser.add_argument('--hp_cutpoints_pct', type=str, help='Horsepower cutpoints for bin definitions [default: 25]', default='25')",
+    "parser.add_argument('--reuse_output_folder', action='store_true', help='Reuse output folder, append to prior results summary and fleet sketches')",
+    "parser.add_argument('--clean_output_folder', action='store_true', help='Delete output folder before processing, including prior results and staging folders left by interrupted runs, do not use while other runs share the output folder')",
+    "parser.add_argument('--cutpoint_sweep_pct', type=str, help='Cutpoint sweep grid start:stop:step (percent) for one and two cutpoint candidate tables, e.g. 2:60:1 [default: no sweep]', default='')",
+    "parser.add_argument('--bootstrap_samples', type=str, help='Number of bootstrap resamples for bin NOx confidence intervals, 0 = off [default: 0]', default='0')",
+    "parser.add_argument('--bootstrap_ci_pct', type=str, help='Bootstrap confidence interval width (percent) [default: 90]', default='90')",
+    "parser.add_argument('--bootstrap_seed', type=str, help='Bootstrap random seed, for repeatable confidence intervals [default: random]', default='')",
+    "parser.add_argument('--bootstrap_workers', type=str, help='Number of bootstrap worker processes, 0 = in-process [default: 0]', default='0')",
+    "parser.add_argument('--species', type=str, help='Tailpipe emissions species for window and bin results, comma separated, or profile for all tailpipe species in the data source profile, NOX is always included [default: NOX]', default='NOX')",
+]
+
+# command line arguments for time-based window processing, shared with cti_tbw_service.py
+tbw_window_args = [
+    "parser.add_argument('--window_length_secs', type=str, help='time-based window length (seconds) [default: 300]', default='300')",
+    "parser.add_argument('--window_step_secs', type=str, help='time-based window step (seconds) [default: 300]', default='300')",
+    "parser.add_argument('--window_min_secs', type=str, help='time-based window minimum size (seconds) [default: 30]', default='30')",
+    "parser.add_argument('--hdiut', action='store_true', help='Data comes from EPA Heavy-Duty In-Use Testing')",
+    "parser.add_argument('--resample_Hz', type=str, help='Resample data to a uniform time grid at this data rate (Hz) before window processing [default: no resampling]', default='')",
+    "parser.add_argument('--resample_method', type=str, help='Resample method, interp = linear interpolation, mean = block average [default: interp]', default='interp', choices=['interp', 'mean'])",
+    "parser.add_argument('--save_windows', action='store_true', help='Save window tables to OUTPUT_PATH/window_tables for use by cti_rebin_TBW.py')",
+    "parser.add_argument('--chunk_rows', type=str, help='Read and process source data in blocks of this many rows to limit memory use, 0 = load whole file [default: 0]', default='0')",
+    "parser.add_argument('--preflight', action='store_true', help='Check file headers and data samples first, only process files that pass')",
+    "parser.add_argument('--max_dt', type=str, help='Maximum time step (seconds), longer time gaps are shortened to this [default: 1 / data rate]', default='')",
+    "parser.add_argument('--indexed_windows', action='store_true', help='Vectorized window search using integer sample indices, for sub-second window steps and high-rate data')",
+    "parser.add_argument('--window_pctiles', type=str, help='Window percentiles of data channels, semicolon separated channel:percentiles, e.g. \"Aftertreatment Out Temp C:10,50\", heavily overlapping windows (e.g. a 1 second step) take about 5 usecs per sample per channel [default: none]', default='')",
+    "parser.add_argument('--window_workers', type=str, help='Calculate window statistics of each file in parallel with this many workers, 0 = single worker [default: 0]', default='0')",
+    "parser.add_argument('--window_pool', type=str, help='Window statistics worker pool, process = worker processes, thread = worker threads [default: process]', default='process', choices=['process', 'thread'])",
+    "parser.add_argument('--adaptive_step_factor', type=str, help='Adaptive coarse-to-fine windows, coarse window step as a multiple of window_step_secs, 0 = off [default: 0]', default='0')",
+    "parser.add_argument('--adaptive_pctiles', type=str, help='Window NOx g/hp-hr percentiles to refine adaptive windows around [default: 70,95]', default='70,95')",
+    "parser.add_argument('--adaptive_margin', type=str, help='Number of coarse windows either side of each percentile to refine [default: 2]', default='2')",
+    "parser.add_argument('--adaptive_check', action='store_true', help='Also calculate all windows and report adaptive percentile errors')",
+    "parser.add_argument('--time_align_emissions', action='store_true', help='Estimate and remove emissions channel delays relative to the time align reference')",
+    "parser.add_argument('--time_align_reference', type=str, help='Time align reference signal, power = engine power, co2 = tailpipe CO2 [default: power]', default='power', choices=['power', 'co2'])",
+    "parser.add_argument('--time_align_max_lag_secs', type=str, help='Maximum emissions delay searched either side of zero (seconds) [default: 20]', default='20')",
+    "parser.add_argument('--operating_modes', action='store_true', help='Label samples as idle, cruise or transient and add window mode fraction columns')",
+    "parser.add_argument('--idle_speed_mph', type=str, help='Operating mode idle vehicle speed threshold, idle below this speed [default: 1]', default='1')",
+    "parser.add_argument('--cruise_speed_mph', type=str, help='Operating mode cruise vehicle speed threshold, cruise at or above this speed, 0 = no cruise mode [default: 40]', default='40')",
+    "parser.add_argument('--idle_rpm_threshold', type=str, help='Operating mode idle engine speed threshold, idle at or below this engine speed, 0 = vehicle speed only [default: 0]', default='0')",
+    "parser.add_argument('--mode_min_secs', type=str, help='Operating modes shorter than this (seconds) take the mode of the previous run [default: 3]', default='3')",
+]
+
+tbw_window_options = ["options.window_length_secs = args.window_length_secs",
+                      "options.window_step_secs = args.window_step_secs",
+                      "options.window_min_secs = args.window_min_secs",
+                      "options.hdiut = args.hdiut",
+                      "options.resample_Hz = args.resample_Hz",
+                      "options.resample_method = args.resample_method",
+                      "options.save_windows = args.save_windows",
+                      "options.chunk_rows = args.chunk_rows",
+                      "options.preflight = args.preflight",
+                      "options.max_dt = args.max_dt",
+                      "options.indexed_windows = args.indexed_windows",
+                      "options.window_pctiles = args.window_pctiles",
+                      "options.window_workers = args.window_workers",
+                      "options.window_pool = args.window_pool",
+                      "options.adaptive_step_factor = args.adaptive_step_factor",
+                      "options.adaptive_pctiles = args.adaptive_pctiles",
+                      "options.adaptive_margin = args.adaptive_margin",
+                      "options.adaptive_check = args.adaptive_check",
+                      "options.time_align_emissions = args.time_align_emissions",
+                      "options.time_align_reference = args.time_align_reference",
+                      "options.time_align_max_lag_secs = args.time_align_max_lag_secs",
+                      "options.operating_modes = args.operating_modes",
+                      "options.idle_speed_mph = args.idle_speed_mph",
+                      "options.cruise_speed_mph = args.cruise_speed_mph",
+                      "options.idle_rpm_threshold = args.idle_rpm_threshold",
+                      "options.mode_min_secs = args.mode_min_secs",
+                      ]
+
+tbw_bin_options = ["options.idle_speed_thresh_mph = args.idle_speed_thresh_mph",
+                   "options.ftp_co2_gphphr = args.ftp_co2_gphphr",
+                   "options.co2_normalization = args.co2_normalization",
+                   "options.true_idle_bin = args.true_idle_bin",
+                   "options.hp_cutpoints_pct = args.hp_cutpoints_pct",
+                   "options.reuse_output_folder = args.reuse_output_folder",
+                   "options.clean_output_folder = args.clean_output_folder",
+                   "options.cutpoint_sweep_pct = args.cutpoint_sweep_pct",
+                   "options.bootstrap_samples = args.bootstrap_samples",
+                   "options.bootstrap_ci_pct = args.bootstrap_ci_pct",
+                   "options.bootstrap_seed = args.bootstrap_seed",
+                   "options.bootstrap_workers = args.bootstrap_workers",
+                   "options.species = args.species",
+                   ]
+
+
 # ------------------------------------- #
 
-def tbw_processor(data_filename, output_folder, __options):
+def get_species_list(species):
+    """
+    Get list of emissions species to process.  NOx is always processed, and first, since windows are ranked by NOx
+    g/hp-hr for the plots, cutpoint sweeps and adaptive windows
+
+    :param species: comma separated string or list of species names, e.g. 'NOX,CO'
+    :return: list of species names, e.g. ['NOX', 'CO']
+    """
+    if isinstance(species, str):
+        species = species.split(',')
+
+    species_list = ['NOX']
+    for s in species:
+        s = s.strip()
+        if s and s not in species_list:
+            species_list.append(s)
+
+    return species_list
+
+
+def get_profile_species(data_profile):
+    """
+    Get tailpipe emissions species with a source signal in the data source profile, other than CO2
+
+    :param data_profile: ``DataSourceProfile`` object
+    :return: list of species names, e.g. ['NOX', 'CO', 'THC', 'NMHC']
+    """
+    species = []
+    for destination_signal in data_profile.signal_plan.linear_destinations + \
+            data_profile.signal_plan.derived_destinations:
+        match = re.match(r'^Tailpipe (\S+) g/s$', destination_signal)
+        if match and match.group(1) != 'CO2':
+            species.append(match.group(1))
+
+    return get_species_list(species)
+
+
+def species_signals(species):
+    """
+    Get tailpipe emissions rate signal names for a list of species
+
+    :param species: list of species names, e.g. ['NOX', 'CO']
+    :return: list of signal names, e.g. ['Tailpipe NOX g/s', 'Tailpipe CO g/s']
+    """
+    return ['Tailpipe %s g/s' % s for s in species]
+
+
+def get_window_pctiles(window_pctiles):
+    """
+    Get the window percentiles of each channel
+
+    :param window_pctiles: string of semicolon separated channel:percentiles, e.g.
+        'Aftertreatment Out Temp C:10,50;Vehicle Speed MPH:50', or dict of channel name: list of percentiles
+    :return: ordered dict of channel name: list of percentiles, e.g. {'Aftertreatment Out Temp C': [10.0, 50.0]}
+    """
+    pctile_chans = OrderedDict()
+
+    if isinstance(window_pctiles, str):
+        for chan_pctiles in window_pctiles.split(';'):
+            if chan_pctiles.strip():
+                if ':' not in chan_pctiles:
+                    raise Exception('window percentiles "%s" must be channel:percentiles' % chan_pctiles)
+                signal_name, pctiles = chan_pctiles.rsplit(':', 1)
+                pctile_chans[signal_name.strip()] = [float(pctile) for pctile in pctiles.split(',')]
+    elif window_pctiles:
+        for signal_name, pctiles in window_pctiles.items():
+            pctile_chans[signal_name] = [float(pctile) for pctile in pctiles]
+
+    for signal_name, pctiles in pctile_chans.items():
+        if not all(0 <= pctile <= 100 for pctile in pctiles):
+            raise Exception('window percentiles of %s must be from 0 to 100' % signal_name)
+
+    return pctile_chans
+
+
+def window_integrate_chans(options):
+    """
+    Get the channels integrated over each window: power, CO2 for binning and every emissions species
+
+    :param options: Data structure of command line / runtime options settings
+    :return: list of channel names
+    """
+    integrate_chans = ['Power hp', 'Tailpipe NOX g/s', 'Tailpipe CO2 g/s']
+    for signal in species_signals(options.species):
+        if signal not in integrate_chans:
+            integrate_chans.append(signal)
+
+    return integrate_chans
+
+
+def process_bin_options(options):
+    """
+    Convert window binning command line option strings to numeric runtime values
+
+    :param options: Data structure of command line / runtime options settings, modified in place
+    """
+    options.bootstrap_samples = int(options.bootstrap_samples)
+    options.bootstrap_ci_pct = float(options.bootstrap_ci_pct)
+    options.bootstrap_workers = int(options.bootstrap_workers)
+    if options.bootstrap_seed != '':
+        options.bootstrap_seed = int(options.bootstrap_seed)
+    else:
+        options.bootstrap_seed = None
+
+    # generate numeric array of bin normalized hp cutpoints
+    try:
+        options.hp_cutpoints_frac = np.array([float(c) for c in options.hp_cutpoints_pct.split(',') if c.strip()]) / 100
+    except ValueError:
+        raise Exception('hp cutpoints "%s" must be comma separated numbers' % options.hp_cutpoints_pct)
+
+    # generate numeric array of cutpoint sweep candidates
+    if options.cutpoint_sweep_pct:
+        sweep_start, sweep_stop, sweep_step = [float(s) for s in options.cutpoint_sweep_pct.split(':')]
+        options.cutpoint_sweep_frac = np.arange(sweep_start, sweep_stop + sweep_step / 2, sweep_step) / 100
+
+    # generate list of emissions species
+    if options.species == 'profile':
+        if getattr(options, 'data_profile', None) is None:
+            raise Exception('--species profile requires a data source profile')
+        options.species = get_profile_species(options.data_profile)
+    else:
+        options.species = get_species_list(options.species)
+
+
+def process_window_options(options):
+    """
+    Convert time-based window and window binning command line option strings to numeric runtime values
+
+    :param options: Data structure of command line / runtime options settings, modified in place
+    """
+    options.window_length_secs = float(options.window_length_secs)
+    options.window_step_secs = float(options.window_step_secs)
+    options.window_min_secs = float(options.window_min_secs)
+    if options.resample_Hz != '':
+        options.resample_Hz = float(options.resample_Hz)
+    else:
+        options.resample_Hz = 0
+    options.chunk_rows = int(options.chunk_rows)
+    if options.max_dt != '':
+        options.max_dt = float(options.max_dt)
+    else:
+        options.max_dt = 0
+    options.window_pctiles = get_window_pctiles(options.window_pctiles)
+    options.window_workers = int(options.window_workers)
+    options.adaptive_step_factor = int(options.adaptive_step_factor)
+    options.adaptive_pctiles = [float(pctile) for pctile in options.adaptive_pctiles.split(',')]
+    options.adaptive_margin = int(options.adaptive_margin)
+    options.time_align_max_lag_secs = float(options.time_align_max_lag_secs)
+    options.idle_speed_mph = float(options.idle_speed_mph)
+    options.cruise_speed_mph = float(options.cruise_speed_mph)
+    options.idle_rpm_threshold = float(options.idle_rpm_threshold)
+    options.mode_min_secs = float(options.mode_min_secs)
+
+    process_bin_options(options)
+
+
+def get_tbw_folder_name(options):
+    """
+    Generate output folder name based on user supplied settings, e.g. 'cti_TBW_300_1_TI_c(8,25)_co2n_idl1'
+
+    :param options: Data structure of command line / runtime options settings
+    :return: output folder name
+    """
+    return file_io.get_filename(__file__).replace('process_', '') + '_%g_%g%s' % (
+        options.window_length_secs, options.window_step_secs, get_descriptor_str(options))
+
+
+def window_table_tag_str(options):
+    """
+    Generate tag string for settings (other than window length, step and minimum size) that change window results
+
+    :param options: Data structure of command line / runtime options settings
+    :return: tag string, e.g. '_rs1mean', or '' if no such settings are active
+    """
+    tag_str = ''
+
+    if options.species != ['NOX']:
+        tag_str = tag_str + '_sp(' + ','.join(options.species) + ')'
+
+    if options.resample_Hz:
+        tag_str = tag_str + '_rs%g%s' % (options.resample_Hz, options.resample_method)
+
+    if options.max_dt:
+        tag_str = tag_str + '_mdt%g' % options.max_dt
+
+    if getattr(options, 'adaptive_step_factor', 0):
+        tag_str = tag_str + '_ad%d' % options.adaptive_step_factor
+
+    if getattr(options, 'time_align_emissions', False):
+        tag_str = tag_str + '_ta%s' % options.time_align_reference.replace('power', '')
+
+    if getattr(options, 'operating_modes', False):
+        tag_str = tag_str + '_om'
+
+    return tag_str
+
+
+def get_descriptor_str(options):
+    """
+    Generate output descriptor string based on user supplied settings, e.g. '_TI_c(8,25)_co2n_idl1'
+
+    :param options: Data structure of command line / runtime options settings
+    :return: descriptor string
+    """
+    descriptor_str = ''
+
+    if options.true_idle_bin:
+        descriptor_str = descriptor_str + '_TI'
+
+    if isinstance(options.hp_cutpoints_pct, str):
+        descriptor_str = descriptor_str + '_c(' + options.hp_cutpoints_pct + ')'
+    else:
+        descriptor_str = descriptor_str + '_c(' + ','.join('%g' % c for c in options.hp_cutpoints_pct) + ')'
+
+    if options.co2_normalization:
+        descriptor_str = descriptor_str + '_co2n'
+
+    descriptor_str = descriptor_str + '_idl%s' % options.idle_speed_thresh_mph
+
+    descriptor_str = descriptor_str + window_table_tag_str(options)
+
+    return descriptor_str
+
+
+def calc_window_rates(wp_window_df, options, max_co2_rate_gphr):
+    """
+    Calculate window work, average power, emissions species g/hp-hr and CO2 rates then sort windows by NOx g/hp-hr
+
+    :param wp_window_df: pandas dataframe of windows from ``find_windows()``
+    :param options: Data structure of command line / runtime options settings
+    :param max_co2_rate_gphr: maximum grams CO2/hour emissions rate, for normalized CO2 rate
+    :return: window dataframe sorted by NOx g/hp-hr, with original window number in the 'window_num' column
+    """
+    # calculate window work hp-hr and average power
+    wp_window_df['Power hp-hr'] = wp_window_df['Power hp-sec'] / 3600
+    wp_window_df['Avg Power hp'] = wp_window_df['Power hp-sec'] / wp_window_df['duration']
+
+    # calculate window g/hp-hr for each emissions species
+    for species in options.species:
+        if options.co2_normalization:
+            wp_window_df['%s g/hp-hr' % species] = wp_window_df['Tailpipe %s g' % species] / wp_window_df[
+                'Tailpipe CO2 g'] * options.ftp_co2_gphphr
+        else:
+            wp_window_df['%s g/hp-hr' % species] = wp_window_df['Tailpipe %s g' % species] / \
+                wp_window_df['Power hp-hr']
+
+    # calculate CO2 emissions rates
+    wp_window_df['Tailpipe CO2 g/hr'] = wp_window_df['Tailpipe CO2 g'] / wp_window_df['duration'] * 3600
+    wp_window_df['Tailpipe CO2 g/hp-hr'] = wp_window_df['Tailpipe CO2 g/hr'] / wp_window_df['Avg Power hp']
+    wp_window_df['Tailpipe CO2 rate norm'] = wp_window_df['Tailpipe CO2 g/hr'] / max_co2_rate_gphr
+
+    # sort windows by NOx g/hp-hr
+    wp_window_df.sort_values('NOX g/hp-hr', inplace=True)
+    wp_window_df.reset_index(drop=False, inplace=True)
+    wp_window_df.rename(columns={'index': 'window_num'}, inplace=True)
+
+    return wp_window_df
+
+
+def bin_windows(wp_window_df, options):
+    """
+    Separate 'true idle' windows (if requested) and bin the remaining windows by normalized CO2 rate cutpoints
+
+    :param wp_window_df: pandas dataframe of windows from ``calc_window_rates()``
+    :param options: Data structure of command line / runtime options settings
+    :return: (wp_window_df, true_idle_pts, bins) tuple, wp_window_df excluding 'true idle' windows, dataframe of
+        'true idle' windows and dict of bin window dataframes by bin name
+
+    """
+    # load idle speed cutoff MPH
+    idle_cutoff_mph = float(options.idle_speed_thresh_mph)
+
+    # calculate 'true idle' bin (window average vehicle speed below idle cutoff mph)
+    if options.true_idle_bin:
+        true_idle_pts = wp_window_df.loc[wp_window_df['Vehicle Speed MPH AVG'] < idle_cutoff_mph]
+        true_idle_pts.reset_index(drop=True, inplace=True)
+        # cull true idle points to process the rest as normal down below
+        wp_window_df = wp_window_df.loc[wp_window_df['Vehicle Speed MPH AVG'] >= idle_cutoff_mph]
+    else:
+        true_idle_pts = []
+
+    # bin windows based on user supplied normalized CO2 rate cutpoints
+    bins = {}
+    previous_bin_frac = 0
+    for cutpoint_frac in options.hp_cutpoints_frac:
+        bin_name = ('%.1f->%.1f' % (previous_bin_frac * 100, cutpoint_frac * 100))
+        bins[bin_name] = wp_window_df.loc[(wp_window_df['Tailpipe CO2 rate norm'] > previous_bin_frac) & (
+                    wp_window_df['Tailpipe CO2 rate norm'] <= cutpoint_frac)]
+        bins[bin_name].reset_index(drop=True, inplace=True)
+        previous_bin_frac = cutpoint_frac
+
+    bin_name = ('>%.1f' % (previous_bin_frac * 100))
+    bins[bin_name] = (wp_window_df.loc[(wp_window_df['Tailpipe CO2 rate norm'] > previous_bin_frac)])
+    bins[bin_name].reset_index(drop=True, inplace=True)
+
+    return wp_window_df, true_idle_pts, bins
+
+
+def window_count(window_df):
+    """
+    Count windows, windows from adaptive stepping count as their 'weight', the number of windows they stand for
+
+    :param window_df: pandas dataframe of windows, or empty list
+    :return: number of windows
+    """
+    if isinstance(window_df, pd.DataFrame) and 'weight' in window_df.columns:
+        return int(window_df['weight'].sum())
+    else:
+        return len(window_df)
+
+
+def weighted_sum(window_df, column):
+    """
+    Sum a window column, windows from adaptive stepping are weighted by their 'weight'
+
+    :param window_df: pandas dataframe of windows
+    :param column: name of column to sum
+    :return: column sum
+    """
+    if 'weight' in window_df.columns:
+        return (window_df[column] * window_df['weight']).sum()
+    else:
+        return window_df[column].sum()
+
+
+def weighted_mean_sd(window_df, column):
+    """
+    Calculate the mean and sample standard deviation of a window column, NaN values are skipped and windows from
+    adaptive stepping are weighted by their 'weight'
+
+    :param window_df: pandas dataframe of windows
+    :param column: name of column
+    :return: (mean, standard deviation) tuple
+    """
+    if 'weight' in window_df.columns:
+        valid = window_df[column].notna()
+        x = window_df.loc[valid, column].values
+        w = window_df.loc[valid, 'weight'].values
+        if w.sum() == 0:
+            return np.NaN, np.NaN
+        mean = np.sum(w * x) / w.sum()
+        if w.sum() > 1:
+            sd = np.sqrt(np.sum(w * (x - mean) ** 2) / (w.sum() - 1))
+        else:
+            sd = np.NaN
+        return mean, sd
+    else:
+        return window_df[column].mean(), window_df[column].std()
+
+
+def weighted_pctile(values, weights, pctile):
+    """
+    Interpolate a percentile of sorted values where each value stands for weights copies of itself, the same as
+    ``np.interp(pctile, index / index.max() * 100, values)`` of the expanded values
+
+    :param values: numpy array of sorted values
+    :param weights: numpy array of integer weights
+    :param pctile: percentile (0-100)
+    :return: percentile value
+    """
+    cumulative_weight = np.cumsum(weights)
+    rank = pctile / 100 * (cumulative_weight[-1] - 1)
+    low_value = values[min(np.searchsorted(cumulative_weight, np.floor(rank), side='right'), len(values) - 1)]
+    high_value = values[min(np.searchsorted(cumulative_weight, np.ceil(rank), side='right'), len(values) - 1)]
+    return low_value + (rank - np.floor(rank)) * (high_value - low_value)
+
+
+def calc_pctile_results(bin_results, bin_name, rates, weights=None, species='NOX'):
+    """
+    Calculate window emissions g/hp-hr percentiles for a bin
+
+    :param bin_results: dict of bin results to add percentile results to
+    :param bin_name: name of the bin, e.g. '0.0->25.0'
+    :param rates: pandas series of bin window g/hp-hr of the species, sorted, with a zero-based index
+    :param weights: optional pandas series of window weights from adaptive stepping
+    :param species: emissions species name, e.g. 'NOX'
+    """
+    if len(rates) > 0 and weights is not None:
+        for pctile in pctile_range:
+            bin_results[bin_name + ' %dth pctile %s g/hp-hr' % (pctile, species)] = \
+                weighted_pctile(rates.values, weights.values, pctile)
+    elif len(rates) > 0:
+        rates_pctile = rates.index / rates.index.max() * 100
+        for pctile in pctile_range:
+            bin_results[bin_name + ' %dth pctile %s g/hp-hr' % (pctile, species)] = \
+                np.interp(pctile, rates_pctile, rates.values)
+    else:
+        bin_results[bin_name + ' 70th pctile %s g/hp-hr' % species] = np.NaN
+        bin_results[bin_name + ' 95th pctile %s g/hp-hr' % species] = np.NaN
+
+
+def ranked_species_rates(bin_data, species):
+    """
+    Get bin window g/hp-hr of a species in rank order, windows are sorted by NOx g/hp-hr so other species are re-ranked
+
+    :param bin_data: dataframe of bin windows from ``bin_windows()``
+    :param species: emissions species name, e.g. 'CO'
+    :return: (rates, weights) tuple of pandas series with a zero-based index, weights is ``None`` unless the windows
+        are from adaptive stepping
+    """
+    if species == 'NOX':
+        return bin_data['NOX g/hp-hr'], bin_data.get('weight')
+
+    ranked = bin_data.sort_values('%s g/hp-hr' % species, kind='mergesort').reset_index(drop=True)
+    return ranked['%s g/hp-hr' % species], ranked.get('weight')
+
+
+def calc_bin_results(true_idle_pts, bins, options):
+    """
+    Calculate 'true idle' and bin emissions rates, aftertreatment temperatures, window counts and window emissions
+    percentiles for each emissions species
+
+    :param true_idle_pts: dataframe of 'true idle' windows from ``bin_windows()``
+    :param bins: dict of bin window dataframes from ``bin_windows()``
+    :param options: Data structure of command line / runtime options settings
+    :return: (true_idle_results, bin_results) tuple of dicts of results by summary column name
+    """
+    true_idle_results = dict()
+    for species in options.species:
+        if options.true_idle_bin:
+            true_idle_results['True Idle %s Rate g/hr' % species] = \
+                weighted_sum(true_idle_pts, 'Tailpipe %s g' % species) / weighted_sum(true_idle_pts, 'duration') * 3600
+            if options.co2_normalization:
+                true_idle_results['True Idle %s g/hp-hr' % species] = \
+                    weighted_sum(true_idle_pts, 'Tailpipe %s g' % species) / \
+                    weighted_sum(true_idle_pts, 'Tailpipe CO2 g') * options.ftp_co2_gphphr
+            else:
+                true_idle_results['True Idle %s g/hp-hr' % species] = \
+                    weighted_sum(true_idle_pts, 'Tailpipe %s g' % species) / weighted_sum(true_idle_pts, 'Power hp-hr')
+        else:
+            true_idle_results['True Idle %s Rate g/hr' % species] = np.NaN
+            true_idle_results['True Idle %s g/hp-hr' % species] = np.NaN
+    true_idle_results['True Idle Window Count'] = window_count(true_idle_pts)
+
+    # calculate results for emissions bins
+    bin_results = {}
+
+    for species in options.species:
+        if options.co2_normalization:
+            for bin_name, bin_data in bins.items():
+                bin_results[bin_name + ' %s g/hp-hr' % species] = weighted_sum(bin_data, 'Tailpipe %s g' % species) / \
+                    weighted_sum(bin_data, 'Tailpipe CO2 g') * options.ftp_co2_gphphr
+        else:
+            for bin_name, bin_data in bins.items():
+                bin_results[bin_name + ' %s g/hp-hr' % species] = weighted_sum(bin_data, 'Tailpipe %s g' % species) / \
+                    weighted_sum(bin_data, 'Power hp-hr')
+
+    for bin_name, bin_data in bins.items():
+        bin_results[bin_name + ' Aftertreatment Out Temp C AVG'], \
+            bin_results[bin_name + ' Aftertreatment Out Temp C SD'] = \
+            weighted_mean_sd(bin_data, 'Aftertreatment Out Temp C AVG')
+        bin_results[bin_name + ' Window Count'] = window_count(bin_data)
+
+        # average window percentiles, if any
+        for pctile_column in [c for c in bin_data.columns if re.match(r'^.+ P[0-9.]+$', c)]:
+            bin_results[bin_name + ' %s AVG' % pctile_column] = weighted_mean_sd(bin_data, pctile_column)[0]
+
+        # average window operating mode fractions, if labeled
+        for mode_name in operating_modes.mode_names:
+            if mode_name + ' Fraction' in bin_data:
+                bin_results[bin_name + ' %s Fraction AVG' % mode_name] = \
+                    weighted_mean_sd(bin_data, mode_name + ' Fraction')[0]
+
+    # calculate ranked window percentiles
+    for species in options.species:
+        if options.true_idle_bin:
+            calc_pctile_results(bin_results, 'True Idle', *ranked_species_rates(true_idle_pts, species),
+                                species=species)
+
+        for bin_name, bin_data in bins.items():
+            calc_pctile_results(bin_results, bin_name, *ranked_species_rates(bin_data, species), species=species)
+
+    return true_idle_results, bin_results
+
+
+def calc_bin_ci(true_idle_pts, bins, options):
+    """
+    Calculate bootstrap confidence intervals for bin emissions and window emissions percentiles of each species
+
+    :param true_idle_pts: dataframe of 'true idle' windows from ``bin_windows()``
+    :param bins: dict of bin window dataframes from ``bin_windows()``
+    :param options: Data structure of command line / runtime options settings
+    :return: dict of confidence interval results by summary column name
+    """
+    ci_results = dict()
+
+    if options.co2_normalization:
+        denominator_chan, bin_scale = 'Tailpipe CO2 g', options.ftp_co2_gphphr
+    else:
+        denominator_chan, bin_scale = 'Power hp-hr', 1.0
+
+    # resample overlapping windows in blocks spanning one window length
+    block_secs = options.window_length_secs
+
+    ci_bins = dict()
+    if options.true_idle_bin:
+        ci_bins['True Idle'] = true_idle_pts
+    ci_bins.update(bins)
+
+    for species in options.species:
+        for bin_name, bin_data in ci_bins.items():
+            ci = bootstrap.bootstrap_bin_ci(bin_data, 'Tailpipe %s g' % species, denominator_chan,
+                                            '%s g/hp-hr' % species, scale=bin_scale, block_secs=block_secs,
+                                            num_resamples=options.bootstrap_samples, pctiles=[70, 95],
+                                            ci_pct=options.bootstrap_ci_pct, seed=options.bootstrap_seed,
+                                            num_workers=options.bootstrap_workers)
+            ci_results[bin_name + ' %s g/hp-hr CI lo' % species] = ci['rate'][0]
+            ci_results[bin_name + ' %s g/hp-hr CI hi' % species] = ci['rate'][1]
+            for pctile in [70, 95]:
+                ci_results[bin_name + ' %dth pctile %s g/hp-hr CI lo' % (pctile, species)] = ci[pctile][0]
+                ci_results[bin_name + ' %dth pctile %s g/hp-hr CI hi' % (pctile, species)] = ci[pctile][1]
+
+    return ci_results
+
+
+def time_align_results(time_align_lags):
+    """
+    Generate time alignment results, lag and peak correlation for each aligned emissions channel
+
+    :param time_align_lags: dict of channel: (lag secs, correlation) from ``time_align.align_emissions()``
+    :return: dict of results by summary column name, e.g. 'Time Align NOX Lag secs'
+    """
+    align_results = dict()
+    for channel, (lag_secs, correlation) in time_align_lags.items():
+        species = channel.replace('Tailpipe ', '').replace(' g/s', '')
+        align_results['Time Align %s Lag secs' % species] = lag_secs
+        align_results['Time Align %s Correlation' % species] = correlation
+
+    return align_results
+
+
+def tbw_summary(data_filename, true_idle_results, bin_results, time_align_lags=None):
+    """
+    Generate results summary row for a data file
+
+    :param data_filename: Name of processed file
+    :param true_idle_results: dict of 'true idle' results from ``calc_bin_results()``
+    :param bin_results: dict of bin results from ``calc_bin_results()``
+    :param time_align_lags: optional dict of emissions channel: (lag secs, correlation) if time aligned
+    :return: single row pandas dataframe of results, columns sorted by name
+    """
+    # generate results dictionary for this data file
+    results_dict = dict()
+    results_dict['file'] = file_io.get_filename(data_filename)
+    results_dict.update(true_idle_results)
+    results_dict.update(bin_results)
+    if time_align_lags:
+        results_dict.update(time_align_results(time_align_lags))
+
+    # return dataframe containing dictionary results
+    res = pd.DataFrame.from_dict([results_dict])
+    res.sort_index(axis='columns', inplace=True)
+
+    return res
+
+
+def plot_ranked_bin_windows(nox, bin_name, plot_data_filename, figure_filename):
+    """
+    Plot bin window percentile and ranked window number versus window NOx g/hp-hr
+
+    :param nox: pandas series of bin window NOx g/hp-hr, sorted, with a zero-based index
+    :param bin_name: name of the bin, e.g. '0.0->25.0'
+    :param plot_data_filename: data file name for plot titles
+    :param figure_filename: path and file name of the figure to save
+    """
+    nox_pctile = nox.index / nox.index.max() * 100
+    fig, ax1, ax2 = fplotyyhg(nox.values, nox_pctile, '', nox.index, '')
+    label_xyt(ax1, '%s Window NOx (g/hp-hr)' % bin_name, 'Percentile',
+              '%s\nNOx (g/hp-hr) per Window' % plot_data_filename)
+    label_xy(ax2, '%s Window NOx (g/hp-hr)' % bin_name, 'Ranked Window Number')
+    lineat(ax1, 95, 'b-')
+    lineat(ax1, 70, 'c-')
+    nox_gphphr_95 = np.interp(95, nox_pctile, nox.values)
+    nox_gphphr_70 = np.interp(70, nox_pctile, nox.values)
+    vlineat(ax1, nox_gphphr_95, 'b--')
+    vlineat(ax1, nox_gphphr_70, 'c--')
+    fig.subplots_adjust(right=0.875)
+    ax1.legend(['Percentile/Ranked Window Number', '95th pctile', '70th pctile',
+                '95th pctile NOx %.3f' % nox_gphphr_95,
+                '70th pctile NOx %.3f' % nox_gphphr_70], fontsize=9)
+    plt.savefig(figure_filename, orientation='landscape')
+
+
+def tbw_signal_names(options):
+    """
+    Get the prepared signals kept for time-based window processing and reporting
+
+    :param options: Data structure of command line / runtime options settings
+    :return: list of signal names
+    """
+    signal_names = []
+    for signal_name in tbw_signals + window_integrate_chans(options) + list(options.window_pctiles) + \
+            tbw_report_signals:
+        if signal_name not in signal_names:
+            signal_names.append(signal_name)
+
+    return signal_names
+
+
+def prep_tbw_signals(df, calcs_dataframe, data_filename, data_profile, options):
+    """
+    Convert source data to numeric, perform signal scaling as defined in data source profile and ensure required
+    data columns exist.
+
+    Only the signals from ``tbw_signal_names()`` are kept.  They are placed in a ``SignalTable`` by reference to the
+    source, calculated and mapped signal arrays, so no signal is copied into another dataframe.
+
+    :param df: source dataframe, whole file or a block of rows
+    :param calcs_dataframe: dataframe of calculated signals for HDIUT data, else ``None``
+    :param data_filename: name of the source data file
+    :param data_profile: ``DataSourceProfile`` object
+    :param options: Data structure of command line / runtime options settings
+    :return: ``SignalTable`` of time-based window signals
+    """
+    # make sure dataframe contains numeric data where possible
+    df = cti.dataframe_to_numeric(df)
+
+    # fix possible data source inconsistency
+    if ('NOX_Mass_Sec' in df.columns) and ('NOX_Mass_Sec_Final' not in df.columns):
+        print('\n%%%% FIXING NOX_Mass_Sec_Final %%%%')
+        df['NOX_Mass_Sec_Final'] = df['NOX_Mass_Sec']
+
+    # source signals by name, later entries replace earlier ones
+    prepared = dict(df.items())
+
+    # perform signal scaling as defined in data source profile and ensure required data columns
+    if data_filename.__contains__('vehMPH') or options.hdiut:
+        # create scaled and derived common-name destination signals from source signals
+        prepared.update(data_profile.signal_plan.evaluate(df))
+
+        if options.hdiut:
+            prepared['Power hp'] = calcs_dataframe['engine_power_hp']
+            prepared['Time secs'] = calcs_dataframe['time_secs']
+            prepared['Vehicle Speed'] = calcs_dataframe['vehicle_speed_mph']
+            prepared['Engine RPM'] = calcs_dataframe['engine_speed_rpm']
+        else:
+            renames = {'Power': 'Power kW', data_profile.time_signal: 'Time secs'}
+            prepared = {renames.get(k, k): v for k, v in prepared.items()}
+            prepared['Power hp'] = prepared['Power kW'] * convert.kW2hp
+
+    else:  # using concatenated_cycles dataframe...
+        # signals are already scaled, just rename a couple that we need:
+        renames = {'engine_power_hp': 'Power hp', 'time_secs': 'Time secs', 'Vehicle Speed MPH': 'Vehicle Speed'}
+        prepared = {renames.get(k, k): v for k, v in prepared.items()}
+
+    signals = signal_table.SignalTable()
+    for signal_name in tbw_signal_names(options):
+        if signal_name in prepared and np.issubdtype(np.asarray(prepared[signal_name]).dtype, np.number):
+            signals[signal_name] = prepared[signal_name]
+
+    # ensure desired column exists
+    if not 'Aftertreatment Out Temp C' in signals:
+        signals['Aftertreatment Out Temp C'] = 0
+
+    return signals
+
+
+def iter_tbw_chunks(data_filename, data_profile, options, cycle_totals):
+    """
+    Generate blocks of prepared time-based window signals, ``options.chunk_rows`` source rows at a time, for use with
+    ``find_windows_chunked()``.  Cycle work and NOx are integrated across blocks as they are generated.
+
+    :param data_filename: name of the source data file
+    :param data_profile: ``DataSourceProfile`` object
+    :param options: Data structure of command line / runtime options settings
+    :param cycle_totals: dict, 'work_hps', 'nox_g' and 'samples' cycle totals are updated as blocks are generated
+    :return: generator of ``SignalTable`` blocks
+    """
+    if options.hdiut:
+        source_chunks = cti.iter_calcs_dataframe_chunks(data_filename, data_profile, options.chunk_rows,
+                                                        options.verbose)
+    else:
+        source_chunks = ((chunk_df, None) for chunk_df in
+                         pd.read_csv(data_filename, header=0, dtype=object, chunksize=options.chunk_rows))
+
+    cycle_totals['work_hps'] = 0.0
+    cycle_totals['nox_g'] = 0.0
+    cycle_totals['samples'] = 0
+    previous_sample = None
+    for df, calcs_dataframe in source_chunks:
+        if options.hdiut:
+            df, calcs_dataframe = cti.prep_vehicle_speed(df, calcs_dataframe, data_profile)
+
+        df = prep_tbw_signals(df, calcs_dataframe, data_filename, data_profile, options)
+
+        # integrate cycle work and NOx, including the interval from the last sample of the previous block
+        time_secs = df['Time secs']
+        power_hp = np.maximum(0, df['Power hp'])
+        nox_gps = df['Tailpipe NOX g/s']
+        if previous_sample is not None:
+            time_secs, power_hp, nox_gps = [np.concatenate([[p], v]) for p, v in
+                                            zip(previous_sample, (time_secs, power_hp, nox_gps))]
+        cycle_totals['work_hps'] += trapz(power_hp, time_secs)
+        cycle_totals['nox_g'] += trapz(nox_gps, time_secs)
+        previous_sample = (time_secs[-1], power_hp[-1], nox_gps[-1])
+        cycle_totals['samples'] += len(df)
+
+        df['unity'] = 1  # integral of 1*dt is time, trick to make work-based window code create time-based windows
+
+        yield df
+
+
+def check_cycle_work(work_hphr, nox_g):
+    """
+    Print cycle work and NOx totals and check cycle work is valid
+
+    :param work_hphr: cycle work (hp-hr)
+    :param nox_g: cycle NOx (grams)
+    :return: cycle NOx g/hp-hr, or ``None`` if cycle work is NaN or negative
+    """
+    nox_gphpr = nox_g / work_hphr
+
+    print('\nWork hp-hr = %f' % work_hphr)
+    print('NOx grams = %f' % nox_g)
+    print('NOx grams/hp-hr = %f\n' % nox_gphpr)
+
+    # error checking on cycle work
+    if np.isnan(work_hphr):
+        print("\n*** WORK IS NAN, EXITING ***\n")
+        return None
+
+    if work_hphr < 0:
+        print("\n*** WORK IS NEGATIVE, EXITING ***\n")
+        return None
+
+    return nox_gphpr
+
+
+class TBWOptions(object):
+    """
+    Typed options for the in-memory time-based window API, ``tbw_evaluate()``.  Attribute names match the
+    command line runtime options so either may be passed to the time-based window functions
+
+    .. code-block:: python
+
+        # example usage:
+        options = TBWOptions(window_step_secs=1, co2_normalization=True, hp_cutpoints_pct=[8, 25])
+        results = tbw_evaluate(signals_df, options, engine_power_rating_hp=450)
+        print(results.summary_df)
+
+    """
+    def __init__(self, window_length_secs=300.0, window_step_secs=300.0, window_min_secs=30.0,
+                 idle_speed_thresh_mph=1.0, ftp_co2_gphphr=555.0, co2_normalization=False, true_idle_bin=False,
+                 hp_cutpoints_pct=(25,), cutpoint_sweep_pct=None, bootstrap_samples=0, bootstrap_ci_pct=90.0,
+                 bootstrap_seed=None, bootstrap_workers=0, resample_Hz=0, resample_method='interp', max_dt=0,
+                 indexed_windows=False, window_pctiles=None, window_workers=0, window_pool='process',
+                 adaptive_step_factor=0, adaptive_pctiles=(70, 95), adaptive_margin=2, adaptive_check=False,
+                 species=('NOX',), operating_modes=False, idle_speed_mph=1.0, cruise_speed_mph=40.0,
+                 idle_rpm_threshold=0.0, mode_min_secs=3.0, verbose=False):
+        """
+        Create ``TBWOptions`` object
+
+        :param window_length_secs: window length (seconds)
+        :param window_step_secs: window step (seconds)
+        :param window_min_secs: windows shorter than this (seconds) are discarded
+        :param idle_speed_thresh_mph: 'true idle' window average vehicle speed threshold (MPH)
+        :param ftp_co2_gphphr: FTP CO2 g/hp-hr for CO2 normalization and the maximum CO2 rate
+        :param co2_normalization: if True then NOx g/hp-hr = NOx_g/CO2_g * ftp_co2_gphphr
+        :param true_idle_bin: if True then 'true idle' windows are binned separately
+        :param hp_cutpoints_pct: list of normalized CO2 rate bin cutpoints (percent)
+        :param cutpoint_sweep_pct: optional (start, stop, step) cutpoint sweep grid (percent)
+        :param bootstrap_samples: number of bootstrap resamples for bin confidence intervals, 0 = off
+        :param bootstrap_ci_pct: bootstrap confidence interval width (percent)
+        :param bootstrap_seed: bootstrap random seed, ``None`` for random
+        :param bootstrap_workers: number of bootstrap worker processes, 0 = in-process
+        :param resample_Hz: data rate (Hz) the signals were resampled to, if any, for output descriptors
+        :param resample_method: resample method used, if any, for output descriptors
+        :param max_dt: maximum time step (seconds), longer time gaps are shortened to this, 0 = 1 / data rate
+        :param indexed_windows: if True then windows are found by ``find_windows_indexed()``, for sub-second window
+            steps and high-rate data
+        :param window_pctiles: optional dict of channel name: list of window percentiles, e.g.
+            {'Aftertreatment Out Temp C': [10, 50]}
+        :param window_workers: number of workers for the window statistics of each file, 0 = single worker
+        :param window_pool: window statistics worker pool, 'process' or 'thread'
+        :param adaptive_step_factor: adaptive coarse-to-fine windows, coarse window step as a multiple of
+            window_step_secs, 0 = off
+        :param adaptive_pctiles: window NOx g/hp-hr percentiles to refine adaptive windows around
+        :param adaptive_margin: number of coarse windows either side of each percentile to refine
+        :param adaptive_check: if True then all windows are also calculated to report adaptive percentile errors
+        :param species: list of tailpipe emissions species for window and bin results, NOX is always included
+        :param operating_modes: if True then samples are labeled idle, cruise or transient and window mode fraction
+            columns are added
+        :param idle_speed_mph: operating mode idle vehicle speed threshold, idle below this speed
+        :param cruise_speed_mph: operating mode cruise vehicle speed threshold, 0 = no cruise mode
+        :param idle_rpm_threshold: operating mode idle engine speed threshold, 0 = vehicle speed only
+        :param mode_min_secs: operating modes shorter than this (seconds) take the mode of the previous run
+        :param verbose: if True then optional outputs are printed to the console
+        """
+        self.window_length_secs = float(window_length_secs)
+        self.window_step_secs = float(window_step_secs)
+        self.window_min_secs = float(window_min_secs)
+        self.idle_speed_thresh_mph = float(idle_speed_thresh_mph)
+        self.ftp_co2_gphphr = float(ftp_co2_gphphr)
+        self.co2_normalization = co2_normalization
+        self.true_idle_bin = true_idle_bin
+        self.hp_cutpoints_pct = list(hp_cutpoints_pct)
+        self.hp_cutpoints_frac = np.array(self.hp_cutpoints_pct, dtype=float) / 100
+        self.cutpoint_sweep_pct = cutpoint_sweep_pct
+        if cutpoint_sweep_pct:
+            sweep_start, sweep_stop, sweep_step = cutpoint_sweep_pct
+            self.cutpoint_sweep_frac = np.arange(sweep_start, sweep_stop + sweep_step / 2, sweep_step) / 100
+        self.bootstrap_samples = int(bootstrap_samples)
+        self.bootstrap_ci_pct = float(bootstrap_ci_pct)
+        self.bootstrap_seed = bootstrap_seed
+        self.bootstrap_workers = int(bootstrap_workers)
+        self.resample_Hz = resample_Hz
+        self.resample_method = resample_method
+        self.max_dt = float(max_dt)
+        self.indexed_windows = indexed_windows
+        self.window_pctiles = get_window_pctiles(window_pctiles)
+        self.window_workers = int(window_workers)
+        self.window_pool = window_pool
+        self.adaptive_step_factor = int(adaptive_step_factor)
+        self.adaptive_pctiles = list(adaptive_pctiles)
+        self.adaptive_margin = int(adaptive_margin)
+        self.adaptive_check = adaptive_check
+        self.species = get_species_list(species)
+        self.operating_modes = operating_modes
+        self.idle_speed_mph = float(idle_speed_mph)
+        self.cruise_speed_mph = float(cruise_speed_mph)
+        self.idle_rpm_threshold = float(idle_rpm_threshold)
+        self.mode_min_secs = float(mode_min_secs)
+        self.verbose = verbose
+
+
+class TBWResults(object):
+    """
+    Container class for in-memory time-based window results from ``tbw_evaluate()``
+    """
+    def __init__(self):
+        self.work_hphr = np.nan  # cycle work
+        self.nox_g = np.nan  # cycle NOx
+        self.nox_gphphr = np.nan  # cycle NOx g/hp-hr
+        self.window_table = None  # windows from find_windows(), culled to the minimum duration
+        self.window_df = None  # windows with rates, sorted by NOx g/hp-hr
+        self.bin_window_df = None  # windows with rates excluding 'true idle' windows, if binned
+        self.true_idle_pts = []  # 'true idle' windows, if binned
+        self.bins = dict()  # bin window dataframes by bin name
+        self.true_idle_results = dict()
+        self.bin_results = dict()
+        self.cutpoint_sweep1_df = None
+        self.cutpoint_sweep2_df = None
+        self.summary_df = None  # single row results summary
+        self.adaptive_report = None  # adaptive window percentile estimates and error bounds, if adaptive
+        self.time_align_lags = None  # emissions channel: (lag secs, correlation), if time aligned
+        self.operating_modes = None  # sample operating modes from label_operating_modes(), if labeled
+
+
+def select_adaptive_windows(coarse_window_df, options, max_co2_rate_gphr):
+    """
+    Select coarse adaptive windows to refine around: in each bin, the windows at the target window NOx g/hp-hr
+    percentiles plus ``options.adaptive_margin`` windows either side in NOx g/hp-hr rank order
+
+    :param coarse_window_df: pandas dataframe of coarse windows from ``find_windows_adaptive()``
+    :param options: Data structure of command line / runtime options settings
+    :param max_co2_rate_gphr: maximum grams CO2/hour emissions rate, for normalized CO2 rate
+    :return: boolean numpy array of the coarse windows to refine around
+    """
+    window_df = calc_window_rates(coarse_window_df.loc[coarse_window_df['duration'] >= options.window_min_secs].copy(),
+                                  options, max_co2_rate_gphr)
+    bin_window_df, true_idle_pts, bins = bin_windows(window_df, options)
+
+    bin_list = list(bins.values())
+    if options.true_idle_bin:
+        bin_list.append(true_idle_pts)
+
+    selected = np.zeros(len(coarse_window_df), dtype=bool)
+    for bin_data in bin_list:
+        if len(bin_data) == 0:
+            continue
+        cumulative_weight = np.cumsum(bin_data['weight'].values)
+        for pctile in options.adaptive_pctiles:
+            rank = pctile / 100 * (cumulative_weight[-1] - 1)
+            low_row = np.searchsorted(cumulative_weight, np.floor(rank), side='right')
+            high_row = np.searchsorted(cumulative_weight, np.ceil(rank), side='right')
+            rows = np.arange(max(0, low_row - options.adaptive_margin),
+                             min(len(bin_data), high_row + options.adaptive_margin + 1))
+            selected[bin_data['window_num'].values[rows]] = True
+
+    return selected
+
+
+def adaptive_pctile_report(results, coarse_window_df, options, max_co2_rate_gphr, exhaustive_window_df=None):
+    """
+    Report adaptive window NOx g/hp-hr percentile estimates by bin, with an estimated error and, if all windows
+    were also calculated, the error against the exhaustive result.
+
+    The adaptive estimate is exact if no unrefined window block crosses the refined band around the percentile.  The
+    estimated error is a heuristic, not a bound: it is the largest change in the estimate for a rank shift of
+    ``options.adaptive_margin`` coarse windows.  Each unrefined coarse window's weight is counted whole in the coarse
+    window's bin, though the windows it stands for may fall in other bins, so bin window counts and sums are also
+    approximate.  Use ``options.adaptive_check`` to measure the actual error
+
+    :param results: ``TBWResults`` object with adaptive window bins
+    :param coarse_window_df: pandas dataframe of coarse windows from ``find_windows_adaptive()``
+    :param options: Data structure of command line / runtime options settings
+    :param max_co2_rate_gphr: maximum grams CO2/hour emissions rate, for normalized CO2 rate
+    :param exhaustive_window_df: optional pandas dataframe of all windows, culled to the minimum duration
+    :return: pandas dataframe, one row per bin and percentile
+    """
+    def named_bins(window_df):
+        # bin window dataframes by bin name, including 'true idle' if binned
+        bin_window_df, true_idle_pts, bins = bin_windows(calc_window_rates(window_df, options, max_co2_rate_gphr),
+                                                         options)
+        if options.true_idle_bin:
+            bins['True Idle'] = true_idle_pts
+        return bins
+
+    adaptive_bins = dict(results.bins)
+    if options.true_idle_bin:
+        adaptive_bins['True Idle'] = results.true_idle_pts
+    coarse_bins = named_bins(coarse_window_df.loc[coarse_window_df['duration'] >= options.window_min_secs].copy())
+    if exhaustive_window_df is not None:
+        exhaustive_bins = named_bins(exhaustive_window_df.copy())
+
+    rank_shift = options.adaptive_step_factor * options.adaptive_margin
+
+    report = []
+    for bin_name, bin_data in adaptive_bins.items():
+        for pctile in options.adaptive_pctiles:
+            row = {'bin': bin_name, 'pctile': pctile, 'window count': window_count(bin_data),
+                   'windows calculated': len(bin_data), 'adaptive NOX g/hp-hr': np.NaN, 'coarse NOX g/hp-hr': np.NaN,
+                   'est error': np.NaN}
+
+            if len(bin_data) > 0:
+                nox, weights = bin_data['NOX g/hp-hr'].values, bin_data['weight'].values
+                row['adaptive NOX g/hp-hr'] = weighted_pctile(nox, weights, pctile)
+                pctile_shift = rank_shift / max(1, weights.sum() - 1) * 100
+                row['est error'] = max(
+                    abs(weighted_pctile(nox, weights, min(100, pctile + pctile_shift)) - row['adaptive NOX g/hp-hr']),
+                    abs(row['adaptive NOX g/hp-hr'] - weighted_pctile(nox, weights, max(0, pctile - pctile_shift))))
+
+            coarse_data = coarse_bins[bin_name]
+            if len(coarse_data) > 0:
+                row['coarse NOX g/hp-hr'] = weighted_pctile(coarse_data['NOX g/hp-hr'].values,
+                                                            coarse_data['weight'].values, pctile)
+
+            if exhaustive_window_df is not None:
+                exhaustive_data = exhaustive_bins[bin_name]
+                if len(exhaustive_data) > 0:
+                    row['exhaustive NOX g/hp-hr'] = weighted_pctile(exhaustive_data['NOX g/hp-hr'].values,
+                                                                    np.ones(len(exhaustive_data)), pctile)
+                else:
+                    row['exhaustive NOX g/hp-hr'] = np.NaN
+                row['abs error'] = abs(row['adaptive NOX g/hp-hr'] - row['exhaustive NOX g/hp-hr'])
+
+            report.append(row)
+
+    return pd.DataFrame(report)
+
+
+# signals required by tbw_evaluate(), plus 'Tailpipe <species> g/s' for any other emissions species
+tbw_signals = ['Time secs', 'Power hp', 'Tailpipe NOX g/s', 'Tailpipe CO2 g/s', 'Vehicle Speed MPH',
+               'Aftertreatment Out Temp C']
+
+# other prepared signals kept for time series plots and operating modes, if available
+tbw_report_signals = ['Vehicle Speed', 'Exhaust Temp C', 'Engine RPM']
+
+
+def tbw_window_signals(signals, options):
+    """
+    Select the signals needed for time-based windows and add the 'unity' signal that makes the windows time-based
+
+    :param signals: prepared ``SignalTable``
+    :param options: ``TBWOptions`` or command line runtime options
+    :return: ``SignalTable`` that shares the caller's signal arrays, the caller's table is unchanged
+    """
+    integrate_chans = window_integrate_chans(options)
+    required_signals = tbw_signals + [c for c in integrate_chans + list(options.window_pctiles)
+                                      if c not in tbw_signals]
+    window_signals = signals.select(required_signals)
+    window_signals['unity'] = 1  # integral of 1*dt is time, trick to make work-based window code create time-based windows
+
+    return window_signals
+
+
+def find_tbw_windows(window_signals, options, max_dt):
     """
-    Process file for NOx emissions using time-based windows
+    Calculate all time-based windows, using the window search selected by the options.  The windows do not depend on
+    the search used
 
-    :param data_filename: Name of file to process
-    :param output_folder:  Name of output file folder
-    :param __options: Data structure of command line / runtime options settings
-    :return: Generates plots in ::output_folder
+    :param window_signals: ``SignalTable`` from ``tbw_window_signals()``
+    :param options: ``TBWOptions`` or command line runtime options
+    :param max_dt: maximum time step (seconds), longer time gaps are shortened to this
+    :return: pandas dataframe of windows
+    """
+    if options.indexed_windows:
+        # vectorized search over integer sample indices, for sub-second window steps and high-rate data
+        find_windows = wp.find_windows_indexed
+    elif options.window_workers > 1:
+        # window statistics of long recordings calculated by segment in a worker pool, identical results
+        find_windows = functools.partial(wp.find_windows_parallel, num_workers=options.window_workers,
+                                         use_processes=options.window_pool == 'process')
+    else:
+        find_windows = wp.find_windows
+
+    return find_windows(window_signals, 'Time secs', 'unity', options.window_length_secs,
+                        window_integrate_chans(options),
+                        data_chans=['Vehicle Speed MPH', 'Aftertreatment Out Temp C'],
+                        window_step=options.window_step_secs, max_dt=max_dt, pctile_chans=options.window_pctiles)
 
+
+def label_tbw_operating_modes(signals, wp_window_df, options, max_dt):
+    """
+    Label sample operating modes and add the window mode fraction columns
+
+    :param signals: prepared ``SignalTable``
+    :param wp_window_df: pandas dataframe of windows, mode fraction columns are added in place
+    :param options: ``TBWOptions`` or command line runtime options
+    :param max_dt: maximum time step (seconds), longer time gaps are shortened to this
+    :return: array of sample operating modes from ``operating_modes.label_operating_modes()``
+    """
+    time_secs = signals['Time secs']
+    sample_modes = operating_modes.label_operating_modes(
+        time_secs, signals['Vehicle Speed MPH'], signals['Engine RPM'] if 'Engine RPM' in signals else None,
+        options.idle_speed_mph, options.cruise_speed_mph, options.idle_rpm_threshold, options.mode_min_secs, max_dt)
+    mode_fractions = operating_modes.window_mode_fractions(time_secs, sample_modes,
+                                                           wp_window_df['start_time'].values,
+                                                           wp_window_df['end_time'].values, max_dt)
+    for mode_name, fractions in mode_fractions.items():
+        wp_window_df[mode_name + ' Fraction'] = fractions
+
+    return sample_modes
+
+
+def tbw_evaluate(signals, options, engine_power_rating_hp, data_rate_Hz=1, data_filename='', cycle_totals=None,
+                 time_align_lags=None):
+    """
+    Calculate time-based windows, bins and bin results in memory, no files are read or written
+
+    :param signals: prepared ``SignalTable``, pandas dataframe or dict of arrays with the ``tbw_signals`` columns and
+        a 'Tailpipe <species> g/s' column for each of ``options.species``, or an iterable of prepared signal table
+        blocks from ``iter_tbw_chunks()``
+    :param options: ``TBWOptions`` or command line runtime options
+    :param engine_power_rating_hp: engine power rating (hp), for the maximum CO2 rate
+    :param data_rate_Hz: data rate (Hz), time gaps are clipped to 1 / data_rate_Hz unless ``options.max_dt`` is set
+    :param data_filename: name of the data file, for the results summary
+    :param cycle_totals: dict of cycle totals filled in by ``iter_tbw_chunks()``, required for dataframe blocks
+    :param time_align_lags: optional dict of emissions channel: (lag secs, correlation) from ``load_tbw_signals()``,
+        for the results summary
+    :return: ``TBWResults`` object or ``None`` if cycle work is NaN or negative
     """
+    verbose = options.verbose
+    results = TBWResults()
+    results.time_align_lags = time_align_lags
+
+    if isinstance(signals, pd.DataFrame):
+        signals = signal_table.SignalTable.from_dataframe(signals)
+    elif isinstance(signals, dict):
+        signals = signal_table.SignalTable(signals)
+
+    if isinstance(signals, signal_table.SignalTable):
+        # calculate cycle engine work hp-hr and integrate NOx emissions for the cycle
+        results.work_hphr = trapz(np.maximum(0, signals['Power hp']), signals['Time secs']) / 3600
+        results.nox_g = trapz(signals['Tailpipe NOX g/s'], signals['Time secs'])
+
+        results.nox_gphphr = check_cycle_work(results.work_hphr, results.nox_g)
+        if results.nox_gphphr is None:
+            return None
+
+    # calculate time-based window data
+    if verbose:
+        print('Getting Windows...')
+    import time
+    start = time.time()
+    max_dt = options.max_dt or 1 / data_rate_Hz
+    max_co2_rate_gphr = options.ftp_co2_gphphr * engine_power_rating_hp
+    integrate_chans = window_integrate_chans(options)
+    if isinstance(signals, signal_table.SignalTable):
+        window_signals = tbw_window_signals(signals, options)
+        if options.adaptive_step_factor:
+            # coarse windows first, then all windows only around the target percentiles of each bin
+            if options.cutpoint_sweep_pct or options.bootstrap_samples:
+                raise Exception('adaptive windows are not available with cutpoint sweeps or bootstrap confidence '
+                                'intervals')
+            wp_window_df, coarse_window_df = wp.find_windows_adaptive(
+                window_signals, 'Time secs', 'unity', options.window_length_secs, integrate_chans,
+                data_chans=['Vehicle Speed MPH', 'Aftertreatment Out Temp C'], window_step=options.window_step_secs,
+                max_dt=max_dt, step_factor=options.adaptive_step_factor,
+                select_windows=lambda coarse_df: select_adaptive_windows(coarse_df, options, max_co2_rate_gphr),
+                verbose=verbose, pctile_chans=options.window_pctiles)
+        else:
+            wp_window_df = find_tbw_windows(window_signals, options, max_dt)
+    else:
+        wp_window_df = wp.find_windows_chunked(signals, 'Time secs', 'unity', options.window_length_secs,
+                                               integrate_chans,
+                                               data_chans=['Vehicle Speed MPH', 'Aftertreatment Out Temp C'],
+                                               window_step=options.window_step_secs, max_dt=max_dt,
+                                               verbose=verbose, pctile_chans=options.window_pctiles)
+
+        # cycle totals are complete once all blocks have been read
+        results.work_hphr = cycle_totals['work_hps'] / 3600
+        results.nox_g = cycle_totals['nox_g']
+
+        results.nox_gphphr = check_cycle_work(results.work_hphr, results.nox_g)
+        if results.nox_gphphr is None:
+            return None
+
+    # label sample operating modes and add window mode fractions
+    if options.operating_modes:
+        if not isinstance(signals, signal_table.SignalTable):
+            raise Exception('operating modes are not available for dataframe blocks')
+        results.operating_modes = label_tbw_operating_modes(signals, wp_window_df, options, max_dt)
+
+    # cull windows below minimum duration, if any:
+    results.window_table = wp_window_df.loc[wp_window_df['duration'] >= options.window_min_secs]
+
+    end = time.time()
+    if verbose:
+        print(end - start)
+        print('done')
 
-    verbose = __options.verbose
+    # calculate window work, NOx g/hp-hr and CO2 rates, sort by NOx g/hp-hr
+    results.window_df = calc_window_rates(results.window_table.copy(), options, max_co2_rate_gphr)
+
+    # bin windows and calculate bin results
+    results.bin_window_df, results.true_idle_pts, results.bins = bin_windows(results.window_df, options)
+    results.true_idle_results, results.bin_results = calc_bin_results(results.true_idle_pts, results.bins, options)
+
+    # sweep one and two cutpoint candidates using prefix sums over windows sorted by normalized CO2 rate
+    if options.cutpoint_sweep_pct:
+        analyzer = cutpoints.CutpointAnalyzer(results.bin_window_df, options.co2_normalization,
+                                              options.ftp_co2_gphphr)
+        results.cutpoint_sweep1_df = analyzer.sweep1(options.cutpoint_sweep_frac)
+        results.cutpoint_sweep2_df = analyzer.sweep2(options.cutpoint_sweep_frac)
+
+    # calculate bootstrap confidence intervals for bin NOx and window NOx percentiles
+    if options.bootstrap_samples:
+        results.bin_results.update(calc_bin_ci(results.true_idle_pts, results.bins, options))
+
+    results.summary_df = tbw_summary(data_filename, results.true_idle_results, results.bin_results, time_align_lags)
+
+    # report adaptive percentile estimates and error bounds, against all windows if checking
+    if options.adaptive_step_factor:
+        exhaustive_window_df = None
+        if options.adaptive_check:
+            exhaustive_window_df = wp.find_windows_indexed(window_signals, 'Time secs', 'unity',
+                                                           options.window_length_secs, integrate_chans,
+                                                           data_chans=['Vehicle Speed MPH',
+                                                                       'Aftertreatment Out Temp C'],
+                                                           window_step=options.window_step_secs, max_dt=max_dt,
+                                                           pctile_chans=options.window_pctiles)
+            exhaustive_window_df = \
+                exhaustive_window_df.loc[exhaustive_window_df['duration'] >= options.window_min_secs]
+        results.adaptive_report = adaptive_pctile_report(results, coarse_window_df, options, max_co2_rate_gphr,
+                                                         exhaustive_window_df)
+
+        if verbose:
+            print('adaptive windows: %d of %d windows calculated, max est error %g NOX g/hp-hr' %
+                  (len(results.window_table), window_count(results.window_table),
+                   results.adaptive_report['est error'].max()))
+            if options.adaptive_check:
+                print('adaptive windows: max abs error %g NOX g/hp-hr' % results.adaptive_report['abs error'].max())
+
+    return results
+
+
+def get_file_options(data_filename, __options):
+    """
+    Get per-file options and data profile, the engine power rating and FTP CO2 g/hp-hr may depend on the filename
 
+    :param data_filename: Name of file to process
+    :param __options: Data structure of command line / runtime options settings
+    :return: (options, data_profile) tuple
+    """
     # load data profile and set FTP grams CO2/hp-hr scale factor
     if __options.data_profile.engine_power_rating_hp == 'filename_7_3':
         options = copy.deepcopy(
@@ -68,170 +1330,230 @@ def tbw_processor(data_filename, output_folder, __options):
                 options.ftp_co2_gphphr = 555
             else:
                 options.ftp_co2_gphphr = 576
-        else:
-            options.ftp_co2_gphphr = eval(options.ftp_co2_gphphr)
+        elif isinstance(options.ftp_co2_gphphr, str):
+            try:
+                options.ftp_co2_gphphr = float(options.ftp_co2_gphphr)
+            except ValueError:
+                raise Exception('FTP CO2 g/hp-hr "%s" must be a number' % options.ftp_co2_gphphr)
     else:  # engine dyno test data...
         options = __options
         data_profile = options.data_profile
         options.ftp_co2_gphphr = 555
 
-    # set engine power rating
-    engine_power_rating_hp = data_profile.engine_power_rating_hp
+    return options, data_profile
 
-    # load emissions data into dataframe
-    if options.hdiut:
-        # process time vector, create engine speed, torque and power in calcs_dataframe
-        df, calcs_dataframe = cti.prep_calcs_dataframe(data_filename, data_profile, verbose)
 
-        # calculate vehicle speed (mph and m/s)
-        df, calcs_dataframe = cti.prep_vehicle_speed(df, calcs_dataframe, data_profile)
+def align_tbw_signals(signals, data_filename, options):
+    """
+    Time align the emissions species and CO2 signals to engine power, or the emissions species to CO2, using cached lag
+    estimates for the file if available
+
+    :param signals: ``SignalTable`` of prepared signals from ``prep_tbw_signals()``
+    :param data_filename: Name of the source data file
+    :param options: Data structure of command line / runtime options settings
+    :return: (signals, time_align_lags) tuple, aligned signals and dict of channel: (lag secs, correlation)
+    """
+    if options.time_align_reference == 'co2':
+        reference_chan = 'Tailpipe CO2 g/s'
     else:
-        df = pd.read_csv(data_filename, header=0, dtype=object)
+        reference_chan = 'Power hp'
+    channels = [c for c in species_signals(options.species) + ['Tailpipe CO2 g/s'] if c != reference_chan]
 
-    # make sure dataframe contains numeric data where possible
-    df = cti.dataframe_to_numeric(df)
+    settings = {'reference': reference_chan, 'channels': channels, 'max_lag_secs': options.time_align_max_lag_secs,
+                'hdiut': options.hdiut}
+    if getattr(options, 'output_path', ''):
+        cache_folder = options.output_path + os.sep + 'time_align_lags'
+    else:
+        cache_folder = ''
 
-    # fix possible data source inconsistency
-    if ('NOX_Mass_Sec' in df.columns) and ('NOX_Mass_Sec_Final' not in df.columns):
-        print('\n%%%% FIXING NOX_Mass_Sec_Final %%%%')
-        df['NOX_Mass_Sec_Final'] = df['NOX_Mass_Sec']
+    lags = time_align.get_cached_lags(data_filename, settings, cache_folder)
+    if lags is None:
+        signals, lags = time_align.align_emissions(signals, 'Time secs', reference_chan, channels,
+                                                   options.time_align_max_lag_secs)
+        time_align.cache_lags(data_filename, settings, lags, cache_folder)
+    else:
+        signals, lags = time_align.align_emissions(signals, 'Time secs', reference_chan, channels,
+                                                   options.time_align_max_lag_secs, lags)
 
-    # set maximum grams CO2/hour emissions rate scale factor
-    max_co2_rate_gphr = options.ftp_co2_gphphr * engine_power_rating_hp
+    for channel, (lag_secs, correlation) in lags.items():
+        print('%s lag %.2f secs, correlation %.3f' % (channel, lag_secs, correlation))
 
-    print('\nprocessing %s %d HP' % (data_filename, engine_power_rating_hp))
+    return signals, lags
 
-    # perform signal scaling as defined in data source profile and ensure required data columns
-    if data_filename.__contains__('vehMPH') or options.hdiut:
-        # create scaled, common-name destination signals from source signals
-        for destination_signal, source_signal, source_signal_scale in zip(data_profile.destination_signal_list,
-                                                                          data_profile.source_signal_list,
-                                                                          data_profile.source_signal_scale):
-            if destination_signal is not '' and source_signal is not '':
-                df[destination_signal] = cti.scale_signal(df, source_signal, source_signal_scale)
 
-        if options.hdiut:
-            df['Power hp'] = calcs_dataframe['engine_power_hp']
-            df['Time secs'] = calcs_dataframe['time_secs']
-            df['Vehicle Speed'] = calcs_dataframe['vehicle_speed_mph']
-        else:
-            df.rename(index=str, columns={'Power': 'Power kW', data_profile.time_signal: 'Time secs'}, inplace=True)
-            df['Power hp'] = df['Power kW'] * convert.kW2hp
+def load_tbw_signals(data_filename, options, data_profile):
+    """
+    Load and prepare time-based window signals from a data file
 
-    else:  # using concatenated_cycles dataframe...
-        # signals are already scaled, just rename a couple that we need:
-        df.rename(index=str, columns={'engine_power_hp': 'Power hp', 'time_secs': 'Time secs',
-                                      'Vehicle Speed MPH': 'Vehicle Speed'}, inplace=True)
+    :param data_filename: Name of file to process
+    :param options: Data structure of command line / runtime options settings
+    :param data_profile: ``DataSourceProfile`` object
+    :return: (signals, data_rate_Hz, cycle_totals, time_align_lags) tuple, signals is a ``SignalTable``, or a
+        generator of ``SignalTable`` blocks if ``options.chunk_rows`` is set in which case cycle totals are filled in
+        as blocks are generated.  time_align_lags is a dict of emissions channel: (lag secs, correlation) if time aligned
+    """
+    cycle_totals = None
+    time_align_lags = None
+
+    if options.chunk_rows:
+        # read and prepare data in blocks of rows as windows are calculated, full data is never loaded
+        if options.resample_Hz:
+            raise Exception('resampling is not available with --chunk_rows')
+        if options.indexed_windows or options.adaptive_step_factor:
+            raise Exception('indexed and adaptive windows are not available with --chunk_rows')
+        if options.time_align_emissions or options.operating_modes:
+            raise Exception('time alignment and operating modes are not available with --chunk_rows')
+        data_rate_Hz = data_profile.data_rate_Hz
+        cycle_totals = dict()
+        signals = iter_tbw_chunks(data_filename, data_profile, options, cycle_totals)
+    else:
+        df, calcs_dataframe = read_tbw_source(data_filename, options, data_profile)
+        signals, data_rate_Hz, time_align_lags = scale_tbw_signals(df, calcs_dataframe, data_filename, options,
+                                                                   data_profile)
 
-    # ensure desired column exists
-    if not 'Aftertreatment Out Temp C' in df.columns:
-        df['Aftertreatment Out Temp C'] = 0
+    return signals, data_rate_Hz, cycle_totals, time_align_lags
 
-    # calculate cycle engine work hp-hr
-    work_hps = trapz(np.maximum(0, df['Power hp']), df['Time secs'])
-    work_hphr = work_hps / 3600
 
-    # load idle speed cutoff MPH
-    idle_cutoff_mph = float(options.idle_speed_thresh_mph)
+def read_tbw_source(data_filename, options, data_profile):
+    """
+    Read a whole source data file
 
-    # integrate NOx emissions and calculate total NOx g/hp-hr for the cycle
-    nox_g = trapz(df['Tailpipe NOX g/s'], df['Time secs'])
-    nox_gphpr = nox_g / work_hphr
+    :param data_filename: Name of file to process
+    :param options: Data structure of command line / runtime options settings
+    :param data_profile: ``DataSourceProfile`` object
+    :return: (df, calcs_dataframe) tuple, source dataframe and dataframe of calculated signals for HDIUT data, else
+        ``None``
+    """
+    # load emissions data into dataframe
+    if options.hdiut:
+        # process time vector, create engine speed, torque and power in calcs_dataframe
+        df, calcs_dataframe = cti.prep_calcs_dataframe(data_filename, data_profile, options.verbose)
 
-    print('\nWork hp-hr = %f' % work_hphr)
-    print('NOx grams = %f' % nox_g)
-    print('NOx grams/hp-hr = %f\n' % nox_gphpr)
+        # calculate vehicle speed (mph and m/s)
+        df, calcs_dataframe = cti.prep_vehicle_speed(df, calcs_dataframe, data_profile)
+    else:
+        df = pd.read_csv(data_filename, header=0, dtype=object)
+        calcs_dataframe = None
 
-    # error checking on cycle work
-    if np.isnan(work_hphr):
-        print("\n*** WORK IS NAN, EXITING ***\n")
-        return
+    return df, calcs_dataframe
 
-    if work_hphr < 0:
-        print("\n*** WORK IS NEGATIVE, EXITING ***\n")
-        return
 
-    # time-based window size is length in seconds
+def scale_tbw_signals(df, calcs_dataframe, data_filename, options, data_profile):
+    """
+    Prepare time-based window signals from source data, then time align and resample them if requested
+
+    :param df: source dataframe from ``read_tbw_source()``
+    :param calcs_dataframe: dataframe of calculated signals for HDIUT data, else ``None``
+    :param data_filename: Name of the source data file
+    :param options: Data structure of command line / runtime options settings
+    :param data_profile: ``DataSourceProfile`` object
+    :return: (signals, data_rate_Hz, time_align_lags) tuple, signals is a ``SignalTable``, time_align_lags is a dict of
+        emissions channel: (lag secs, correlation) if time aligned
+    """
+    time_align_lags = None
+
+    signals = prep_tbw_signals(df, calcs_dataframe, data_filename, data_profile, options)
+
+    # remove emissions measurement delays, lag estimates are cached per file
+    if options.time_align_emissions:
+        signals, time_align_lags = align_tbw_signals(signals, data_filename, options)
+
+    # resample to a uniform time grid if requested.  Time gaps longer than max_dt, or 1.5 source sample periods if not
+    # set, aren't interpolated across and are clipped like any other gap by the window search
+    if options.resample_Hz:
+        signals = signal_table.SignalTable.from_dataframe(
+            cti.resample_dataframe(signals.to_dataframe(), 'Time secs', options.resample_Hz,
+                                   options.resample_method, options.verbose,
+                                   max_gap=options.max_dt or 1.5 / data_profile.data_rate_Hz))
+        data_rate_Hz = options.resample_Hz
+    else:
+        data_rate_Hz = data_profile.data_rate_Hz
+
+    return signals, data_rate_Hz, time_align_lags
+
+
+def write_tbw_outputs(results, df, data_filename, output_folder, options, data_profile):
+    """
+    File output sink for ``tbw_evaluate()`` results: window table, cutpoint sweep tables and plots
+
+    :param results: ``TBWResults`` object from ``tbw_evaluate()``
+    :param df: ``SignalTable`` of prepared signals for time series plots, or ``None`` to skip them
+    :param data_filename: Name of processed file
+    :param output_folder: Name of output file folder, a figure folder is created for the file
+    :param options: Data structure of command line / runtime options settings
+    :param data_profile: ``DataSourceProfile`` object
+    """
+    engine_power_rating_hp = data_profile.engine_power_rating_hp
     window_size = options.window_length_secs
+    wp_window_df = results.window_df
+    true_idle_pts = results.true_idle_pts
+    bins = results.bins
+    true_idle_results = results.true_idle_results
+    bin_results = results.bin_results
+    work_hphr = results.work_hphr
+    nox_gphpr = results.nox_gphphr
 
     # create detailed output folder name and create folder if necessary
-    foldername = file_io.get_filename(data_filename.replace('QAdone', 'QA')) + '_%d_%d%s' % \
-                 (options.window_length_secs, options.window_step_secs, descriptor_str)
+    foldername = file_io.get_filename(data_filename.replace('QAdone', 'QA')) + '_%g_%g%s' % \
+                 (options.window_length_secs, options.window_step_secs, get_descriptor_str(options))
     figure_path = output_folder + os.sep + foldername + os.sep
     file_io.validate_folder(figure_path)
 
     if cti_verbose:
         print('figure_path = ' + figure_path)
 
-    # calculate time-based window data
-    df['unity'] = 1  # integral of 1*dt is time, trick to make work-based window code create time-based windows
-    if verbose:
-        print('Getting Windows...')
-    import time
-    start = time.time()
-    wp_window_df = wp.find_windows(df, 'Time secs', 'unity', window_size,
-                                   ['Power hp', 'Tailpipe NOX g/s', 'Tailpipe CO2 g/s'],
-                                   data_chans=['Vehicle Speed MPH', 'Aftertreatment Out Temp C'],
-                                   window_step=options.window_step_secs)
-
-    # cull windows below minimum duration, if any:
-    wp_window_df = wp_window_df.loc[wp_window_df['duration'] >= options.window_min_secs]
-
-    end = time.time()
-    if verbose:
-        print(end - start)
-        print('done')
-
-    # calculate window work hp-hr and average power
-    wp_window_df['Power hp-hr'] = wp_window_df['Power hp-sec'] / 3600
-    wp_window_df['Avg Power hp'] = wp_window_df['Power hp-sec'] / wp_window_df['duration']
-
-    # calculate window NOx g/hp-hr
-    if options.co2_normalization:
-        wp_window_df['NOX g/hp-hr'] = wp_window_df['Tailpipe NOX g'] / wp_window_df[
-            'Tailpipe CO2 g'] * options.ftp_co2_gphphr
-    else:
-        wp_window_df['NOX g/hp-hr'] = wp_window_df['Tailpipe NOX g'] / wp_window_df['Power hp-hr']
-
-    # calculate CO2 emissions rates
-    wp_window_df['Tailpipe CO2 g/hr'] = wp_window_df['Tailpipe CO2 g'] / wp_window_df['duration'] * 3600
-    wp_window_df['Tailpipe CO2 g/hp-hr'] = wp_window_df['Tailpipe CO2 g/hr'] / wp_window_df['Avg Power hp']
-    wp_window_df['Tailpipe CO2 rate norm'] = wp_window_df['Tailpipe CO2 g/hr'] / max_co2_rate_gphr
-
-    # sort windows by NOx g/hp-hr
-    wp_window_df.sort_values('NOX g/hp-hr', inplace=True)
-    wp_window_df.reset_index(drop=False, inplace=True)
-    wp_window_df.rename(columns={'index': 'window_num'}, inplace=True)
+    # save window table for later rebinning, tagged with the settings that produced the windows
+    if options.save_windows:
+        window_table_filename = options.output_path + os.sep + 'window_tables' + os.sep + \
+            window_store.get_window_table_filename(data_filename, options.window_length_secs,
+                                                   options.window_step_secs, options.window_min_secs,
+                                                   window_table_tag_str(options))
+        window_store.save_window_table(window_table_filename, results.window_table,
+                                       {'file': file_io.get_filename(data_filename),
+                                        'window_length_secs': options.window_length_secs,
+                                        'window_step_secs': options.window_step_secs,
+                                        'window_min_secs': options.window_min_secs,
+                                        'resample_Hz': options.resample_Hz,
+                                        'resample_method': options.resample_method,
+                                        'max_dt': options.max_dt,
+                                        'time_align_emissions': options.time_align_emissions,
+                                        'time_align_reference': options.time_align_reference,
+                                        'regulatory_class': data_profile.regulatory_class,
+                                        'engine_power_rating_hp': float(engine_power_rating_hp),
+                                        'ftp_co2_gphphr': float(options.ftp_co2_gphphr),
+                                        'created': datetime.now().isoformat()})
 
     # get base file name without for plot titles
     plot_data_filename = file_io.get_filename(data_filename)
 
-    # plot Vehicle Speed and NOx rate versus time
-    fig, ax1, ax2 = fplotyyhg(df['Time secs'], df['Vehicle Speed'], '', df['Tailpipe NOX g/s'], 'r-')
-    label_xyt(ax1, 'Time (secs)', 'Vehicle Speed (mph)',
-              '%s\nVehicle Speed and NOX g/s v Time %.1f hp-hr total work' % (plot_data_filename, work_hphr))
-    ax2.tick_params(axis='y', colors='red')
-    ax2.set_ylabel('Tailpipe NOx g/s', color='red')
-    fig.subplots_adjust(right=0.85)
-    plt.savefig(figure_path + '1_NOX_gps_n_vspeed_v_t', orientation='landscape')
-
-    # plot HP and NOx rate versus time
-    fig, ax1, ax2 = fplotyyhg(df['Time secs'], df['Power hp'], '', df['Tailpipe NOX g/s'], 'r-')
-    label_xyt(ax1, 'Time (secs)', 'Power (hp)',
-              '%s\nPower and NOX g/s v Time %.1f hp-hr total work' % (plot_data_filename, work_hphr))
-    ax2.tick_params(axis='y', colors='red')
-    ax2.set_ylabel('Tailpipe NOx g/s', color='red')
-    fig.subplots_adjust(right=0.85)
-    plt.savefig(figure_path + '2_NOX_gps_n_HP_v_t', orientation='landscape')
-
-    # plot HP and Exhaust temp versus time
-    fig, ax1, ax2 = fplotyyhg(df['Time secs'], df['Power hp'], '', df['Exhaust Temp C'], 'r-')
-    label_xyt(ax1, 'Time (secs)', 'Power (hp)',
-              '%s\nPower and Exhaust Temp v Time %.1f hp-hr total work' % (plot_data_filename, work_hphr))
-    ax2.tick_params(axis='y', colors='red')
-    ax2.set_ylabel('Exhaust Temp (C)', color='red')
-    fig.subplots_adjust(right=0.85)
-    plt.savefig(figure_path + '3_Exh_tmp_n_HP_v_t', orientation='landscape')
+    # time series plots need the full data, not available for block-wise processing
+    if df is not None:
+        # plot Vehicle Speed and NOx rate versus time
+        fig, ax1, ax2 = fplotyyhg(df['Time secs'], df['Vehicle Speed'], '', df['Tailpipe NOX g/s'], 'r-')
+        label_xyt(ax1, 'Time (secs)', 'Vehicle Speed (mph)',
+                  '%s\nVehicle Speed and NOX g/s v Time %.1f hp-hr total work' % (plot_data_filename, work_hphr))
+        ax2.tick_params(axis='y', colors='red')
+        ax2.set_ylabel('Tailpipe NOx g/s', color='red')
+        fig.subplots_adjust(right=0.85)
+        plt.savefig(figure_path + '1_NOX_gps_n_vspeed_v_t', orientation='landscape')
+
+        # plot HP and NOx rate versus time
+        fig, ax1, ax2 = fplotyyhg(df['Time secs'], df['Power hp'], '', df['Tailpipe NOX g/s'], 'r-')
+        label_xyt(ax1, 'Time (secs)', 'Power (hp)',
+                  '%s\nPower and NOX g/s v Time %.1f hp-hr total work' % (plot_data_filename, work_hphr))
+        ax2.tick_params(axis='y', colors='red')
+        ax2.set_ylabel('Tailpipe NOx g/s', color='red')
+        fig.subplots_adjust(right=0.85)
+        plt.savefig(figure_path + '2_NOX_gps_n_HP_v_t', orientation='landscape')
+
+        # plot HP and Exhaust temp versus time
+        fig, ax1, ax2 = fplotyyhg(df['Time secs'], df['Power hp'], '', df['Exhaust Temp C'], 'r-')
+        label_xyt(ax1, 'Time (secs)', 'Power (hp)',
+                  '%s\nPower and Exhaust Temp v Time %.1f hp-hr total work' % (plot_data_filename, work_hphr))
+        ax2.tick_params(axis='y', colors='red')
+        ax2.set_ylabel('Exhaust Temp (C)', color='red')
+        fig.subplots_adjust(right=0.85)
+        plt.savefig(figure_path + '3_Exh_tmp_n_HP_v_t', orientation='landscape')
 
     # plot window number and percentile versus NOx g/hp-hr for each window
     nox = wp_window_df['NOX g/hp-hr']
@@ -280,15 +1602,8 @@ def tbw_processor(data_filename, output_folder, __options):
     ax1.set_xlim([0, 100])
     plt.savefig(figure_path + '8_nox_v_wdw_avg_pct_pwr', orientation='landscape')
 
-    # calculate 'true idle' bin (window average vehicle speed below idle cutoff mph)
     if options.true_idle_bin:
-        true_idle_pts = wp_window_df.loc[wp_window_df['Vehicle Speed MPH AVG'] < idle_cutoff_mph]
-        true_idle_pts.reset_index(drop=True, inplace=True)
-        # cull true idle points to process the rest as normal down below
-        wp_window_df = wp_window_df.loc[wp_window_df['Vehicle Speed MPH AVG'] >= idle_cutoff_mph]
-        true_idle_nox_gphr = true_idle_pts['Tailpipe NOX g'].sum() / true_idle_pts['duration'].sum() * 3600
-        true_idle_aftertreatment_mean_tempC = true_idle_pts['Aftertreatment Out Temp C AVG'].mean()
-        true_idle_aftertreatment_SD_tempC = true_idle_pts['Aftertreatment Out Temp C AVG'].std()
+        true_idle_nox_gphr = true_idle_results['True Idle NOX Rate g/hr']
         fig = plt.figure()
         ax1 = plt.gca()
         ax1.plot('true idle\n%.3f' % true_idle_nox_gphr, true_idle_nox_gphr, '.')
@@ -296,59 +1611,36 @@ def tbw_processor(data_filename, output_folder, __options):
         ax1.set_title('%s\nBin True Idle NOx Rate Plot\n%s' % (plot_data_filename, foldername), fontsize=9)
         plt.grid()
         plt.savefig(figure_path + '12_NOxTruIdl_binplot', orientation='landscape')
-    else:
-        true_idle_nox_gphr = np.NaN
-        true_idle_nox_gphphr = np.NaN
-        true_idle_pts = []
-        true_idle_aftertreatment_mean_tempC = np.NaN
-        true_idle_aftertreatment_SD_tempC = np.NaN
-
-    # bin windows based on user supplied normalized CO2 rate cutpoints
-    bins = {}
-    previous_bin_frac = 0
-    for cutpoint_frac in options.hp_cutpoints_frac:
-        bin_name = ('%.1f->%.1f' % (previous_bin_frac * 100, cutpoint_frac * 100))
-        bins[bin_name] = wp_window_df.loc[(wp_window_df['Tailpipe CO2 rate norm'] > previous_bin_frac) & (
-                    wp_window_df['Tailpipe CO2 rate norm'] <= cutpoint_frac)]
-        bins[bin_name].reset_index(drop=True, inplace=True)
-        previous_bin_frac = cutpoint_frac
-
-    bin_name = ('>%.1f' % (previous_bin_frac * 100))
-    bins[bin_name] = (wp_window_df.loc[(wp_window_df['Tailpipe CO2 rate norm'] > previous_bin_frac)])
-    bins[bin_name].reset_index(drop=True, inplace=True)
-
-    # calculate results for emissions bins
-    bin_results = {}
-
-    if options.co2_normalization:
-        if options.true_idle_bin:
-            true_idle_nox_gphphr = true_idle_pts['Tailpipe NOX g'].sum() / true_idle_pts[
-                'Tailpipe CO2 g'].sum() * options.ftp_co2_gphphr
-        for bin_name, bin_data in bins.items():
-            bin_results[bin_name + ' NOX g/hp-hr'] = bin_data['Tailpipe NOX g'].sum() / bin_data[
-                'Tailpipe CO2 g'].sum() * options.ftp_co2_gphphr
-    else:
-        if options.true_idle_bin:
-            true_idle_nox_gphphr = true_idle_pts['Tailpipe NOX g'].sum() / true_idle_pts['Power hp-hr'].sum()
-        for bin_name, bin_data in bins.items():
-            bin_results[bin_name + ' NOX g/hp-hr'] = bin_data['Tailpipe NOX g'].sum() / bin_data['Power hp-hr'].sum()
 
-    for bin_name, bin_data in bins.items():
-        bin_results[bin_name + ' Aftertreatment Out Temp C AVG'] = bin_data['Aftertreatment Out Temp C AVG'].mean()
-        bin_results[bin_name + ' Aftertreatment Out Temp C SD'] = bin_data['Aftertreatment Out Temp C AVG'].std()
-        bin_results[bin_name + ' Window Count'] = len(bin_data)
+    # write adaptive window percentile report
+    if results.adaptive_report is not None:
+        results.adaptive_report.to_csv(figure_path + foldername + '_adaptive_pctiles.csv', index=False)
+
+    # write cutpoint sweep tables and plots
+    if options.cutpoint_sweep_pct:
+        results.cutpoint_sweep1_df.to_csv(figure_path + foldername + '_cutpoint_sweep1.csv', index=False)
+        sweep2_df = results.cutpoint_sweep2_df
+        sweep2_df.to_csv(figure_path + foldername + '_cutpoint_sweep2.csv', index=False)
+        if len(sweep2_df) > 0:
+            cutpoints.plot_sweep2_heatmap(sweep2_df, 'mid bin NOX g/hp-hr',
+                                          '%s\nMid Bin NOx (g/hp-hr) Cutpoint Sweep' % plot_data_filename)
+            plt.savefig(figure_path + '9_cutpoint_sweep_mid_nox', orientation='landscape')
+            cutpoints.plot_sweep2_heatmap(sweep2_df, 'mid bin Window Count',
+                                          '%s\nMid Bin Window Count Cutpoint Sweep' % plot_data_filename)
+            plt.savefig(figure_path + '10_cutpoint_sweep_mid_count', orientation='landscape')
 
     # plot NOx g/hp-hr by bin
     fig = plt.figure()
     ax1 = plt.gca()
     plotted = False
     if options.true_idle_bin:
+        true_idle_nox_gphphr = true_idle_results['True Idle NOX g/hp-hr']
         ax1.plot('True Idle\n%.3f' % true_idle_nox_gphphr, true_idle_nox_gphphr, '.')
         plotted = True
-    for bin_name, bin_result in bin_results.items():
-        if 'NOX g/hp-hr' in bin_name:
-            ax1.plot('%s\n%.3f' % (bin_name, bin_result), bin_result, '.')
-            plotted = True
+    for bin_name in bins.keys():
+        bin_result = bin_results[bin_name + ' NOX g/hp-hr']
+        ax1.plot('%s\n%.3f' % (bin_name, bin_result), bin_result, '.')
+        plotted = True
     ax1.set_ylabel('Bin NOx (g/hp-hr)')
     ax1.set_title('%s\nBin Brake Specific NOx Plot\n%s' % (plot_data_filename, foldername), fontsize=9)
     plt.grid()
@@ -370,7 +1662,7 @@ def tbw_processor(data_filename, output_folder, __options):
     # plot window window average percent power histogram
     fig = plt.figure()
     ax1 = plt.gca()
-    plt.hist(wp_window_df['Avg Power hp'] / engine_power_rating_hp * 100, 100)
+    plt.hist(results.bin_window_df['Avg Power hp'] / engine_power_rating_hp * 100, 100)
     ax1.set_ylabel('Window Count')
     ax1.set_xlabel('Window Avg Pct Power')
     ax1.set_title('%s\nWindow Avg Pct Power Histogram' % plot_data_filename, fontsize=9)
@@ -380,109 +1672,215 @@ def tbw_processor(data_filename, output_folder, __options):
     plt.savefig(figure_path + '15_wdw_pwr_hist', orientation='landscape')
 
     # plot 'true idle' ranked window percentile chart
-    if options.true_idle_bin:
-        nox = true_idle_pts['NOX g/hp-hr']
-        if len(nox) > 0:
-            bin_name = 'True Idle'
-            nox_pctile = nox.index / nox.index.max() * 100
-            fig, ax1, ax2 = fplotyyhg(nox.values, nox_pctile, '', nox.index, '')
-            label_xyt(ax1, '%s Window NOx (g/hp-hr)' % bin_name, 'Percentile',
-                      '%s\nNOx (g/hp-hr) per Window' % plot_data_filename)
-            label_xy(ax2, '%s Window NOx (g/hp-hr)' % bin_name, 'Ranked Window Number')
-            lineat(ax1, 95, 'b-')
-            lineat(ax1, 70, 'c-')
-            nox_gphphr_95 = np.interp(95, nox_pctile, nox.values)
-            nox_gphphr_70 = np.interp(70, nox_pctile, nox.values)
-            vlineat(ax1, nox_gphphr_95, 'b--')
-            vlineat(ax1, nox_gphphr_70, 'c--')
-            fig.subplots_adjust(right=0.875)
-            ax1.legend(['Percentile/Ranked Window Number', '95th pctile', '70th pctile',
-                        '95th pctile NOx %.3f' % nox_gphphr_95,
-                        '70th pctile NOx %.3f' % nox_gphphr_70], fontsize=9)
-            for pctile in pctile_range:
-                bin_results[bin_name + ' %dth pctile NOX g/hp-hr' % pctile] = np.interp(pctile, nox_pctile, nox.values)
-            plt.savefig(figure_path + '16_Idle_NOX_gphphr_p_ranked_bin_wdw', orientation='landscape')
-        else:
-            bin_results[bin_name + ' 70th pctile NOX g/hp-hr'] = np.NaN
-            bin_results[bin_name + ' 95th pctile NOX g/hp-hr'] = np.NaN
+    if options.true_idle_bin and len(true_idle_pts) > 0:
+        plot_ranked_bin_windows(true_idle_pts['NOX g/hp-hr'], 'True Idle', plot_data_filename,
+                                figure_path + '16_Idle_NOX_gphphr_p_ranked_bin_wdw')
 
     # plot ranked window percentile chart for non-'true idle' bins
     fig_num = 17
     for bin_name, bin_data in bins.items():
-        nox = bins[bin_name]['NOX g/hp-hr']
-        if len(nox) > 0:
-            nox_pctile = nox.index / nox.index.max() * 100
-            fig, ax1, ax2 = fplotyyhg(nox.values, nox_pctile, '', nox.index, '')
-            label_xyt(ax1, '%s Window NOx (g/hp-hr)' % bin_name, 'Percentile',
-                      '%s\nNOx (g/hp-hr) per Window' % plot_data_filename)
-            label_xy(ax2, '%s Window NOx (g/hp-hr)' % bin_name, 'Ranked Window Number')
-            lineat(ax1, 95, 'b-')
-            lineat(ax1, 70, 'c-')
-            nox_gphphr_95 = np.interp(95, nox_pctile, nox.values)
-            nox_gphphr_70 = np.interp(70, nox_pctile, nox.values)
-            vlineat(ax1, nox_gphphr_95, 'b--')
-            vlineat(ax1, nox_gphphr_70, 'c--')
-            fig.subplots_adjust(right=0.875)
-            ax1.legend(['Percentile/Ranked Window Number', '95th pctile', '70th pctile',
-                        '95th pctile NOx %.3f' % nox_gphphr_95,
-                        '70th pctile NOx %.3f' % nox_gphphr_70], fontsize=9)
-            for pctile in pctile_range:
-                bin_results[bin_name + ' %dth pctile NOX g/hp-hr' % pctile] = np.interp(pctile, nox_pctile, nox.values)
-
-            plt.savefig(figure_path + '%d_NOX_gphphr_p_ranked_bin_wdw' % fig_num, orientation='landscape')
+        if len(bin_data) > 0:
+            plot_ranked_bin_windows(bin_data['NOX g/hp-hr'], bin_name, plot_data_filename,
+                                    figure_path + '%d_NOX_gphphr_p_ranked_bin_wdw' % fig_num)
             fig_num = fig_num + 1
-        else:
-            bin_results[bin_name + ' 70th pctile NOX g/hp-hr'] = np.NaN
-            bin_results[bin_name + ' 95th pctile NOX g/hp-hr'] = np.NaN
 
     # close plots
     plt.close('all')
 
-    # generate results dictionary for this data file
-    results_dict = dict()
-    results_dict['file'] = plot_data_filename
-    results_dict['True Idle NOX Rate g/hr'] = true_idle_nox_gphr
-    results_dict['True Idle NOX g/hp-hr'] = true_idle_nox_gphphr
-    results_dict['True Idle Window Count'] = len(true_idle_pts)
 
-    for bin_name, bin_result in bin_results.items():
-        results_dict[bin_name] = bin_result
+def tbw_processor(data_filename, output_folder, __options, write_outputs=True, stats=None):
+    """
+    Process file for NOx emissions using time-based windows
 
-    # return dataframe containing dictionary results
-    res = pd.DataFrame.from_dict([results_dict])
-    res.sort_index(axis='columns', inplace=True)
+    :param data_filename: Name of file to process
+    :param output_folder:  Name of output file folder
+    :param __options: Data structure of command line / runtime options settings
+    :param write_outputs: if True then plots and tables are written to ::output_folder, results are also added to the
+        results database if ``options.results_db`` is set
+    :param stats: optional dict, filled with the number of 'samples' and 'windows' and the 'load secs',
+        'windows secs' and 'outputs secs' processing stage times
+    :return: single row pandas dataframe of results, or ``None`` if cycle work is NaN or negative
 
-    return res
+    """
+    if stats is None:
+        stats = dict()
+
+    options, data_profile = get_file_options(data_filename, __options)
+
+    print('\nprocessing %s %d HP' % (data_filename, data_profile.engine_power_rating_hp))
+
+    start_time = time.time()
+    signals, data_rate_Hz, cycle_totals, time_align_lags = load_tbw_signals(data_filename, options, data_profile)
+    stats['load secs'] = time.time() - start_time
+
+    # blocks of rows are loaded as windows are calculated when chunked
+    start_time = time.time()
+    results = tbw_evaluate(signals, options, data_profile.engine_power_rating_hp, data_rate_Hz, data_filename,
+                           cycle_totals, time_align_lags)
+    stats['windows secs'] = time.time() - start_time
+    stats['samples'] = cycle_totals['samples'] if options.chunk_rows else len(signals)
+
+    if results is None:
+        return None
+
+    stats['windows'] = len(results.window_df)
+
+    start_time = time.time()
+    if write_outputs:
+        write_tbw_outputs(results, None if options.chunk_rows else signals, data_filename, output_folder, options,
+                          data_profile)
+    stats['outputs secs'] = time.time() - start_time
+
+    if getattr(options, 'results_db', ''):
+        results_db.add_file_results(options.results_db, options.results_db_run_id, results.summary_df,
+                                    data_profile.engine_power_rating_hp, results.work_hphr, results.nox_g,
+                                    results.nox_gphphr)
+
+    return results.summary_df
+
+
+def tbw_file_job(data_filename, output_folder, staging_folder, options):
+    """
+    Process one file of a batch run, the file's outputs are staged in their own folder then moved into the output
+    folder when the file is done, so files can be processed at once by the scheduler
+
+    :param data_filename: Name of file to process
+    :param output_folder: Name of output folder
+    :param staging_folder: Name of this run's staging folder, from ``get_staging_folder()``
+    :param options: Data structure of command line / runtime options settings
+    :return: (file results, stats) tuple, file results is a single row pandas dataframe of results, or ``None`` if
+        cycle work is NaN or negative, stats is a dict of file stats from ``tbw_processor()``
+
+    """
+    file_staging_folder = staging_folder + os.sep + file_io.get_filename(data_filename)
+    stats = dict()
+
+    try:
+        # per-file messages are discarded if quiet, errors are still raised
+        with contextlib.redirect_stdout(io.StringIO()) if options.quiet else contextlib.nullcontext():
+            file_results = tbw_processor(data_filename, file_staging_folder, options, stats=stats)
+    except BaseException:
+        file_io.delete_folder(file_staging_folder)  # discard partial outputs
+        raise
+
+    if os.path.isdir(file_staging_folder):
+        file_io.promote_folder(file_staging_folder, output_folder)
+        os.rmdir(file_staging_folder)
+
+    return file_results, stats
+
+
+def get_staging_folder(output_folder):
+    """
+    Create a staging folder unique to this run (or service job) inside an output folder, outputs are written to the
+    staging folder then moved into the output folder with ``file_io.promote_folder()`` so concurrent runs never see
+    each other's partial outputs
+
+    :param output_folder: name of the output folder
+    :return: name of the staging folder, e.g. output_folder/_staging/20210101_120000_1234
+
+    """
+    staging_folder = output_folder + os.sep + '_staging' + os.sep + datetime.now().strftime('%Y%m%d_%H%M%S') + \
+        '_%d' % os.getpid()
+    file_io.validate_folder(staging_folder)
+    return staging_folder
+
+
+def remove_staging_folder(staging_folder):
+    """
+    Remove a staging folder, including any partial outputs of failed files, and the '_staging' folder too if no other
+    runs are staging outputs
+
+    :param staging_folder: name of the staging folder from ``get_staging_folder()``
+
+    """
+    file_io.delete_folder(staging_folder)
+    try:
+        os.rmdir(file_io.get_filepath(staging_folder))
+    except OSError:
+        pass  # other runs are still staging outputs
+
+
+def save_results_summary(results_df, csv_summary_filename, append=False):
+    """
+    Save results summary CSV file, optionally appending to prior results.  The summary file is locked while it is
+    updated and each update is written to a temporary file then renamed, so concurrent runs take turns and never leave
+    a partial file
+
+    :param results_df: results summary dataframe, one row per file
+    :param csv_summary_filename: name of results summary CSV file
+    :param append: if ``True`` then append to prior results in the file, else replace them
+
+    """
+    results_df = results_df.set_index('file')
+    with file_io.FileLock(csv_summary_filename):
+        if file_io.file_exists(csv_summary_filename) and append:
+            prior_results = pd.read_csv(csv_summary_filename, index_col='file')
+            new_results = prior_results.append(results_df)
+        else:
+            new_results = results_df
+        temp_filename = file_io.get_temp_filename(csv_summary_filename)
+        new_results.to_csv(temp_filename)
+        file_io.replace_file(temp_filename, csv_summary_filename)
+
+
+def append_results_summary(results_df, csv_summary_filename, lock=True):
+    """
+    Append rows to the results summary CSV file without rewriting it.  The summary file is locked while rows are
+    appended, the header is only written when the file is created.  If the new rows don't have the same columns as the
+    file then the file is rewritten with all the columns
+
+    :param results_df: results summary dataframe, one row per file
+    :param csv_summary_filename: name of results summary CSV file
+    :param lock: if ``False`` then the file is not locked, for files only this process writes to
+
+    """
+    results_df = results_df.set_index('file')
+    with file_io.FileLock(csv_summary_filename) if lock else contextlib.nullcontext():
+        if file_io.file_exists(csv_summary_filename):
+            with open(csv_summary_filename, 'r', newline='') as f:
+                header = next(csv.reader(f), [])
+
+            if header[:1] == ['file'] and sorted(header[1:]) == sorted(results_df.columns):
+                with open(csv_summary_filename, 'a', newline='') as f:
+                    results_df[header[1:]].to_csv(f, header=False)
+                return
+
+            results_df = pd.read_csv(csv_summary_filename, index_col='file').append(results_df)
+
+        temp_filename = file_io.get_temp_filename(csv_summary_filename)
+        results_df.to_csv(temp_filename)
+        file_io.replace_file(temp_filename, csv_summary_filename)
+
+
+def stream_file_results(data_filename, file_results, csv_summary_filename, fleet_sketches, kept_results=None):
+    """
+    Add one file's results to a results summary CSV file and the fleet sketches as the file finishes, so a run doesn't
+    keep every file's results in memory
+
+    :param data_filename: name of the file that finished
+    :param file_results: single row pandas dataframe of the file's results from ``tbw_file_job()``, or ``None``
+    :param csv_summary_filename: name of results summary CSV file to append to, only written by this process
+    :param fleet_sketches: ``OrderedDict`` of fleet quantile sketches from ``sketch.update_sketches()``
+    :param kept_results: optional list the file results are also added to, e.g. for the fleet bootstrap
+
+    """
+    if file_results is not None:
+        append_results_summary(file_results, csv_summary_filename, lock=False)
+        sketch.update_sketches(fleet_sketches, file_results)
+        if kept_results is not None:
+            kept_results.append(file_results)
 
 
 # entry point for script when called from command line
 if __name__ == '__main__':
 
     # define command line arguments specific to time-based window processing
-    additional_args = [
-        "parser.add_argument('--window_length_secs', type=str, help='time-based window length (seconds) [default: 300]', default='300')",
-        "parser.add_argument('--window_step_secs', type=str, help='time-based window step (seconds) [default: 300]', default='300')",
-        "parser.add_argument('--window_min_secs', type=str, help='time-based window minimum size (seconds) [default: 30]', default='30')",
-        "parser.add_argument('--hdiut', action='store_true', help='Data comes from EPA Heavy-Duty In-Use Testing')",
-        "parser.add_argument('--idle_speed_thresh_mph', type=str, help='Speed threshhold for idle bin below this speed [default: 1]', default='1')",
-        "parser.add_argument('--ftp_co2_gphphr', type=str, help='FTP CO2 g/hp-hr for this engine', default='')",
-        "parser.add_argument('--co2_normalization', action='store_true', help='NOx g/hp-hr = NOx_g/CO2_g * CO2_g/FTP_hp-hr')",
-        "parser.add_argument('--true_idle_bin', action='store_true', help='Add extra bin for true idle (vehicle speed < idle_speed_thresh_mph mph for entire window)')",
-        "parser.add_argument('--hp_cutpoints_pct', type=str, help='Horsepower cutpoints for bin definitions [default: 25]', default='25')",
-        "parser.add_argument('--reuse_output_folder', action='store_true', help='Reuse output folder, do not delete prior results')",
-    ]
-
-    additional_options = ["options.window_length_secs = args.window_length_secs",
-                          "options.window_step_secs = args.window_step_secs",
-                          "options.window_min_secs = args.window_min_secs",
-                          "options.hdiut = args.hdiut",
-                          "options.idle_speed_thresh_mph = args.idle_speed_thresh_mph",
-                          "options.ftp_co2_gphphr = args.ftp_co2_gphphr",
-                          "options.co2_normalization = args.co2_normalization",
-                          "options.true_idle_bin = args.true_idle_bin",
-                          "options.hp_cutpoints_pct = args.hp_cutpoints_pct",
-                          "options.reuse_output_folder = args.reuse_output_folder",
-                          ]
+    additional_args = tbw_window_args + tbw_bin_args + preflight.preflight_args + scheduler.scheduler_args + \
+        progress.progress_args + results_db.results_db_args
+
+    additional_options = tbw_window_options + tbw_bin_options + preflight.preflight_options + \
+        scheduler.scheduler_options + progress.progress_options + results_db.results_db_options
 
     # process script-specific and common (see cti_common.py) command line options
     options = cti.handle_command_line_options(
@@ -490,38 +1888,42 @@ if __name__ == '__main__':
         additional_args=additional_args,
         additional_options=additional_options)
 
-    options.window_length_secs = float(options.window_length_secs)
-    options.window_step_secs = float(options.window_step_secs)
-    options.window_min_secs = float(options.window_min_secs)
+    process_window_options(options)
 
     # generate descriptor string based on user supplied settings
-    descriptor_str = ''
-
-    if options.true_idle_bin:
-        descriptor_str = descriptor_str + '_TI'
-
-    descriptor_str = descriptor_str + '_c(' + options.hp_cutpoints_pct + ')'
-
-    if options.co2_normalization:
-        descriptor_str = descriptor_str + '_co2n'
-
-    descriptor_str = descriptor_str + '_idl' + options.idle_speed_thresh_mph
-
-    # generate numeric array of bin normalized hp cutpoints
-    options.hp_cutpoints_frac = eval('np.array([' + options.hp_cutpoints_pct + '])') / 100
+    descriptor_str = get_descriptor_str(options)
 
     # generate output folder name based on user supplied settings
-    tbw_folder_name = file_io.get_filename(__file__).replace('process_', '') + '_%d_%d%s' % (
-    options.window_length_secs, options.window_step_secs, descriptor_str)
+    tbw_folder_name = get_tbw_folder_name(options)
 
     if cti_verbose:
         print('tbw_folder_name = ' + tbw_folder_name )
 
-    # generate fresh timestamp and delete previous output folder unless reusing
+    # generate fresh timestamp unless reusing, only delete previous output folder if requested
     datetime_str = ''
     if not options.reuse_output_folder:
         datetime_str = datetime_str + datetime.now().strftime('%Y%m%d_%H%M%S')
-        file_io.delete_folder(options.output_path + os.sep + tbw_folder_name)  # delete folder so there's no old data
+    output_folder = options.output_path + os.sep + tbw_folder_name
+    if options.clean_output_folder:
+        file_io.delete_folder(output_folder)  # delete folder so there's no old data
+
+    # outputs are written to a staging folder unique to this run then moved into the output folder, so concurrent
+    # runs never delete or overwrite each other's partial results
+    staging_folder = get_staging_folder(output_folder)
+
+    # check files before processing, skip files that would fail
+    if options.preflight:
+        report_df, options.file_list = preflight.preflight_files(options.file_list, options.data_profile,
+                                                                 options.hdiut, int(options.preflight_sample_rows),
+                                                                 int(options.preflight_workers))
+        preflight.print_preflight_summary(report_df)
+        report_df.to_csv(staging_folder + os.sep + tbw_folder_name + '_preflight_report_%s.csv' % datetime_str,
+                         index=False)
+        file_io.promote_folder(staging_folder, output_folder)
+
+    # add this run to the results database, file results are added as each file finishes
+    if options.results_db:
+        options.results_db_run_id = results_db.add_run(options.results_db, options, tbw_folder_name)
 
     # create results dictionary and dataframes to store bin emissions rates at various percentiles
     # for output summary file
@@ -532,67 +1934,127 @@ if __name__ == '__main__':
         results_dict[pctile] = pd.DataFrame()
         results_dict[pctile]['co2_pct'] = co2_pct_range
 
-    # create results summary dataframe (one row per file)
-    results_df = pd.DataFrame()
+    # create fleet quantile sketches (one per result column), updated as each file finishes
+    fleet_sketches = OrderedDict()
+
+    # calculate time-base window results for user-selected files, largest files first.  Each file is only sampled for
+    # its cost when files are scheduled in worker processes
+    scheduled = int(options.file_workers) or float(options.file_timeout_secs) or float(options.worker_memory_limit)
+    cost_df = scheduler.estimate_file_costs(options.file_list, options.data_profile, options.hdiut,
+                                            int(options.preflight_sample_rows),
+                                            report_df if options.preflight else None, bool(scheduled))
 
-    # calculate time-base window results for user-selected files
-    for data_filename in options.file_list:
-        file_results = tbw_processor(data_filename, options.output_path + os.sep + tbw_folder_name, options)
-        results_df = results_df.append(file_results, ignore_index=True, sort=False)
+    # report progress as files finish and keep a status file up to date for run monitoring
+    run_id = file_io.get_filename(staging_folder)
+    if options.status_file:
+        status_filename = options.status_file
+    else:
+        status_filename = output_folder + os.sep + '_status' + os.sep + run_id + '.json'
+    progress_reporter = progress.ProgressReporter(dict(zip(cost_df['file'], cost_df['est rows'])), status_filename,
+                                                  int(options.file_workers), float(options.status_interval_secs),
+                                                  run_id)
+    print('writing run status to %s' % status_filename)
+
+    # runs that don't reuse the output folder write their own results summary and fleet sketches, tagged with the run
+    # id, so concurrent runs with the same settings never replace each other's results
+    run_str = '' if options.reuse_output_folder else '_' + run_id
+
+    # each file's results summary row is written next to the staging folder as the file finishes, in the order files
+    # finish, only the fleet bootstrap keeps every file's results in memory
+    staged_summary_filename = file_io.get_filepath(staging_folder) + os.sep + run_id + '_results_summary.csv'
+    bootstrap_results = [] if options.bootstrap_samples else None
+    result_function = functools.partial(stream_file_results, csv_summary_filename=staged_summary_filename,
+                                        fleet_sketches=fleet_sketches, kept_results=bootstrap_results)
+
+    _, schedule_df = scheduler.run_scheduled_jobs(tbw_file_job, cost_df, (output_folder, staging_folder, options),
+                                                  int(options.file_workers), float(options.memory_budget),
+                                                  float(options.file_timeout_secs), float(options.worker_memory_limit),
+                                                  int(options.file_retries), progress=progress_reporter,
+                                                  result_function=result_function)
+    schedule_df.drop(columns='traceback').to_csv(staging_folder + os.sep + tbw_folder_name +
+                                                 '_schedule_%s.csv' % datetime_str, index=False)
+
+    # report failed files, the results are from the files that succeeded
+    failures_df = schedule_df.loc[schedule_df['status'] != 'ok', ['file', 'status', 'attempts', 'error', 'traceback']]
+    if len(failures_df):
+        failures_df.to_csv(staging_folder + os.sep + tbw_folder_name + '_failures_%s.csv' % datetime_str,
+                           index=False)
+        print('\n*** %d of %d files failed, see %s_failures_%s.csv ***' % (len(failures_df), len(schedule_df),
+                                                                          tbw_folder_name, datetime_str))
+        for _, row in failures_df.iterrows():
+            print('    %s %s: %s' % (row['status'].upper(), row['file'], row['error']))
+
+    if not file_io.file_exists(staged_summary_filename):
+        file_io.promote_folder(staging_folder, output_folder)
+        remove_staging_folder(staging_folder)
+        progress_reporter.close()
+        print('\n*** no files were processed successfully ***', file=sys.stderr)
+        exit(-1)
 
     # gather results for box and whisker plots of emissions arates across all selected input files
     print('\nCollating Final Results...\n')
 
-    # plot 'true idle' NOx emissions rates (g/hr)
-    fig = plt.figure()
-    if options.true_idle_bin:
-        if len(results_df['True Idle NOX Rate g/hr'].dropna()) > 0:
-            boxplot_dict = plt.boxplot(
-                results_df['True Idle NOX Rate g/hr'].dropna(),
-                whis=1e6, labels=['True Idle\n%0.3f Avg\n%0.3f Med' % (
-                results_df['True Idle NOX Rate g/hr'].mean(), results_df['True Idle NOX Rate g/hr'].median())],
-                showmeans=True)
-            ax1 = plt.gca()
-            ax1.set_ylabel('True Idle NOx Rate(g/hr)')
-            ax1.set_title('True Idle NOx Rate Boxplot %s_%d_%d_%d%s' % (
-            options.data_profile.regulatory_class, options.window_length_secs, options.window_step_secs,
-            options.window_min_secs, descriptor_str), fontsize=9)
-            ax1.legend(handles=[boxplot_dict['medians'][0], boxplot_dict['means'][0]], labels=['median', 'mean'])
-            plt.grid()
-            plt.savefig(options.output_path + os.sep + tbw_folder_name + '/NOx_TruIdle_plt %s_%d_%d_%d%s_%s' % (
-            options.data_profile.regulatory_class, options.window_length_secs, options.window_step_secs,
-            options.window_min_secs, descriptor_str, datetime_str), orientation='landscape')
-
-    # plot brake-specific NOx emissions rates (g/hp-hr) for non-'true idle' bins
-    gphphr_results = {}
-    gphphr_labels = []
-    # calculate mean and median emissions rates for plot labels for each bin
-    for c in results_df.columns:
-        if ('gphphr' in c) or ('g/hp-hr' in c) and ('pctile' not in c):
-            print('Processing Column %s' % c)
-            if len(results_df[c].dropna()) > 0:
-                gphphr_results[c] = results_df[c].dropna()
-                gphphr_labels.append('%s\n%0.3f Avg\n%0.3f Med' % (c, results_df[c].mean(), results_df[c].median()))
-
-    fig = plt.figure()
-    boxplot_dict = plt.boxplot(gphphr_results.values(), whis=1e6, labels=gphphr_labels, showmeans=True)
-    ax1 = plt.gca()
-    ax1.set_ylabel('Bin NOx (g/hp-hr)')
-    ax1.set_title('Bin Brake Specific NOx Boxplot %s_%d_%d%s' % (
-    options.data_profile.regulatory_class, options.window_length_secs, options.window_step_secs, descriptor_str),
-                  fontsize=9)
-    ax1.legend(handles=[boxplot_dict['medians'][0], boxplot_dict['means'][0]], labels=['median', 'mean'])
-    plt.grid()
-    plt.savefig(options.output_path + os.sep + tbw_folder_name + '/NOx_bin_plt %s_%d_%d%s_%s' % (
-    options.data_profile.regulatory_class, options.window_length_secs, options.window_step_secs, descriptor_str,
-    datetime_str), orientation='landscape')
-
-    # generate CSV summary file from results dataframe
-    csv_summary_filename = options.output_path + os.sep + tbw_folder_name + os.sep + tbw_folder_name + '_results_summary.csv'
-    results_df.set_index('file', inplace=True)
-    if file_io.file_exists(csv_summary_filename) and options.reuse_output_folder:
-        prior_results = pd.read_csv(csv_summary_filename)
-        new_results = prior_results.append(results_df)
-        new_results.to_csv(csv_summary_filename)
+    # generate fleet confidence intervals by resampling files
+    if options.bootstrap_samples:
+        results_df = pd.concat(bootstrap_results, ignore_index=True, sort=False)
+        fleet_columns = [c for c in results_df.columns if any((' %s g/hp-hr' % species) in c for species in
+                                                              options.species) and ('CI' not in c) and
+                         (('pctile' not in c) or ('70th' in c) or ('95th' in c))]
+        fleet_ci = bootstrap.bootstrap_fleet_ci(results_df, fleet_columns, num_resamples=options.bootstrap_samples,
+                                                ci_pct=options.bootstrap_ci_pct, seed=options.bootstrap_seed,
+                                                num_workers=options.bootstrap_workers)
+        fleet_ci.to_csv(staging_folder + os.sep + tbw_folder_name + '_fleet_bootstrap_ci_%s.csv' % datetime_str)
+
+    # merge sketches from prior runs into this folder, save sketches for later runs and shards, the sketches are
+    # locked until the fleet outputs are in place so concurrent runs merge one at a time
+    sketch_filename = output_folder + os.sep + tbw_folder_name + '_fleet_sketches%s.json' % run_str
+    with file_io.FileLock(sketch_filename):
+        if file_io.file_exists(sketch_filename) and options.reuse_output_folder:
+            fleet_sketches = sketch.merge_sketches(sketch.load_sketches(sketch_filename), fleet_sketches)
+        sketch.save_sketches(staging_folder + os.sep + file_io.get_filenameext(sketch_filename), fleet_sketches)
+
+        sketch.sketch_percentile_table(fleet_sketches, pctile_range).to_csv(
+            staging_folder + os.sep + tbw_folder_name + '_fleet_percentiles_%s.csv' % datetime_str)
+
+        # plot 'true idle' NOx emissions rates (g/hr)
+        if options.true_idle_bin:
+            if 'True Idle NOX Rate g/hr' in fleet_sketches and fleet_sketches['True Idle NOX Rate g/hr'].count > 0:
+                sketch.plot_sketch_boxplot(fleet_sketches, ['True Idle NOX Rate g/hr'], 'True Idle NOx Rate(g/hr)',
+                                           'True Idle NOx Rate Boxplot %s_%g_%g_%g%s' % (
+                                               options.data_profile.regulatory_class, options.window_length_secs,
+                                               options.window_step_secs, options.window_min_secs, descriptor_str),
+                                           label_names=['True Idle'])
+                plt.savefig(staging_folder + '/NOx_TruIdle_plt %s_%g_%g_%g%s_%s.png' % (
+                options.data_profile.regulatory_class, options.window_length_secs, options.window_step_secs,
+                options.window_min_secs, descriptor_str, datetime_str), orientation='landscape')
+
+        # plot brake-specific emissions rates (g/hp-hr) for non-'true idle' bins, one plot per species
+        for species in options.species:
+            species_name = species.replace('NOX', 'NOx')
+            gphphr_columns = []
+            for c in fleet_sketches.keys():
+                if (' %s g/hp-hr' % species in c) and ('pctile' not in c) and ('CI' not in c):
+                    print('Processing Column %s' % c)
+                    gphphr_columns.append(c)
+
+            sketch.plot_sketch_boxplot(fleet_sketches, gphphr_columns, 'Bin %s (g/hp-hr)' % species_name,
+                                       'Bin Brake Specific %s Boxplot %s_%g_%g%s' % (
+                                           species_name, options.data_profile.regulatory_class,
+                                           options.window_length_secs, options.window_step_secs, descriptor_str))
+            plt.savefig(staging_folder + '/%s_bin_plt %s_%g_%g%s_%s.png' % (
+            species_name, options.data_profile.regulatory_class, options.window_length_secs, options.window_step_secs,
+            descriptor_str, datetime_str), orientation='landscape')
+
+        file_io.promote_folder(staging_folder, output_folder)
+
+    # move the results summary into place, or append it to the results summary of prior runs a block at a time
+    csv_summary_filename = output_folder + os.sep + tbw_folder_name + '_results_summary%s.csv' % run_str
+    if options.reuse_output_folder:
+        for summary_rows_df in pd.read_csv(staged_summary_filename, chunksize=1000):
+            append_results_summary(summary_rows_df, csv_summary_filename)
+        os.remove(staged_summary_filename)
     else:
-        results_df.to_csv(csv_summary_filename)
+        file_io.replace_file(staged_summary_filename, csv_summary_filename)
+    remove_staging_folder(staging_folder)
+
+    progress_reporter.close()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_progress.py
+===============
+
+Batch progress reporting, files done/total, samples/s, windows/s and a rolling ETA for each processing stage
+
+A progress line is printed as each file finishes, and a JSON status file is rewritten every few seconds (and as each
+file starts and finishes) so run monitoring can watch the batch.  The status file is replaced atomically, a reader
+never sees a partial file.
+
+Stage ETAs are the estimated samples still to process times the recent seconds per sample of each stage, from the last
+few files, divided by the number of files that can still be processed at once.
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import os
+import json
+import time
+import threading
+from collections import deque
+from datetime import datetime
+import numpy as np
+import cti_file_io as file_io
+
+# processing stages timed by the file jobs, see ``cti_process_TBW.tbw_processor()``
+stages = ['load', 'windows', 'outputs']
+
+# number of recent files used for the rolling stage rates
+rolling_files = 10
+
+
+def format_secs(secs):
+    """
+    Format a duration as hours:minutes:seconds
+
+    :param secs: duration (seconds)
+    :return: 'H:MM:SS' string, or '?' if unknown
+    """
+    if secs is None or not np.isfinite(secs):
+        return '?'
+    secs = int(round(secs))
+    return '%d:%02d:%02d' % (secs // 3600, secs // 60 % 60, secs % 60)
+
+
+class ProgressReporter(object):
+    """
+    Track batch progress and write a JSON status file
+
+    .. code-block:: python
+
+        progress = ProgressReporter(est_samples, 'output/status.json', num_workers=4)
+        progress.file_started(data_filename)
+        progress.file_finished(data_filename, 'ok', {'samples': 36000, 'windows': 35700, 'load secs': 1.2, ...})
+        progress.close()
+
+    """
+    def __init__(self, est_samples, status_filename='', num_workers=1, interval_secs=10, run_id=''):
+        """
+        Create ``ProgressReporter`` object and start updating the status file
+
+        :param est_samples: dict of file name: estimated number of samples (data rows), one entry per file in the batch
+        :param status_filename: name of the JSON status file, '' = no status file
+        :param num_workers: number of files processed at once
+        :param interval_secs: status file update interval (seconds)
+        :param run_id: run identifier written to the status file
+        """
+        self.est_samples = {data_filename: (0 if np.isnan(samples) else samples)
+                            for data_filename, samples in est_samples.items()}
+        self.status_filename = status_filename
+        self.num_workers = max(1, num_workers)
+        self.interval_secs = interval_secs
+        self.run_id = run_id
+
+        self.start_time = time.time()
+        self.running = dict()  # file name: start time
+        self.finished = dict()  # file name: status
+        self.samples = 0
+        self.windows = 0
+        self.stage_secs = {stage: 0.0 for stage in stages}
+        self.recent = deque(maxlen=rolling_files)  # (samples, {stage: secs}) of recent files
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.status_filename:
+            if file_io.get_filepath(self.status_filename):
+                file_io.validate_folder(file_io.get_filepath(self.status_filename))
+            self.write_status()
+            self._thread = threading.Thread(target=self._update_status, daemon=True)
+            self._thread.start()
+
+    def _update_status(self):
+        """
+        Rewrite the status file every ``interval_secs`` until closed
+        """
+        while not self._stop.wait(self.interval_secs):
+            self.write_status()
+
+    def file_started(self, data_filename):
+        """
+        Record the start of a file
+
+        :param data_filename: name of the file
+        """
+        with self._lock:
+            self.running[data_filename] = time.time()
+        self.write_status()
+
+    def file_finished(self, data_filename, status, stats=None):
+        """
+        Record the end of a file and print a progress line
+
+        :param data_filename: name of the file
+        :param status: file status, e.g. 'ok', 'failed' or 'timeout'
+        :param stats: optional dict of file stats, 'samples', 'windows' and '<stage> secs'
+        """
+        stats = stats or dict()
+        with self._lock:
+            self.running.pop(data_filename, None)
+            self.finished[data_filename] = status
+            if 'samples' in stats:
+                self.est_samples[data_filename] = stats['samples']
+                self.samples += stats['samples']
+                self.windows += stats.get('windows', 0)
+                file_stage_secs = {stage: stats.get('%s secs' % stage, 0.0) for stage in stages}
+                for stage in stages:
+                    self.stage_secs[stage] += file_stage_secs[stage]
+                self.recent.append((stats['samples'], file_stage_secs))
+
+        status_dict = self.write_status()
+
+        print('progress: %d/%d files (%d failed), %.0f samples/s, %.0f windows/s, ETA %s (%s)' %
+              (status_dict['files done'], status_dict['files total'], status_dict['files failed'],
+               status_dict['samples per sec'], status_dict['windows per sec'],
+               format_secs(status_dict['eta secs']),
+               ', '.join('%s %s' % (stage, format_secs(status_dict['stages'][stage]['eta secs']))
+                         for stage in stages)))
+
+    def status(self):
+        """
+        Get the current batch status
+
+        :return: JSON-serializable dict of batch status
+        """
+        with self._lock:
+            now = time.time()
+            elapsed_secs = now - self.start_time
+            remaining_samples = sum(samples for data_filename, samples in self.est_samples.items()
+                                    if data_filename not in self.finished)
+            recent_samples = sum(samples for samples, _ in self.recent)
+            concurrency = max(1, min(self.num_workers, len(self.est_samples) - len(self.finished)))
+
+            stage_status = dict()
+            for stage in stages:
+                if recent_samples:
+                    secs_per_sample = sum(stage_secs[stage] for _, stage_secs in self.recent) / recent_samples
+                    eta_secs = remaining_samples * secs_per_sample / concurrency
+                    samples_per_sec = 1 / secs_per_sample if secs_per_sample else None
+                else:
+                    eta_secs = None
+                    samples_per_sec = None
+                stage_status[stage] = {'secs': self.stage_secs[stage], 'samples per sec': samples_per_sec,
+                                       'eta secs': eta_secs}
+
+            if len(self.finished) == len(self.est_samples):
+                eta_secs = 0.0
+            elif recent_samples:
+                eta_secs = sum(stage_status[stage]['eta secs'] for stage in stages)
+            else:
+                eta_secs = None
+
+            return {
+                'run id': self.run_id,
+                'pid': os.getpid(),
+                'state': 'done' if self._stop.is_set() else 'running',
+                'start time': datetime.fromtimestamp(self.start_time).isoformat(timespec='seconds'),
+                'update time': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+                'elapsed secs': elapsed_secs,
+                'files total': len(self.est_samples),
+                'files done': len(self.finished),
+                'files failed': sum(status != 'ok' for status in self.finished.values()),
+                'files running': {data_filename: now - start_time for data_filename, start_time in
+                                  self.running.items()},
+                'samples done': self.samples,
+                'samples remaining est': remaining_samples,
+                'windows done': self.windows,
+                'samples per sec': self.samples / elapsed_secs if elapsed_secs else 0.0,
+                'windows per sec': self.windows / elapsed_secs if elapsed_secs else 0.0,
+                'eta secs': eta_secs,
+                'eta': format_secs(eta_secs),
+                'stages': stage_status,
+            }
+
+    def write_status(self):
+        """
+        Write the status file, if any, through a temporary file so readers never see a partial file
+
+        :return: status dict from ``status()``
+        """
+        status_dict = self.status()
+
+        if self.status_filename:
+            with self._lock:
+                temp_filename = file_io.get_temp_filename(self.status_filename)
+                with open(temp_filename, 'w') as f:
+                    json.dump(status_dict, f, indent=2)
+                file_io.replace_file(temp_filename, self.status_filename)
+
+        return status_dict
+
+    def close(self):
+        """
+        Stop updating the status file and write the final status
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write_status()
+
+
+# command line arguments for progress reporting, shared with cti_process_TBW.py
+progress_args = [
+    "parser.add_argument('--status_file', type=str, help='Path and filename of the JSON run status file [default: <output folder>/_status/<run id>.json]', default='')",
+    "parser.add_argument('--status_interval_secs', type=str, help='Run status file update interval (seconds) [default: 10]', default='10')",
+    "parser.add_argument('--quiet', action='store_true', help='Suppress per-file processing messages, progress is still reported')",
+]
+
+progress_options = ["options.status_file = args.status_file",
+                    "options.status_interval_secs = args.status_interval_secs",
+                    "options.quiet = args.quiet",
+                    ]
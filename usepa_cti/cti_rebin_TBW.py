@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+cti_rebin_TBW.py
+================
+
+Recalculate time-based window bins, percentiles and the results summary from window tables saved by
+``cti_process_TBW.py --save_windows``, without reloading source data or recalculating windows
+
+.. code-block:: bash
+
+    python cti_process_TBW.py --source_path sample_data --hdiut --window_step_secs 1 --save_windows
+    python cti_rebin_TBW.py --source_path output/window_tables --hp_cutpoints_pct 8,25 --co2_normalization
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+import os
+import copy
+import pandas as pd
+
+import cti_file_io as file_io
+import cti_common as cti
+import cti_window_store as window_store
+import cti_process_TBW as tbw
+
+
+def tbw_rebin(window_table_filename, __options):
+    """
+    Recalculate bins and bin results for a saved window table
+
+    :param window_table_filename: Name of window table file to process
+    :param __options: Data structure of command line / runtime options settings
+    :return: (results dataframe, window table metadata) tuple
+
+    """
+    wp_window_df, metadata = window_store.load_window_table(window_table_filename)
+
+    # use the FTP CO2 g/hp-hr from the original run unless overridden
+    options = copy.copy(__options)
+    if options.ftp_co2_gphphr == '':
+        options.ftp_co2_gphphr = metadata['ftp_co2_gphphr']
+    else:
+        try:
+            options.ftp_co2_gphphr = float(options.ftp_co2_gphphr)
+        except ValueError:
+            raise Exception('FTP CO2 g/hp-hr "%s" must be a number' % options.ftp_co2_gphphr)
+    options.window_length_secs = metadata['window_length_secs']
+    options.window_step_secs = metadata['window_step_secs']
+
+    # window tables only have the species integrated by the original run
+    missing_species = [species for species in options.species if 'Tailpipe %s g' % species not in wp_window_df]
+    if missing_species:
+        raise Exception('window table %s has no %s windows' % (window_table_filename, ','.join(missing_species)))
+
+    max_co2_rate_gphr = options.ftp_co2_gphphr * metadata['engine_power_rating_hp']
+
+    print('rebinning %s...' % window_table_filename)
+
+    wp_window_df = tbw.calc_window_rates(wp_window_df, options, max_co2_rate_gphr)
+    wp_window_df, true_idle_pts, bins = tbw.bin_windows(wp_window_df, options)
+    true_idle_results, bin_results = tbw.calc_bin_results(true_idle_pts, bins, options)
+
+    if options.bootstrap_samples:
+        bin_results.update(tbw.calc_bin_ci(true_idle_pts, bins, options))
+
+    return tbw.tbw_summary(metadata['file'], true_idle_results, bin_results), metadata
+
+
+# entry point for script when called from command line
+if __name__ == '__main__':
+
+    additional_args = [
+        "parser.set_defaults(include='*.npz', exclude='', profile='')",
+    ] + tbw.tbw_bin_args
+
+    # process script-specific and common (see cti_common.py) command line options
+    options = cti.handle_command_line_options(
+        app_description='Time-Based Window Rebin Processor, recalculates bin results from saved window tables',
+        additional_args=additional_args,
+        additional_options=tbw.tbw_bin_options)
+
+    tbw.process_bin_options(options)
+
+    # calculate bin results for each window table
+    results_df = pd.DataFrame()
+    window_settings = set()
+    for window_table_filename in sorted(options.file_list):
+        file_results, metadata = tbw_rebin(window_table_filename, options)
+        results_df = results_df.append(file_results, ignore_index=True, sort=False)
+        window_settings.add((metadata['window_length_secs'], metadata['window_step_secs'],
+                             metadata['resample_Hz'], metadata['resample_method'], metadata.get('max_dt', 0),
+                             metadata.get('time_align_emissions', False),
+                             metadata.get('time_align_reference', 'power')))
+
+    if len(window_settings) > 1:
+        print('\n*** WARNING: window tables were produced by %d different window settings ***\n' %
+              len(window_settings))
+
+    # name output folder the same as the time-based window processor would for these settings
+    options.window_length_secs, options.window_step_secs, options.resample_Hz, options.resample_method, \
+        options.max_dt, options.time_align_emissions, options.time_align_reference = sorted(window_settings)[0]
+    tbw_folder_name = tbw.get_tbw_folder_name(options)
+    output_folder = options.output_path + os.sep + tbw_folder_name
+
+    if options.clean_output_folder:
+        file_io.delete_folder(output_folder)  # delete folder so there's no old data
+    file_io.validate_folder(output_folder)
+
+    # generate CSV summary file from results dataframe
+    csv_summary_filename = output_folder + os.sep + tbw_folder_name + '_results_summary.csv'
+    tbw.save_results_summary(results_df, csv_summary_filename, append=options.reuse_output_folder)
+
+    print('\nwrote %s' % csv_summary_filename)
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_results_db.py
+=================
+
+Optional SQLite results database, an alternative to loading and joining results summary CSV files when comparing runs
+across window settings
+
+Tables:
+
+    * ``runs``: one row per processing run, with a fingerprint (hash) of the settings that change results, the output
+      descriptor and the settings as JSON
+    * ``files``: one row per run and file, with the engine power rating and cycle work and NOx totals
+    * ``bin_results``: one row per run, file, bin and metric (e.g. 'NOX g/hp-hr', 'CO g/hp-hr', 'Window Count')
+    * ``percentiles``: one row per run, file, bin, emissions species and window g/hp-hr percentile
+
+Each file's results are bulk inserted in one transaction as the file finishes.  The database uses write-ahead logging
+(WAL) so several processing runs may add results to the same database at once.
+
+.. code-block:: bash
+
+    python cti_process_TBW.py --source_path sample_data --hdiut --window_step_secs 1 --results_db output/results.sqlite
+    python cti_results_db.py --source_path output --include results.sqlite --metric "NOX g/hp-hr"
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import os
+import re
+import json
+import sqlite3
+import hashlib
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import cti_file_io as file_io
+
+results_db_version = 2
+
+# runtime options that change window or bin results, used for the run fingerprint
+fingerprint_options = ['profile_filename', 'hdiut', 'window_length_secs', 'window_step_secs', 'window_min_secs',
+                       'resample_Hz', 'resample_method', 'max_dt', 'idle_speed_thresh_mph', 'ftp_co2_gphphr',
+                       'co2_normalization', 'true_idle_bin', 'hp_cutpoints_pct', 'species', 'time_align_emissions',
+                       'time_align_reference', 'time_align_max_lag_secs', 'operating_modes', 'idle_speed_mph',
+                       'cruise_speed_mph', 'idle_rpm_threshold', 'mode_min_secs', 'window_pctiles']
+
+# runtime options that change results only when the option that enables them is set, option: enabling option.  They
+# are left out of the fingerprint when not enabled so runs that don't use them keep their fingerprint
+enabled_fingerprint_options = {'adaptive_step_factor': 'adaptive_step_factor',
+                               'adaptive_pctiles': 'adaptive_step_factor',
+                               'adaptive_margin': 'adaptive_step_factor',
+                               'cutpoint_sweep_pct': 'cutpoint_sweep_pct',
+                               'bootstrap_samples': 'bootstrap_samples',
+                               'bootstrap_ci_pct': 'bootstrap_samples',
+                               'bootstrap_seed': 'bootstrap_samples'}
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fingerprint TEXT NOT NULL,
+    descriptor TEXT,
+    options_json TEXT,
+    started TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    file TEXT NOT NULL,
+    engine_power_rating_hp REAL,
+    work_hphr REAL,
+    nox_g REAL,
+    nox_gphphr REAL,
+    processed TEXT,
+    PRIMARY KEY (run_id, file)
+);
+CREATE TABLE IF NOT EXISTS bin_results (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    file TEXT NOT NULL,
+    bin TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, file, bin, metric)
+);
+CREATE TABLE IF NOT EXISTS percentiles (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    file TEXT NOT NULL,
+    bin TEXT NOT NULL,
+    species TEXT NOT NULL,
+    pctile INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, file, bin, species, pctile)
+);
+CREATE INDEX IF NOT EXISTS runs_fingerprint ON runs (fingerprint);
+CREATE INDEX IF NOT EXISTS files_file ON files (file);
+CREATE INDEX IF NOT EXISTS bin_results_file ON bin_results (file);
+CREATE INDEX IF NOT EXISTS bin_results_bin ON bin_results (bin, metric);
+CREATE INDEX IF NOT EXISTS percentiles_file ON percentiles (file);
+CREATE INDEX IF NOT EXISTS percentiles_bin ON percentiles (bin, species, pctile);
+"""
+
+# version 1 percentiles were NOx only, add the species column
+upgrade_v1_statements = [
+    "DROP INDEX IF EXISTS percentiles_bin",
+    "ALTER TABLE percentiles RENAME TO percentiles_v1",
+    "CREATE TABLE percentiles (run_id INTEGER NOT NULL REFERENCES runs(run_id), file TEXT NOT NULL, "
+    "bin TEXT NOT NULL, species TEXT NOT NULL, pctile INTEGER NOT NULL, value REAL, "
+    "PRIMARY KEY (run_id, file, bin, species, pctile))",
+    "INSERT INTO percentiles SELECT run_id, file, bin, 'NOX', pctile, value FROM percentiles_v1",
+    "DROP TABLE percentiles_v1",
+]
+
+# summary column name to (bin, species, percentile) e.g. '>25.0 95th pctile NOX g/hp-hr' -> ('>25.0', 'NOX', 95)
+pctile_column_pattern = re.compile(r'^(.+) (\d+)th pctile (\S+) g/hp-hr$')
+
+
+def connect(db_filename, timeout_secs=60):
+    """
+    Open results database, creating the tables and indexes if required
+
+    :param db_filename: path and file name of the SQLite database
+    :param timeout_secs: time to wait for other writers to finish (seconds)
+    :return: ``sqlite3.Connection`` object
+    """
+    db_path = file_io.get_filepath(db_filename)
+    if db_path:
+        file_io.validate_folder(db_path)
+
+    connection = sqlite3.connect(db_filename, timeout=timeout_secs)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    _upgrade_schema(connection)
+    with connection:
+        connection.executescript(schema)
+        connection.execute('PRAGMA user_version=%d' % results_db_version)
+
+    return connection
+
+
+def _upgrade_schema(connection):
+    """
+    Upgrade an existing version 1 results database, under a write lock so concurrent runs upgrade it only once
+
+    :param connection: ``sqlite3.Connection`` object
+    """
+    if connection.execute('PRAGMA user_version').fetchone()[0] != 1:
+        return
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        if connection.execute('PRAGMA user_version').fetchone()[0] == 1:
+            for statement in upgrade_v1_statements:
+                connection.execute(statement)
+            connection.execute('PRAGMA user_version=%d' % results_db_version)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+
+
+def _db_value(value):
+    """
+    Convert a result value to an SQLite value, NaN becomes NULL
+
+    :param value: value to convert
+    :return: float, str or ``None``
+    """
+    if isinstance(value, str):
+        return value
+    elif value is None or pd.isnull(value):
+        return None
+    else:
+        return float(value)
+
+
+def options_fingerprint(options):
+    """
+    Generate run fingerprint from the runtime options that change results, runs with the same fingerprint have
+    comparable results
+
+    :param options: Data structure of command line / runtime options settings
+    :return: (fingerprint, options JSON) tuple
+    """
+    fingerprint_dict = dict()
+    enabled_options = [option for option, enabling_option in enabled_fingerprint_options.items()
+                       if getattr(options, enabling_option, None)]
+    for option in fingerprint_options + enabled_options:
+        value = getattr(options, option, None)
+        if option == 'profile_filename' and value:
+            value = os.path.abspath(value)
+        elif isinstance(value, (list, tuple, np.ndarray)):
+            value = ','.join(v if isinstance(v, str) else '%g' % v for v in value)
+        elif isinstance(value, (np.integer, np.floating)):
+            value = float(value)
+        fingerprint_dict[option] = value
+
+    options_json = json.dumps(fingerprint_dict, sort_keys=True)
+
+    return hashlib.sha1(options_json.encode('utf-8')).hexdigest(), options_json
+
+
+def add_run(db_filename, options, descriptor=''):
+    """
+    Add a processing run to the results database
+
+    :param db_filename: path and file name of the SQLite database
+    :param options: Data structure of command line / runtime options settings
+    :param descriptor: output descriptor, e.g. the output folder name
+    :return: run id
+    """
+    fingerprint, options_json = options_fingerprint(options)
+
+    connection = connect(db_filename)
+    try:
+        with connection:
+            cursor = connection.execute('INSERT INTO runs (fingerprint, descriptor, options_json, started) '
+                                        'VALUES (?, ?, ?, ?)',
+                                        (fingerprint, descriptor, options_json, datetime.now().isoformat()))
+        return cursor.lastrowid
+    finally:
+        connection.close()
+
+
+def summary_rows(summary_df):
+    """
+    Split a results summary row into bin result and percentile rows
+
+    :param summary_df: single row pandas dataframe of results from ``tbw_summary()``
+    :return: (list of (bin, metric, value) tuples, list of (bin, species, pctile, value) tuples)
+    """
+    bin_rows = []
+    pctile_rows = []
+
+    for column, value in summary_df.iloc[0].items():
+        if column == 'file':
+            continue
+
+        match = pctile_column_pattern.match(column)
+        if match:
+            pctile_rows.append((match.group(1), match.group(3), int(match.group(2)), _db_value(value)))
+        else:
+            # bin names have no spaces except for 'True Idle', time alignment results are stored as a 'Time Align' bin
+            if column.startswith('True Idle '):
+                bin_name, metric = 'True Idle', column[len('True Idle '):]
+            elif column.startswith('Time Align '):
+                bin_name, metric = 'Time Align', column[len('Time Align '):]
+            else:
+                bin_name, metric = column.split(' ', 1)
+            bin_rows.append((bin_name, metric, _db_value(value)))
+
+    return bin_rows, pctile_rows
+
+
+def add_file_results(db_filename, run_id, summary_df, engine_power_rating_hp=np.nan, work_hphr=np.nan,
+                     nox_g=np.nan, nox_gphphr=np.nan):
+    """
+    Add one file's results to the results database in a single transaction, replacing any prior results for the
+    same run and file
+
+    :param db_filename: path and file name of the SQLite database
+    :param run_id: run id from ``add_run()``
+    :param summary_df: single row pandas dataframe of results from ``tbw_summary()``
+    :param engine_power_rating_hp: engine power rating (hp)
+    :param work_hphr: cycle work (hp-hr)
+    :param nox_g: cycle NOx (g)
+    :param nox_gphphr: cycle NOx (g/hp-hr)
+    """
+    file = summary_df['file'].iloc[0]
+    bin_rows, pctile_rows = summary_rows(summary_df)
+
+    connection = connect(db_filename)
+    try:
+        with connection:
+            connection.execute('DELETE FROM bin_results WHERE run_id = ? AND file = ?', (run_id, file))
+            connection.execute('DELETE FROM percentiles WHERE run_id = ? AND file = ?', (run_id, file))
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (run_id, file, _db_value(engine_power_rating_hp), _db_value(work_hphr),
+                                _db_value(nox_g), _db_value(nox_gphphr), datetime.now().isoformat()))
+            connection.executemany('INSERT INTO bin_results VALUES (?, ?, ?, ?, ?)',
+                                   [(run_id, file) + row for row in bin_rows])
+            connection.executemany('INSERT INTO percentiles VALUES (?, ?, ?, ?, ?, ?)',
+                                   [(run_id, file) + row for row in pctile_rows])
+    finally:
+        connection.close()
+
+
+def query(db_filename, sql, params=()):
+    """
+    Run an SQL query on the results database
+
+    :param db_filename: path and file name of the SQLite database
+    :param sql: SQL query string
+    :param params: query parameters
+    :return: pandas dataframe of query results
+    """
+    connection = connect(db_filename)
+    try:
+        return pd.read_sql_query(sql, connection, params=params)
+    finally:
+        connection.close()
+
+
+def compare_runs(db_filename, metric='NOX g/hp-hr'):
+    """
+    Compare a bin result metric across runs, using the latest run of each fingerprint
+
+    :param db_filename: path and file name of the SQLite database
+    :param metric: bin result metric, e.g. 'NOX g/hp-hr', 'Window Count'
+    :return: pandas dataframe indexed by (file, bin) with one column per run descriptor
+    """
+    results_df = query(db_filename,
+                       'SELECT r.descriptor, b.file, b.bin, b.value FROM bin_results b '
+                       'JOIN runs r ON r.run_id = b.run_id '
+                       'WHERE b.metric = ? AND b.run_id IN (SELECT MAX(run_id) FROM runs GROUP BY fingerprint)',
+                       (metric,))
+
+    return results_df.pivot_table(index=['file', 'bin'], columns='descriptor', values='value', aggfunc='last')
+
+
+# command line arguments for the results database, shared with cti_process_TBW.py
+results_db_args = [
+    "parser.add_argument('--results_db', type=str, help='Path and filename of an SQLite results database to add results to [default: none]', default='')",
+]
+
+results_db_options = ["options.results_db = args.results_db",
+                      ]
+
+
+# entry point for script when called from command line
+if __name__ == '__main__':
+    import cti_common as cti
+
+    additional_args = [
+        "parser.set_defaults(include='*.sqlite', exclude='', profile='')",
+        "parser.add_argument('--metric', type=str, help='Bin result metric to compare across runs [default: NOX g/hp-hr]', default='NOX g/hp-hr')",
+    ]
+
+    additional_options = ["options.metric = args.metric",
+                          ]
+
+    # process script-specific and common (see cti_common.py) command line options
+    options = cti.handle_command_line_options(
+        app_description='Results Database Compare, tabulates a bin result across runs in SQLite results databases',
+        additional_args=additional_args,
+        additional_options=additional_options)
+
+    for db_filename in sorted(options.file_list):
+        compare_df = compare_runs(db_filename, options.metric)
+        compare_filename = options.output_path + os.sep + file_io.get_filename(db_filename) + '_compare_%s.csv' % \
+            re.sub(r'[^\w\-]+', '_', options.metric).strip('_')
+        compare_df.to_csv(compare_filename)
+        print('wrote %s' % compare_filename)
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_scheduler.py
+================
+
+Memory- and size-aware batch scheduler, runs one job per source data file in worker processes
+
+Each file's cost is estimated from its size and estimated row count, read from a small sample of the file by the
+pre-flight check (``cti_preflight.py``).  Files are started largest-first, which keeps the longest files from
+finishing last and so shortens the batch run time, and a file is only started while the estimated memory of all running
+files stays under the memory budget.  When the largest waiting file does not fit, the largest one that does fit is
+started instead, a file larger than the whole budget runs on its own.
+
+Each file runs in a new worker process so the peak memory of each file can be measured, the estimated and actual cost
+of each file is printed as it finishes and returned as a report dataframe.  Files processed in-process are measured by
+resetting the peak memory before each file where the platform allows it (Linux).  A forked worker starts with the resident
+memory of the scheduler process, so the peak memory of a file is measured as the rise in the worker's peak memory above
+its starting memory.
+
+When files are processed one at a time in-process the order and memory estimates are not needed, so only the largest
+file is sampled and the row counts of the other files, used for progress reports, are scaled by size.
+
+Worker processes also isolate failures, a file that raises an exception, calls ``exit()`` (e.g.
+``file_io.validate_file()``), runs past its time limit or runs out of memory is recorded in the report with its
+traceback and the rest of the batch carries on.  Transient I/O errors are retried after a delay.
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+import multiprocessing.connection
+import numpy as np
+import pandas as pd
+import cti_preflight as preflight
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# estimated memory of a worker process before loading any data (MB)
+worker_memory_MB = 150
+
+# estimated peak processing memory relative to the in-memory size of the source data
+memory_factor = 4
+
+
+def peak_memory_MB():
+    """
+    Get the peak resident memory of this process
+
+    :return: peak resident memory (MB), ``NaN`` if not available on this platform
+    """
+    if resource is None:
+        return np.nan
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss / 1e6  # bytes
+    else:
+        return max_rss / 1e3  # kilobytes
+
+
+def reset_peak_memory():
+    """
+    Reset the peak resident memory of this process to its current resident memory, so the peak memory of each file
+    can be measured when files are processed in-process.  Only available on Linux
+
+    :return: ``True`` if the peak memory was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def estimate_file_costs(file_list, data_profile, hdiut=True, sample_rows=100, report_df=None, sample_all=True):
+    """
+    Estimate the processing cost of each file from its size and estimated row count
+
+    :param file_list: list of source data file names
+    :param data_profile: ``DataSourceProfile`` object
+    :param hdiut: if True then files are HDIUT data, see ``preflight.preflight_file()``
+    :param sample_rows: number of data rows to read from each file to estimate the row count
+    :param report_df: optional pre-flight report dataframe from ``preflight.preflight_files()``, files in the report
+        are not read again
+    :param sample_all: if True then each file is sampled, else only the largest file is sampled and the other files are
+        scaled by size from it, for runs that are not scheduled (see ``run_scheduled_jobs()``)
+    :return: dataframe of 'file', 'size MB', 'est rows' and 'est memory MB', one row per file, largest-first
+    """
+    cost_df = pd.DataFrame({'file': list(file_list)})
+
+    if report_df is not None:
+        cost_df = cost_df.merge(report_df[['file', 'size MB', 'est rows', 'est memory MB']], on='file', how='left')
+    else:
+        cost_df['size MB'] = np.nan
+        cost_df['est rows'] = np.nan
+        cost_df['est memory MB'] = np.nan
+
+    unsampled = cost_df.index[cost_df['size MB'].isna()]
+    if not sample_all:
+        # size each file, then only sample the largest file if there are no estimates yet
+        for idx in unsampled:
+            data_filename = cost_df.loc[idx, 'file']
+            cost_df.loc[idx, 'size MB'] = os.path.getsize(data_filename) / 1e6 if os.path.isfile(data_filename) else 0
+        if cost_df['est rows'].notna().any() or cost_df.empty:
+            unsampled = []
+        else:
+            unsampled = [cost_df['size MB'].idxmax()]
+
+    for idx in unsampled:
+        result = preflight.preflight_file(cost_df.loc[idx, 'file'], data_profile, hdiut, sample_rows)
+        for column in ['size MB', 'est rows', 'est memory MB']:
+            cost_df.loc[idx, column] = result[column]
+
+    # files without sampled estimates (e.g. excel files) are scaled by size from the files with estimates
+    sampled = cost_df['est rows'].notna() & (cost_df['size MB'] > 0)
+    if sampled.any():
+        rows_per_MB = (cost_df.loc[sampled, 'est rows'] / cost_df.loc[sampled, 'size MB']).median()
+        memory_per_MB = (cost_df.loc[sampled, 'est memory MB'] / cost_df.loc[sampled, 'size MB']).median()
+    else:
+        rows_per_MB = np.nan
+        memory_per_MB = 1.0
+    cost_df['est rows'] = cost_df['est rows'].fillna(cost_df['size MB'] * rows_per_MB)
+    cost_df['est memory MB'] = cost_df['est memory MB'].fillna(cost_df['size MB'] * memory_per_MB).fillna(0)
+
+    # peak processing memory, including the worker process
+    cost_df['est memory MB'] = worker_memory_MB + memory_factor * cost_df['est memory MB']
+
+    return cost_df.sort_values(['est rows', 'size MB'], ascending=False, kind='mergesort').reset_index(drop=True)
+
+
+def is_transient_error(error):
+    """
+    Check if an exception is a transient I/O error worth retrying, e.g. a network file share timeout.  Missing files,
+    bad paths and permission errors are not transient
+
+    :param error: exception
+    :return: ``True`` if the error is transient
+    """
+    return isinstance(error, OSError) and not isinstance(error, (FileNotFoundError, IsADirectoryError,
+                                                                 NotADirectoryError, PermissionError))
+
+
+def _error_message(error):
+    """
+    Get a one line error message for the failures report
+
+    :param error: exception, including ``SystemExit`` from ``file_io.validate_file()``
+    :return: error message string
+    """
+    if isinstance(error, SystemExit):
+        return 'exit(%s)' % error.code
+    elif isinstance(error, MemoryError):
+        return 'MemoryError, worker memory limit exceeded'
+    else:
+        return ('%s: %s' % (type(error).__name__, error)).replace('\n', ' ')
+
+
+def _call_job(job_function, data_filename, job_args):
+    """
+    Call a job function, catching any failure including ``exit()``
+
+    :param job_function: job function, called as ``job_function(data_filename, *job_args)``
+    :param data_filename: name of the file to process
+    :param job_args: tuple of additional job function arguments
+    :return: (status, result, error message, traceback, transient) tuple, status is 'ok' or 'failed'
+    """
+    try:
+        return 'ok', job_function(data_filename, *job_args), '', '', False
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:
+        return 'failed', None, _error_message(e), traceback.format_exc(), is_transient_error(e)
+
+
+def _run_job(connection, job_function, data_filename, job_args, memory_limit_MB):
+    """
+    Run one job in a worker process and send the outcome, elapsed time and peak memory back to the scheduler.
+
+    A forked worker inherits the resident memory of the scheduler process, so the peak memory sent back is the rise in
+    peak memory above the worker's starting memory
+
+    :param connection: ``multiprocessing`` connection to the scheduler
+    :param job_function: job function, called as ``job_function(data_filename, *job_args)``
+    :param data_filename: name of the file to process
+    :param job_args: tuple of additional job function arguments
+    :param memory_limit_MB: worker address space limit (MB), 0 = no limit
+    """
+    if memory_limit_MB and resource is not None:
+        limit = int(memory_limit_MB * 1e6)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    start_memory_MB = peak_memory_MB()
+    start_time = time.time()
+    status, result, error, error_traceback, transient = _call_job(job_function, data_filename, job_args)
+    connection.send((status, result, error, error_traceback, transient, time.time() - start_time,
+                     peak_memory_MB() - start_memory_MB))
+    connection.close()
+
+
+def run_scheduled_jobs(job_function, cost_df, job_args=(), num_workers=0, memory_budget_MB=0, timeout_secs=0,
+                       memory_limit_MB=0, retries=0, retry_delay_secs=5, progress=None, result_function=None):
+    """
+    Run a job for each file, largest-first, in up to ``num_workers`` worker processes while the estimated memory of the
+    running files stays under the memory budget.
+
+    A failed file does not stop the run.  Exceptions (and ``exit()``) are recorded in the report with their
+    traceback, transient I/O errors are retried, files that run past the timeout are stopped.
+
+    :param job_function: job function, called as ``job_function(data_filename, *job_args)``, must be importable by the
+        worker processes and return a (result, stats) tuple, stats is a dict with optional 'samples', 'windows' and
+        stage times for the report and the progress reporter
+    :param cost_df: file cost dataframe from ``estimate_file_costs()``
+    :param job_args: tuple of additional job function arguments
+    :param num_workers: maximum number of files to run at once, 0 = run each file in this process, one at a time
+    :param memory_budget_MB: estimated memory budget (MB) of the running files, 0 = no limit
+    :param timeout_secs: time limit for each file (seconds), 0 = no limit, requires worker processes
+    :param memory_limit_MB: address space limit of each worker process (MB), 0 = no limit, requires worker processes
+    :param retries: number of times a file is retried after a transient I/O error
+    :param retry_delay_secs: delay before each retry (seconds)
+    :param progress: optional ``cti_progress.ProgressReporter`` object, told as each file starts and finishes
+    :param result_function: optional function called as ``result_function(data_filename, result)`` as each file
+        succeeds, the results are then passed on as they arrive rather than kept
+    :return: (dict of file name: job result, report dataframe) tuple, failed files have no result and the dict is
+        empty if ``result_function`` is given.  The report is
+        ``cost_df`` with the 'status' ('ok', 'failed' or 'timeout'), 'attempts', actual 'samples', 'windows',
+        'elapsed secs' and 'peak memory MB', 'error' and 'traceback' of each file
+    """
+    est_memory_MB = dict(zip(cost_df['file'], cost_df['est memory MB']))
+    results = dict()
+    report_df = cost_df.set_index('file')
+    report_df['status'] = ''
+    report_df['attempts'] = 0
+    report_df['samples'] = np.nan
+    report_df['windows'] = np.nan
+    report_df['elapsed secs'] = np.nan
+    report_df['peak memory MB'] = np.nan
+    report_df['error'] = ''
+    report_df['traceback'] = ''
+
+    # retry transient errors after a delay, returns True if the file was retried
+    retry_times = dict()  # file name: earliest retry time
+
+    def retry_file(data_filename, error, transient):
+        if transient and report_df.loc[data_filename, 'attempts'] <= retries:
+            print('scheduler: %s %s, retrying in %g secs' % (data_filename, error, retry_delay_secs))
+            retry_times[data_filename] = time.time() + retry_delay_secs
+            return True
+        return False
+
+    def start_file(data_filename):
+        report_df.loc[data_filename, 'attempts'] += 1
+        if progress is not None:
+            progress.file_started(data_filename)
+
+    def log_file(data_filename, status, result, error, error_traceback, elapsed_secs, peak_MB):
+        report_df.loc[data_filename, ['status', 'elapsed secs', 'peak memory MB', 'error', 'traceback']] = \
+            [status, elapsed_secs, peak_MB, error, error_traceback]
+        stats = dict()
+        if status == 'ok':
+            job_result, stats = result
+            if result_function is not None:
+                result_function(data_filename, job_result)
+            else:
+                results[data_filename] = job_result
+            report_df.loc[data_filename, 'samples'] = stats.get('samples', np.nan)
+            report_df.loc[data_filename, 'windows'] = stats.get('windows', np.nan)
+            print('scheduler: %s est %.0f rows %.0f MB, actual %.0f rows %.1f secs%s' %
+                  (data_filename, report_df.loc[data_filename, 'est rows'], est_memory_MB[data_filename],
+                   report_df.loc[data_filename, 'samples'], elapsed_secs,
+                   '' if np.isnan(peak_MB) else ' %.0f MB peak' % peak_MB))
+        else:
+            print('scheduler: %s %s after %d attempt(s), %s' %
+                  (data_filename, status.upper(), report_df.loc[data_filename, 'attempts'], error))
+        if progress is not None:
+            progress.file_finished(data_filename, status, stats)
+
+    # time limits and memory limits can only be enforced on worker processes
+    if (timeout_secs or memory_limit_MB) and not num_workers:
+        num_workers = 1
+
+    if not num_workers:
+        for data_filename in cost_df['file']:
+            while True:
+                start_file(data_filename)
+                # peak memory is only per file in-process if the peak can be reset
+                start_memory_MB = peak_memory_MB() if reset_peak_memory() else np.nan
+                start_time = time.time()
+                status, result, error, error_traceback, transient = _call_job(job_function, data_filename,
+                                                                              job_args)
+                if status == 'ok' or not retry_file(data_filename, error, transient):
+                    break
+                time.sleep(retry_delay_secs)
+            log_file(data_filename, status, result, error, error_traceback, time.time() - start_time,
+                     peak_memory_MB() - start_memory_MB)
+        return results, report_df.reset_index()
+
+    pending = list(cost_df['file'])  # largest-first
+    running = dict()  # connection: (process, file name, start time)
+
+    while pending or running:
+        # start the largest waiting files that fit in the memory budget
+        while len(running) < num_workers:
+            running_memory_MB = sum(est_memory_MB[data_filename] for _, data_filename, _ in running.values())
+            fits = [data_filename for data_filename in pending if retry_times.get(data_filename, 0) <= time.time()
+                    and (not memory_budget_MB or not running or
+                         running_memory_MB + est_memory_MB[data_filename] <= memory_budget_MB)]
+            if not fits:
+                break
+            data_filename = fits[0]
+            pending.remove(data_filename)
+            start_file(data_filename)
+            receive_connection, send_connection = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_job, args=(send_connection, job_function, data_filename,
+                                                                     job_args, memory_limit_MB))
+            process.start()
+            send_connection.close()
+            running[receive_connection] = (process, data_filename, time.time())
+
+        # wait for a file to finish, time out or become ready to retry
+        wake_times = [retry_times[data_filename] for data_filename in pending if data_filename in retry_times]
+        if timeout_secs:
+            wake_times += [start_time + timeout_secs for _, _, start_time in running.values()]
+        wait_secs = max(0.0, min(wake_times) - time.time()) if wake_times else None
+
+        if not running:
+            time.sleep(wait_secs or 0)
+            continue
+
+        for connection in multiprocessing.connection.wait(list(running), wait_secs):
+            process, data_filename, start_time = running.pop(connection)
+            try:
+                status, result, error, error_traceback, transient, elapsed_secs, peak_MB = connection.recv()
+            except EOFError:
+                status, result, error, error_traceback, transient, elapsed_secs, peak_MB = \
+                    'failed', None, 'worker process exited unexpectedly (exit code %s)' % process.exitcode, '', \
+                    False, time.time() - start_time, np.nan
+            connection.close()
+            process.join()
+
+            if status != 'ok' and retry_file(data_filename, error, transient):
+                pending.insert(0, data_filename)
+            else:
+                log_file(data_filename, status, result, error, error_traceback, elapsed_secs, peak_MB)
+
+        # stop files that have run past the time limit
+        if timeout_secs:
+            for connection, (process, data_filename, start_time) in list(running.items()):
+                if time.time() - start_time >= timeout_secs:
+                    process.terminate()
+                    process.join()
+                    connection.close()
+                    running.pop(connection)
+                    log_file(data_filename, 'timeout', None, 'stopped after %g secs' % timeout_secs, '',
+                             time.time() - start_time, np.nan)
+
+    return results, report_df.reset_index()
+
+
+# command line arguments for the batch scheduler, shared with cti_process_TBW.py
+scheduler_args = [
+    "parser.add_argument('--file_workers', type=str, help='Number of files processed at once in worker processes, largest files first, 0 = one at a time in-process [default: 0]', default='0')",
+    "parser.add_argument('--memory_budget', type=str, help='Estimated memory budget (MB) of the files processed at once, 0 = no limit [default: 0]', default='0')",
+    "parser.add_argument('--file_timeout_secs', type=str, help='Time limit for each file (seconds), files that run longer are stopped and reported as failures, 0 = no limit [default: 0]', default='0')",
+    "parser.add_argument('--worker_memory_limit', type=str, help='Address space limit of each file worker process (MB), files that run out of memory are reported as failures, 0 = no limit [default: 0]', default='0')",
+    "parser.add_argument('--file_retries', type=str, help='Number of times a file is retried after a transient I/O error [default: 2]', default='2')",
+]
+
+scheduler_options = ["options.file_workers = args.file_workers",
+                     "options.memory_budget = args.memory_budget",
+                     "options.file_timeout_secs = args.file_timeout_secs",
+                     "options.worker_memory_limit = args.worker_memory_limit",
+                     "options.file_retries = args.file_retries",
+                     ]
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_signal_plan.py
+==================
+
+Compiled signal mapping plan, created once from a data source profile signal table and reused for every data file
+
+Signal mappings with a numeric scale or a ``degF->degC`` / ``degC->degF`` conversion are linear, destination =
+(source + offset) * scale, and are applied to all source signals at once as one column-block add and multiply.
+
+Derived channels are declared in the profile by a Signal Source that starts with ``=``, followed by a vectorized
+expression of source signals and previously mapped destination signals.  Names that are not valid Python identifiers
+are quoted with backticks, and the optional Signal Scale multiplies the result, for example:
+
+.. code-block:: text
+
+    Signal Destination      Signal Source                                   Signal Scale
+    Tailpipe NOX g/s        =NOX_ppm * `Exh Flow kg/s` * 0.001587
+
+Expressions may use ``where``, ``sqrt``, ``exp``, ``log``, ``log10``, ``abs``, ``sin`` and ``cos``, and are evaluated
+with ``numexpr``, if installed, to avoid intermediate temporary arrays, else with NumPy.
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import re
+import numpy as np
+import pandas as pd
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# functions available to derived channel expressions, numexpr supports the same names natively
+expression_functions = {'where': np.where, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'log10': np.log10,
+                        'abs': np.abs, 'sin': np.sin, 'cos': np.cos}
+
+# linear (offset, scale) equivalents of temperature conversion scale strings, destination = (source + offset) * scale
+linear_conversions = {'degF->degC': (-32.0, 5 / 9), 'degC->degF': (32.0 * 5 / 9, 9 / 5)}
+
+
+class SignalMappingPlan(object):
+    """
+    Compiled signal mapping plan: linear source signal scaling plus derived channel expressions
+
+    """
+    def __init__(self, destination_signal_list, source_signal_list, source_signal_scale):
+        """
+        Compile ``SignalMappingPlan`` object from data source profile signal table columns
+
+        .. warning:: Exception raised on invalid scale or expression
+
+        :param destination_signal_list: list of destination (common-name) signals
+        :param source_signal_list: list of source signals or ``=`` derived channel expressions
+        :param source_signal_scale: list of numeric scale factors or 'degF->degC' or 'degC->degF'
+        """
+        self.linear_destinations = []
+        self.linear_sources = []
+        linear_offsets = []
+        linear_scales = []
+        self.derived_destinations = []
+        self.derived_expressions = []
+        self.derived_scales = []
+        self._compiled = None
+
+        for destination_signal, source_signal, source_signal_scale in zip(destination_signal_list,
+                                                                          source_signal_list, source_signal_scale):
+            if destination_signal == '' or source_signal == '':
+                continue
+
+            if str(source_signal).startswith('='):
+                self.derived_destinations.append(destination_signal)
+                self.derived_expressions.append(source_signal[1:].strip())
+                if pd.isnull(source_signal_scale) or source_signal_scale == '':
+                    self.derived_scales.append(1.0)
+                else:
+                    self.derived_scales.append(float(source_signal_scale))
+            else:
+                if source_signal_scale in linear_conversions:
+                    offset, scale = linear_conversions[source_signal_scale]
+                else:
+                    try:
+                        offset, scale = 0.0, float(source_signal_scale)
+                    except (TypeError, ValueError):
+                        raise Exception('Invalid signal scale "%s" for %s' % (source_signal_scale, destination_signal))
+                self.linear_destinations.append(destination_signal)
+                self.linear_sources.append(source_signal)
+                linear_offsets.append(offset)
+                linear_scales.append(scale)
+
+        self.linear_offsets = np.array(linear_offsets)
+        self.linear_scales = np.array(linear_scales)
+
+        self._compile()
+
+    def __getstate__(self):
+        """
+        Drop compiled expressions when copying or pickling (e.g. for worker processes), they are recompiled on use
+
+        :return: object state dict
+        """
+        state = self.__dict__.copy()
+        state['_compiled'] = None
+        return state
+
+    def _compile(self):
+        """
+        Compile derived channel expressions, backtick-quoted names are replaced by generated identifiers
+
+        .. warning:: Exception raised on invalid expression
+        """
+        self._compiled = []
+        for destination_signal, expression in zip(self.derived_destinations, self.derived_expressions):
+            quoted_names = dict()  # signal name: generated identifier
+            expression_str = re.sub(r'`([^`]*)`',
+                                    lambda match: quoted_names.setdefault(match.group(1),
+                                                                          '_signal_%d' % len(quoted_names)),
+                                    expression)
+            names = {identifier: name for name, identifier in quoted_names.items()}
+
+            try:
+                code = compile(expression_str, destination_signal, 'eval')
+            except SyntaxError:
+                raise Exception('Invalid derived signal expression "%s" for %s' % (expression, destination_signal))
+
+            # remaining names are plain identifiers, referencing signals of the same name
+            for name in code.co_names:
+                if name not in names and name not in expression_functions:
+                    names[name] = name
+
+            self._compiled.append((expression_str, code, names))
+
+    def required_source_signals(self):
+        """
+        Get the source signals needed by each destination signal, signals produced by the plan itself are excluded
+
+        :return: dict of destination signal: list of source signals
+        """
+        if self._compiled is None:
+            self._compile()
+
+        required = dict()
+        for destination_signal, source_signal in zip(self.linear_destinations, self.linear_sources):
+            required[destination_signal] = [source_signal]
+        for destination_signal, (expression_str, code, names) in zip(self.derived_destinations, self._compiled):
+            required[destination_signal] = [signal for signal in names.values() if signal not in required]
+
+        return required
+
+    def apply(self, df):
+        """
+        Apply signal mapping plan to a source dataframe
+
+        :param df: pandas dataframe of numeric source signals
+        :return: dataframe with scaled and derived destination signals added
+        """
+        values = self.evaluate(df)
+
+        if not values:
+            return df
+
+        mapped_df = pd.DataFrame(values, index=df.index)
+        return pd.concat([df.drop(columns=[c for c in mapped_df.columns if c in df.columns]), mapped_df], axis=1)
+
+    def evaluate(self, df):
+        """
+        Calculate the scaled and derived destination signals of a source dataframe without adding them to it
+
+        :param df: pandas dataframe of numeric source signals
+        :return: dict of destination signal: numpy array, in plan order
+        """
+        if self._compiled is None:
+            self._compile()
+
+        num_rows = len(df)
+        values = dict()
+
+        # linear scaling as one block operation, one contiguous row per signal
+        if self.linear_destinations:
+            block = np.full((len(self.linear_sources), num_rows), np.nan)
+            for i, source_signal in enumerate(self.linear_sources):
+                if source_signal in df.columns:
+                    block[i] = df[source_signal].values
+                else:
+                    print('WARNING::: source signal %s not present in source data, using NaN :::WARNING' %
+                          source_signal)
+            block += self.linear_offsets[:, np.newaxis]
+            block *= self.linear_scales[:, np.newaxis]
+            for i, destination_signal in enumerate(self.linear_destinations):
+                values[destination_signal] = block[i]
+
+        # derived channels, in declared order so later expressions may use earlier results
+        for destination_signal, scale, (expression_str, code, names) in zip(self.derived_destinations,
+                                                                            self.derived_scales, self._compiled):
+            local_dict = dict()
+            missing = []
+            for name, signal in names.items():
+                if signal in values:
+                    local_dict[name] = values[signal]
+                elif signal in df.columns:
+                    local_dict[name] = df[signal].values.astype(float)
+                else:
+                    missing.append(signal)
+
+            if missing:
+                print('WARNING::: source signal(s) %s not present in source data, %s is NaN :::WARNING' %
+                      (', '.join(missing), destination_signal))
+                result = np.full(num_rows, np.nan)
+            elif numexpr is not None:
+                result = numexpr.evaluate(expression_str, local_dict=local_dict)
+            else:
+                result = eval(code, dict(expression_functions), local_dict)
+
+            values[destination_signal] = np.broadcast_to(result * scale, (num_rows,)).astype(float)
+
+        return values
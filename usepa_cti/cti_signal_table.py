@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_signal_table.py
+===================
+
+Columnar signal table, a lightweight container of named, contiguous NumPy arrays for the time-based window hot path
+
+Ingestion places each prepared signal in the table once, the window engine reads the arrays directly and selecting
+or adding signals never copies the other signals.  Pandas is only used at the result-reporting boundary, see
+``to_dataframe()``.
+
+.. code-block:: python
+
+    # example usage:
+    signals = SignalTable({'Time secs': time_secs, 'Power hp': power_hp})
+    signals['unity'] = np.ones(len(signals))
+    window_signals = signals.select(['Time secs', 'unity'])  # shares the arrays, no copies
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+class SignalTable(object):
+    """
+    Ordered collection of equal-length, one-dimensional float NumPy arrays accessed by signal name
+    """
+    def __init__(self, signals=None, columns=None):
+        """
+        Create ``SignalTable`` object
+
+        :param signals: optional dict of signal name: array-like, pandas dataframe or ``SignalTable``, numeric float
+            arrays and dataframe columns are used without copying
+        :param columns: optional list of signal names to take from ::signals, default is all
+        """
+        self._signals = OrderedDict()
+        self._num_rows = None
+
+        if signals is not None:
+            if columns is None:
+                columns = list(signals.columns) if isinstance(signals, (pd.DataFrame, SignalTable)) \
+                    else list(signals.keys())
+            for signal_name in columns:
+                self[signal_name] = signals[signal_name]
+
+    @property
+    def columns(self):
+        """
+        :return: list of signal names, in the order they were added
+        """
+        return list(self._signals.keys())
+
+    def __len__(self):
+        return self._num_rows or 0
+
+    def __contains__(self, signal_name):
+        return signal_name in self._signals
+
+    def __iter__(self):
+        return iter(self._signals)
+
+    def __getitem__(self, signal_name):
+        return self._signals[signal_name]
+
+    def __setitem__(self, signal_name, values):
+        """
+        Add or replace a signal, scalars are broadcast to the table length without allocating a full array
+
+        :param signal_name: signal name
+        :param values: array-like of length ``len(self)``, or scalar
+        """
+        if np.ndim(values) == 0:
+            if self._num_rows is None:
+                raise Exception('cannot add scalar signal %s to an empty signal table' % signal_name)
+            values = np.broadcast_to(np.float64(values), (self._num_rows,))
+        else:
+            if isinstance(values, (pd.Series, pd.Index)):
+                values = values.to_numpy()
+            values = np.asarray(values)
+            if values.dtype != np.float64:
+                values = values.astype(np.float64)
+            if values.ndim != 1:
+                raise Exception('signal %s must be one-dimensional' % signal_name)
+            if self._num_rows is None:
+                self._num_rows = len(values)
+            elif len(values) != self._num_rows:
+                raise Exception('signal %s has %d rows, expecting %d' % (signal_name, len(values), self._num_rows))
+
+        self._signals[signal_name] = values
+
+    def __delitem__(self, signal_name):
+        del self._signals[signal_name]
+
+    def keys(self):
+        return self._signals.keys()
+
+    def items(self):
+        return self._signals.items()
+
+    def select(self, columns):
+        """
+        Get a new table of some signals, the arrays are shared with this table
+
+        :param columns: list of signal names
+        :return: ``SignalTable`` object
+        """
+        missing_signals = [c for c in columns if c not in self._signals]
+        if missing_signals:
+            raise Exception('missing signals %s' % missing_signals)
+
+        return SignalTable(self, columns)
+
+    def copy(self):
+        """
+        Get a shallow copy, signals may be replaced in the copy without changing this table
+
+        :return: ``SignalTable`` object
+        """
+        return SignalTable(self)
+
+    def nbytes(self):
+        """
+        :return: memory used by the signal arrays (bytes), broadcast scalar signals use none
+        """
+        return sum(v.nbytes for v in self._signals.values() if v.strides != (0,))
+
+    def to_dataframe(self, columns=None):
+        """
+        Convert to a pandas dataframe, for reporting
+
+        :param columns: optional list of signal names, default is all
+        :return: pandas dataframe
+        """
+        if columns is None:
+            columns = self.columns
+
+        return pd.DataFrame(OrderedDict((c, np.array(self._signals[c])) for c in columns))
+
+    @classmethod
+    def from_dataframe(cls, df, columns=None):
+        """
+        Create a table from the numeric columns of a dataframe
+
+        :param df: pandas dataframe
+        :param columns: optional list of column names, default is all numeric columns
+        :return: ``SignalTable`` object
+        """
+        if columns is None:
+            columns = list(df.select_dtypes(include=[np.number]).columns)
+
+        return cls(df, columns)
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_sketch.py
+=============
+
+Mergeable streaming quantile sketches (t-digest) for fleet-level summary statistics
+
+A sketch is updated with each file's results as the file finishes, so fleet box plots and percentile tables don't
+need every file's results in memory.  Sketches are saved as JSON and can be merged across runs and shards.
+
+Sketches are exact (identical to ``numpy.percentile()`` linear interpolation) until more than ``compression`` values
+have been added, after which values are merged into weighted centroids with a rank error that is smallest near the
+tails.
+
+.. code-block:: bash
+
+    # merge fleet sketches from several output folders and write a combined percentile table and box plot
+    python cti_sketch.py --source_path shard_sketches --include *_fleet_sketches*.json --output_path merged
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import json
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+sketch_file_version = 1
+
+
+class QuantileSketch(object):
+    """
+    Merging t-digest quantile sketch
+
+    """
+    def __init__(self, compression=200):
+        """
+        Create empty ``QuantileSketch`` object
+
+        :param compression: t-digest compression, larger values keep more centroids and give smaller rank errors
+        """
+        self.compression = compression
+        self.count = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self._buffer = []
+
+    def update(self, values):
+        """
+        Add one or more values to the sketch, NaN values are ignored
+
+        :param values: scalar or array of values
+        """
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.count += len(values)
+            self.sum += values.sum()
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            self._buffer.append(values)
+            if sum(len(b) for b in self._buffer) > 5 * self.compression:
+                self._compress()
+
+    def merge(self, other):
+        """
+        Merge another sketch into this sketch
+
+        :param other: ``QuantileSketch`` to merge
+        :return: self
+        """
+        other._compress()
+        if other.count:
+            self.count += other.count
+            self.sum += other.sum
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self.means = np.concatenate([self.means, other.means])
+            self.weights = np.concatenate([self.weights, other.weights])
+            self._compress()
+        return self
+
+    def _k(self, q):
+        """
+        t-digest k1 scale function, centroids are limited to one k unit
+
+        :param q: quantile(s) 0..1
+        :return: k scale value(s)
+        """
+        return self.compression / (2 * np.pi) * np.arcsin(2 * np.clip(q, 0, 1) - 1)
+
+    def _k_inverse(self, k):
+        """
+        Inverse of the k1 scale function
+
+        :param k: k scale value(s)
+        :return: quantile(s) 0..1
+        """
+        return (np.sin(np.minimum(k * 2 * np.pi / self.compression, np.pi / 2)) + 1) / 2
+
+    def _compress(self):
+        """
+        Merge buffered values and centroids, sorted by mean, into centroids of at most one k scale unit
+        """
+        if self._buffer:
+            self.means = np.concatenate([self.means] + self._buffer)
+            self.weights = np.concatenate([self.weights] + [np.ones(len(b)) for b in self._buffer])
+            self._buffer = []
+
+        order = np.argsort(self.means, kind='stable')
+        means = self.means[order]
+        weights = self.weights[order]
+
+        if len(means) <= self.compression:
+            # keep everything, sketch is exact
+            self.means, self.weights = means, weights
+            return
+
+        total_weight = weights.sum()
+        new_means = []
+        new_weights = []
+        weight_so_far = 0.0
+        q_limit = self._k_inverse(self._k(0) + 1)
+        current_mean, current_weight = means[0], weights[0]
+        for mean, weight in zip(means[1:], weights[1:]):
+            if (weight_so_far + current_weight + weight) / total_weight <= q_limit:
+                current_weight += weight
+                current_mean += (mean - current_mean) * weight / current_weight
+            else:
+                new_means.append(current_mean)
+                new_weights.append(current_weight)
+                weight_so_far += current_weight
+                q_limit = self._k_inverse(self._k(weight_so_far / total_weight) + 1)
+                current_mean, current_weight = mean, weight
+        new_means.append(current_mean)
+        new_weights.append(current_weight)
+
+        self.means = np.array(new_means)
+        self.weights = np.array(new_weights)
+
+    def quantile(self, q):
+        """
+        Estimate quantile(s), using linear interpolation between centroid ranks.  Exact (same as
+        ``numpy.percentile()``) while all centroids are single values
+
+        :param q: scalar or array of quantiles 0..1
+        :return: scalar or array of quantile estimates, NaN for an empty sketch
+        """
+        self._compress()
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+
+        # rank of each centroid center, for single value centroids rank = sorted index
+        centers = np.cumsum(self.weights) - self.weights + (self.weights - 1) / 2
+        means = self.means
+        if centers[0] > 0:
+            centers = np.concatenate([[0], centers])
+            means = np.concatenate([[self.min], means])
+        if centers[-1] < self.count - 1:
+            centers = np.concatenate([centers, [self.count - 1]])
+            means = np.concatenate([means, [self.max]])
+
+        return np.interp(np.asarray(q) * (self.count - 1), centers, means)
+
+    def percentile(self, pct):
+        """
+        Estimate percentile(s)
+
+        :param pct: scalar or array of percentiles 0..100
+        :return: scalar or array of percentile estimates
+        """
+        return self.quantile(np.asarray(pct) / 100)
+
+    def mean(self):
+        """
+        :return: mean of all values added, NaN for an empty sketch
+        """
+        return self.sum / self.count if self.count else np.nan
+
+    def to_dict(self):
+        """
+        :return: JSON-serializable dict of the sketch state
+        """
+        self._compress()
+        return {'compression': self.compression, 'count': int(self.count), 'sum': float(self.sum),
+                'min': float(self.min) if self.count else None, 'max': float(self.max) if self.count else None,
+                'means': self.means.tolist(), 'weights': self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+        """
+        Create ``QuantileSketch`` from a dict made by ``to_dict()``
+
+        :param sketch_dict: dict of the sketch state
+        :return: ``QuantileSketch`` object
+        """
+        sketch = cls(sketch_dict['compression'])
+        sketch.count = sketch_dict['count']
+        sketch.sum = sketch_dict['sum']
+        if sketch.count:
+            sketch.min = sketch_dict['min']
+            sketch.max = sketch_dict['max']
+        sketch.means = np.array(sketch_dict['means'], dtype=float)
+        sketch.weights = np.array(sketch_dict['weights'], dtype=float)
+        return sketch
+
+
+def update_sketches(sketches, file_results, compression=200):
+    """
+    Update fleet sketches with one file's numeric results, sketches are created for new result columns
+
+    :param sketches: ``OrderedDict`` of result column name: ``QuantileSketch``, modified in place
+    :param file_results: pandas dataframe (one row) or dict of one file's results
+    :param compression: compression for new sketches
+    :return: sketches
+    """
+    if isinstance(file_results, pd.DataFrame):
+        file_results = file_results.iloc[0].to_dict()
+
+    for column, value in file_results.items():
+        if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+            if column not in sketches:
+                sketches[column] = QuantileSketch(compression)
+            sketches[column].update(value)
+
+    return sketches
+
+
+def merge_sketches(sketches, other_sketches):
+    """
+    Merge one set of fleet sketches into another
+
+    :param sketches: ``OrderedDict`` of result column name: ``QuantileSketch``, modified in place
+    :param other_sketches: ``OrderedDict`` of result column name: ``QuantileSketch`` to merge
+    :return: sketches
+    """
+    for column, sketch in other_sketches.items():
+        if column in sketches:
+            sketches[column].merge(sketch)
+        else:
+            sketches[column] = QuantileSketch(sketch.compression).merge(sketch)
+
+    return sketches
+
+
+def save_sketches(filename, sketches):
+    """
+    Save fleet sketches to a JSON file
+
+    :param filename: path and file name of the sketch file to write
+    :param sketches: ``OrderedDict`` of result column name: ``QuantileSketch``
+    """
+    with open(filename, 'w') as f:
+        json.dump({'sketch_file_version': sketch_file_version,
+                   'sketches': OrderedDict((column, sketch.to_dict()) for column, sketch in sketches.items())}, f)
+
+
+def load_sketches(filename):
+    """
+    Load fleet sketches from a JSON file
+
+    :param filename: path and file name of the sketch file to read
+    :return: ``OrderedDict`` of result column name: ``QuantileSketch``
+    """
+    with open(filename, 'r') as f:
+        sketch_file = json.load(f, object_pairs_hook=OrderedDict)
+
+    return OrderedDict((column, QuantileSketch.from_dict(sketch_dict))
+                       for column, sketch_dict in sketch_file['sketches'].items())
+
+
+def sketch_percentile_table(sketches, pctiles):
+    """
+    Generate fleet percentile table from sketches
+
+    :param sketches: ``OrderedDict`` of result column name: ``QuantileSketch``
+    :param pctiles: list of percentiles 0..100
+    :return: pandas dataframe, one row per result column with count, mean and percentile columns
+    """
+    table_df = pd.DataFrame(index=list(sketches.keys()))
+    table_df.index.name = 'result'
+    table_df['count'] = [sketch.count for sketch in sketches.values()]
+    table_df['mean'] = [sketch.mean() for sketch in sketches.values()]
+    pctile_values = np.array([sketch.percentile(pctiles) for sketch in sketches.values()]).reshape(-1, len(pctiles))
+    for i, pctile in enumerate(pctiles):
+        table_df['%g pctile' % pctile] = pctile_values[:, i]
+
+    return table_df
+
+
+def sketch_boxplot_stats(sketch, label):
+    """
+    Generate ``matplotlib`` ``Axes.bxp()`` box statistics from a sketch, whiskers span the full range of values
+
+    :param sketch: ``QuantileSketch``
+    :param label: box label
+    :return: dict of box statistics
+    """
+    q1, median, q3 = sketch.percentile([25, 50, 75])
+    return {'label': label, 'mean': sketch.mean(), 'med': median, 'q1': q1, 'q3': q3,
+            'whislo': sketch.min, 'whishi': sketch.max, 'fliers': []}
+
+
+def plot_sketch_boxplot(sketches, columns, ylabel_str, title_str, label_names=None):
+    """
+    Plot fleet box plot of the given sketch columns, box labels include the mean and median values
+
+    :param sketches: ``OrderedDict`` of result column name: ``QuantileSketch``
+    :param columns: list of sketch columns to plot, empty sketches are skipped
+    :param ylabel_str: y-axis label
+    :param title_str: plot title
+    :param label_names: optional list of box label names, one per column, defaults to the column names
+    :return: (figure, axis, bxp artist dict) tuple
+    """
+    if label_names is None:
+        label_names = columns
+
+    stats = []
+    for column, label_name in zip(columns, label_names):
+        sketch = sketches[column]
+        if sketch.count > 0:
+            label = '%s\n%0.3f Avg\n%0.3f Med' % (label_name, sketch.mean(), sketch.percentile(50))
+            stats.append(sketch_boxplot_stats(sketch, label))
+
+    fig = plt.figure()
+    ax1 = plt.gca()
+    boxplot_dict = ax1.bxp(stats, showmeans=True)
+    ax1.set_ylabel(ylabel_str)
+    ax1.set_title(title_str, fontsize=9)
+    if stats:
+        ax1.legend(handles=[boxplot_dict['medians'][0], boxplot_dict['means'][0]], labels=['median', 'mean'])
+    plt.grid()
+
+    return fig, ax1, boxplot_dict
+
+
+# entry point for script when called from command line
+if __name__ == '__main__':
+    import os
+    import cti_common as cti
+
+    additional_args = [
+        "parser.set_defaults(include='*_fleet_sketches*.json', exclude='', profile='')",
+    ]
+
+    # process common (see cti_common.py) command line options
+    options = cti.handle_command_line_options(
+        app_description='Fleet Sketch Merge, combines fleet quantile sketches from multiple runs or shards',
+        additional_args=additional_args)
+
+    sketches = OrderedDict()
+    for sketch_filename in sorted(options.file_list):
+        merge_sketches(sketches, load_sketches(sketch_filename))
+
+    merged_filename = options.output_path + os.sep + 'merged_fleet_sketches.json'
+    save_sketches(merged_filename, sketches)
+    print('wrote %s' % merged_filename)
+
+    table_filename = options.output_path + os.sep + 'merged_fleet_percentiles.csv'
+    sketch_percentile_table(sketches, np.arange(0, 105, 5).tolist()).to_csv(table_filename)
+    print('wrote %s' % table_filename)
+
+    gphphr_columns = [c for c in sketches if ('g/hp-hr' in c) and ('pctile' not in c) and ('CI' not in c)]
+    plot_sketch_boxplot(sketches, gphphr_columns, 'Bin NOx (g/hp-hr)',
+                        'Bin Brake Specific NOx Boxplot, %d files' % max([0] + [sketches[c].count for c in gphphr_columns]))
+    plt.savefig(options.output_path + os.sep + 'merged_NOx_bin_plt', orientation='landscape')
+    print('wrote %s' % (options.output_path + os.sep + 'merged_NOx_bin_plt.png'))
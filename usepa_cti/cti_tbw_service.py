@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+"""
+cti_tbw_service.py
+==================
+
+Local time-based window service, keeps a pool of warm worker processes with the processing modules already imported
+and data source profiles already loaded, so ad-hoc requests don't pay the start-up cost of ``cti_process_TBW.py``
+
+The service listens on localhost only.  Requests are JSON, posted to ``/tbw``, and name a data file plus optional
+time-based window settings, using the ``cti_process_TBW.py`` command line option names.  Results are returned as JSON.
+
+.. code-block:: bash
+
+    python cti_tbw_service.py --profile sample_data/cti_data_source_profile.xlsx --workers 2
+
+.. code-block:: python
+
+    # example request:
+    import cti_tbw_service as service
+    response = service.tbw_request('sample_data/HHD_01_5x0.csv',
+                                   {'hdiut': True, 'window_step_secs': 1, 'hp_cutpoints_pct': '8,25'})
+    print(response['summary'])
+
+Up to ``--workers`` requests are processed at once, up to ``--max_queue`` more wait in line and any others are
+refused with HTTP status 503 so the client can retry later.  ``GET /status`` returns the service counters.
+
+Requests must have a ``Content-Type: application/json`` header and the service token in an ``X-TBW-Token`` header.
+The token is generated when the service starts and is written to a token file only the user can read,
+``~/.cti_tbw_service_<port>.token`` by default, where ``tbw_request()`` finds it.  Data files and profiles must be in
+one of the ``--data_roots`` folders and output paths in the ``--output_root`` folder.
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import hmac
+import secrets
+import argparse
+import threading
+import contextlib
+import traceback
+import urllib.request
+import urllib.error
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+default_port = 8765
+
+log_requests = False  # if True then requests are logged to the console, set by the --verbose command line option
+
+token_header = 'X-TBW-Token'
+
+# per-worker data source profile cache, by (absolute profile filename, modification time)
+_profile_cache = dict()
+
+
+def _worker_init(profile_filename):
+    """
+    Worker process initializer, imports the processing modules and loads the default data source profile
+
+    :param profile_filename: default data source profile filename
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # no display in worker processes
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import cti_process_TBW
+        if profile_filename:
+            _get_data_profile(profile_filename)
+
+
+def _worker_ready(worker_num):
+    """
+    No-op job used to start the worker processes when the service starts
+
+    :param worker_num: worker number, unused
+    :return: worker process id
+    """
+    return os.getpid()
+
+
+def _get_data_profile(profile_filename):
+    """
+    Get data source profile from the worker cache, the profile is reloaded if the file has changed
+
+    :param profile_filename: data source profile filename
+    :return: ``DataSourceProfile`` object
+    """
+    import cti_data_source_profile as omdsp
+
+    key = (os.path.abspath(profile_filename), os.path.getmtime(profile_filename))
+    if key not in _profile_cache:
+        _profile_cache[key] = omdsp.DataSourceProfile(profile_filename)
+
+    return _profile_cache[key]
+
+
+def default_token_filename(port=default_port):
+    """
+    Get the default service token file name for a port
+
+    :param port: service TCP port number
+    :return: token file name, in the user's home folder
+    """
+    return os.path.join(os.path.expanduser('~'), '.cti_tbw_service_%d.token' % port)
+
+
+def _path_within(path, roots):
+    """
+    Check if a path is inside one of the root folders, after resolving relative paths and links
+
+    :param path: file or folder name
+    :param roots: list of root folder names
+    :return: ``True`` if ::path is inside one of ::roots
+    """
+    path = os.path.realpath(path)
+    for root in roots:
+        root = os.path.realpath(root)
+        if os.path.commonpath([path, root]) == root:
+            return True
+    return False
+
+
+def _json_value(value):
+    """
+    Convert a result value to a JSON-compatible value, non-finite numbers become ``None``
+
+    :param value: value to convert
+    :return: JSON-compatible value
+    """
+    if isinstance(value, (np.integer, np.floating, float)):
+        value = float(value)
+        return value if np.isfinite(value) else None
+    elif isinstance(value, np.bool_):
+        return bool(value)
+    else:
+        return value
+
+
+def request_options(request, default_profile_filename):
+    """
+    Build runtime options for a service request, request settings use the ``cti_process_TBW.py`` command line
+    option names and defaults
+
+    .. warning:: Exception raised on invalid request settings
+
+    :param request: request dict with 'file' and optional 'profile' and 'options' dict
+    :param default_profile_filename: service default data source profile filename
+    :return: runtime options object
+    """
+    import cti_common as cti
+    import cti_process_TBW as tbw
+
+    # settings to command line argument list, flags are set by any true value
+    argv = []
+    for option, value in request.get('options', dict()).items():
+        if isinstance(value, bool):
+            if value:
+                argv.append('--' + option)
+        else:
+            if isinstance(value, (list, tuple)):
+                value = ','.join(str(v) for v in value)
+            argv += ['--' + option, str(value)]
+
+    parser = argparse.ArgumentParser(prog='tbw service request', add_help=False)
+    for addargs in tbw.tbw_window_args + tbw.tbw_bin_args:
+        eval(addargs)
+
+    with contextlib.redirect_stderr(io.StringIO()) as parser_errors:
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit:
+            raise Exception('invalid request options: %s' % parser_errors.getvalue().strip().split('\n')[-1])
+
+    options = cti.runtime_options()
+    for addoptions in tbw.tbw_window_options + tbw.tbw_bin_options:
+        exec(addoptions)
+    options.reuse_output_folder = True  # the service never deletes output folders
+
+    profile_filename = request.get('profile') or default_profile_filename
+    if not profile_filename:
+        raise Exception('no data source profile')
+    options.profile_filename = profile_filename
+    options.data_profile = _get_data_profile(profile_filename)
+
+    tbw.process_window_options(options)
+
+    return options
+
+
+def service_job(request, default_profile_filename):
+    """
+    Process one service request in a worker process
+
+    :param request: request dict with 'file', optional 'profile', optional 'options' dict of ``cti_process_TBW.py``
+        command line settings and optional 'output_path' to also write the usual plots and tables
+    :param default_profile_filename: service default data source profile filename
+    :return: response dict
+    """
+    import cti_file_io as file_io
+    import cti_process_TBW as tbw
+
+    start_time = time.time()
+    response = {'status': 'error', 'file': request.get('file'), 'worker pid': os.getpid()}
+
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            data_filename = request['file']
+            if not file_io.file_exists(data_filename):
+                raise Exception("couldn't access file %s" % data_filename)
+
+            options = request_options(request, default_profile_filename)
+            options, data_profile = tbw.get_file_options(data_filename, options)
+
+            signals, data_rate_Hz, cycle_totals, time_align_lags = tbw.load_tbw_signals(data_filename, options,
+                                                                                        data_profile)
+
+            results = tbw.tbw_evaluate(signals, options, data_profile.engine_power_rating_hp, data_rate_Hz,
+                                       data_filename, cycle_totals, time_align_lags)
+
+            if results is None:
+                raise Exception('cycle work is NaN or negative')
+
+            if request.get('output_path'):
+                output_folder = request['output_path'] + os.sep + tbw.get_tbw_folder_name(options)
+                staging_folder = tbw.get_staging_folder(output_folder)
+                tbw.write_tbw_outputs(results, None if options.chunk_rows else signals, data_filename,
+                                      staging_folder, options, data_profile)
+                file_io.promote_folder(staging_folder, output_folder)
+                tbw.remove_staging_folder(staging_folder)
+                response['output folder'] = output_folder
+
+        response['status'] = 'ok'
+        response['engine_power_rating_hp'] = _json_value(data_profile.engine_power_rating_hp)
+        response['work_hphr'] = _json_value(results.work_hphr)
+        response['nox_g'] = _json_value(results.nox_g)
+        response['nox_gphphr'] = _json_value(results.nox_gphphr)
+        response['num windows'] = len(results.window_df)
+        response['summary'] = {k: _json_value(v) for k, v in results.summary_df.iloc[0].items()}
+    except Exception as e:
+        response['error'] = str(e)
+        response['log'] = log.getvalue() + traceback.format_exc()
+
+    response['elapsed secs'] = time.time() - start_time
+
+    return response
+
+
+class TBWService(object):
+    """
+    Warm worker process pool with request queueing and concurrency limits
+    """
+    def __init__(self, profile_filename='', num_workers=2, max_queue=8, timeout_secs=0, data_roots=('.',),
+                 output_root='output', token=None):
+        """
+        Create ``TBWService`` object and start the worker processes
+
+        :param profile_filename: default data source profile filename, used when a request does not name one
+        :param num_workers: number of worker processes, the maximum number of requests processed at once
+        :param max_queue: maximum number of requests waiting for a worker, others are refused
+        :param timeout_secs: request timeout (seconds), 0 = no timeout.  A timed out request is answered right away,
+            but its worker is not free until the job finishes
+        :param data_roots: list of folders that request data files and profiles must be in
+        :param output_root: folder that request output paths must be in
+        :param token: service token required by HTTP requests, ``None`` to generate a random token
+        """
+        if profile_filename:
+            profile_filename = os.path.abspath(profile_filename)
+        self.profile_filename = profile_filename
+        self.data_roots = [os.path.realpath(root) for root in data_roots]
+        self.output_root = os.path.realpath(output_root)
+        self.token = token or secrets.token_urlsafe(32)
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.timeout_secs = timeout_secs
+
+        self.slots = threading.BoundedSemaphore(num_workers + max_queue)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.refused = 0
+        self.start_time = time.time()
+
+        self.executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_worker_init,
+                                            initargs=(profile_filename,))
+
+        # start and warm up all workers now rather than on the first requests
+        self.worker_pids = sorted(set(self.executor.map(_worker_ready, range(num_workers))))
+
+    def check_request(self, request):
+        """
+        Check that a request only reads from the data roots and only writes to the output root
+
+        :param request: request dict, see ``service_job()``
+        :return: error message, or '' if the request is allowed
+        """
+        for key in ['file', 'profile']:
+            if request.get(key) and not _path_within(str(request[key]), self.data_roots):
+                return '%s %s is not in the service data folders' % (key, request[key])
+
+        if request.get('output_path') and not _path_within(str(request['output_path']), [self.output_root]):
+            return 'output_path %s is not in the service output folder' % request['output_path']
+
+        return ''
+
+    def submit(self, request):
+        """
+        Process a request in the worker pool, waits for the result
+
+        :param request: request dict, see ``service_job()``
+        :return: (HTTP status, response dict) tuple
+        """
+        error = self.check_request(request)
+        if error:
+            with self.lock:
+                self.refused += 1
+            return 403, {'status': 'error', 'file': request.get('file'), 'error': error}
+
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.refused += 1
+            return 503, {'status': 'busy', 'error': 'request queue is full, retry later'}
+
+        try:
+            with self.lock:
+                self.pending += 1
+            future = self.executor.submit(service_job, request, self.profile_filename)
+            try:
+                response = future.result(timeout=self.timeout_secs or None)
+            except TimeoutError:
+                future.cancel()
+                response = {'status': 'timeout', 'file': request.get('file'),
+                            'error': 'request timed out after %g secs' % self.timeout_secs}
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+
+        with self.lock:
+            if response['status'] == 'ok':
+                self.completed += 1
+            else:
+                self.failed += 1
+
+        return {'ok': 200, 'error': 400, 'timeout': 504}[response['status']], response
+
+    def status(self):
+        """
+        Get service counters
+
+        :return: status dict
+        """
+        with self.lock:
+            return {'status': 'ok', 'profile': self.profile_filename, 'workers': self.num_workers,
+                    'worker pids': self.worker_pids, 'max queue': self.max_queue,
+                    'running': min(self.pending, self.num_workers),
+                    'queued': max(0, self.pending - self.num_workers),
+                    'completed': self.completed, 'failed': self.failed, 'refused': self.refused,
+                    'uptime secs': time.time() - self.start_time}
+
+    def shutdown(self):
+        """
+        Stop the worker processes
+        """
+        self.executor.shutdown(wait=True)
+
+
+class TBWRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler, ``POST /tbw`` processes a request and ``GET /status`` returns the service counters
+    """
+    service = None  # ``TBWService`` object, set by ``run_service()``
+
+    def _send_json(self, http_status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(http_status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        """
+        Check the request's service token, an error response is sent if it's missing or wrong
+
+        :return: ``True`` if the request has the service token
+        """
+        if hmac.compare_digest(self.headers.get(token_header, ''), self.service.token):
+            return True
+
+        self._send_json(403, {'status': 'error', 'error': 'missing or invalid %s header' % token_header})
+        return False
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+
+        if self.path == '/status':
+            self._send_json(200, self.service.status())
+        else:
+            self._send_json(404, {'status': 'error', 'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/tbw':
+            self._send_json(404, {'status': 'error', 'error': 'unknown path %s' % self.path})
+            return
+
+        # JSON requests can't be sent cross-site by a browser without a CORS pre-flight, which the service refuses
+        if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+            self._send_json(415, {'status': 'error', 'error': 'Content-Type must be application/json'})
+            return
+
+        if not self._authorized():
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(request, dict) or 'file' not in request:
+                raise ValueError('request must be a JSON object with a "file" entry')
+        except ValueError as e:
+            self._send_json(400, {'status': 'error', 'error': str(e)})
+            return
+
+        self._send_json(*self.service.submit(request))
+
+    def log_message(self, format, *args):
+        if log_requests:
+            sys.stderr.write('%s - %s\n' % (self.address_string(), format % args))
+
+
+def write_token_file(token_filename, token):
+    """
+    Write the service token to a file only the user can read
+
+    :param token_filename: token file name
+    :param token: service token
+    """
+    if os.path.exists(token_filename):
+        os.remove(token_filename)
+    with os.fdopen(os.open(token_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+        f.write(token)
+
+
+def run_service(service, port=default_port, token_filename=''):
+    """
+    Serve requests on localhost until interrupted
+
+    :param service: ``TBWService`` object
+    :param port: TCP port number, 0 to pick a free port
+    :param token_filename: service token file name, '' for ``default_token_filename()``
+    """
+    TBWRequestHandler.service = service
+    server = ThreadingHTTPServer(('127.0.0.1', port), TBWRequestHandler)
+    server.daemon_threads = True
+
+    token_filename = token_filename or default_token_filename(server.server_port)
+    write_token_file(token_filename, service.token)
+
+    print('TBW service listening on http://127.0.0.1:%d with %d workers, token in %s' %
+          (server.server_port, service.num_workers, token_filename))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        os.remove(token_filename)
+
+
+def tbw_request(data_filename, options=None, profile_filename='', output_path='', port=default_port, token=''):
+    """
+    Send a request to a running TBW service
+
+    :param data_filename: name of file to process, as seen by the service
+    :param options: dict of ``cti_process_TBW.py`` command line settings, e.g. {'hdiut': True, 'window_step_secs': 1}
+    :param profile_filename: data source profile filename, or '' for the service default
+    :param output_path: if not '' then plots and tables are also written to this folder
+    :param port: service TCP port number
+    :param token: service token, '' to read it from the default token file for the port
+    :return: response dict
+    """
+    if not token:
+        with open(default_token_filename(port), 'r') as f:
+            token = f.read().strip()
+
+    request = {'file': os.path.abspath(data_filename), 'options': options or dict()}
+    if profile_filename:
+        request['profile'] = os.path.abspath(profile_filename)
+    if output_path:
+        request['output_path'] = os.path.abspath(output_path)
+
+    http_request = urllib.request.Request('http://127.0.0.1:%d/tbw' % port, data=json.dumps(request).encode('utf-8'),
+                                          headers={'Content-Type': 'application/json', token_header: token})
+    try:
+        with urllib.request.urlopen(http_request) as http_response:
+            return json.loads(http_response.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read())
+
+
+# entry point for script when called from command line
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time-Based Window Service, processes TBW requests on localhost')
+    parser.add_argument('--profile', type=str,
+                        help='Path and filename of the default cti_data_source_profile spreadsheet [default: none]',
+                        default='')
+    parser.add_argument('--port', type=str, help='TCP port number [default: %d]' % default_port,
+                        default=str(default_port))
+    parser.add_argument('--workers', type=str, help='Number of worker processes [default: 2]', default='2')
+    parser.add_argument('--max_queue', type=str,
+                        help='Maximum number of requests waiting for a worker, others are refused [default: 8]',
+                        default='8')
+    parser.add_argument('--timeout_secs', type=str, help='Request timeout (seconds), 0 = no timeout [default: 0]',
+                        default='0')
+    parser.add_argument('--data_roots', type=str,
+                        help='Comma separated folders that request data files and profiles must be in [default: .]',
+                        default='.')
+    parser.add_argument('--output_root', type=str,
+                        help='Folder that request output paths must be in [default: output]', default='output')
+    parser.add_argument('--token_file', type=str,
+                        help='Service token file name [default: ~/.cti_tbw_service_<port>.token]', default='')
+    parser.add_argument('--verbose', action='store_true', help='Log each request to the console')
+    args = parser.parse_args()
+
+    log_requests = args.verbose
+
+    run_service(TBWService(args.profile, int(args.workers), int(args.max_queue), float(args.timeout_secs),
+                           args.data_roots.split(','), args.output_root), int(args.port), args.token_file)
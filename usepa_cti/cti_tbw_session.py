@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_tbw_session.py
+==================
+
+Interactive time-based window session for one data file, for exploring settings in a notebook or console.  Processing
+runs as a chain of stages:
+
+    load → scale → integrate → window → bin → percentile → plot
+
+Each stage's output is cached, keyed by the stage's upstream key and by only the options that stage depends on (see
+``session_stages``).  Changing an option recomputes only the stages from the first one that depends on it, e.g. new
+cutpoints recompute the bin and percentile stages but not the file load or the windows, and returning to earlier
+settings reuses their cached outputs.  The cache is limited in size, the least recently used outputs are evicted first.
+
+.. code-block:: python
+
+    # example usage:
+    import cti_process_TBW as tbw
+    import cti_tbw_session as tbw_session
+
+    options = tbw.TBWOptions(window_length_secs=300, window_step_secs=1, co2_normalization=True, hp_cutpoints_pct=[8, 25])
+    session = tbw_session.TBWSession('sample_data/HHD_01_5x0.csv', options,
+                                     'sample_data/cti_data_source_profile.xlsx', hdiut=True)
+    print(session.evaluate().summary_df)
+
+    session.set_options(hp_cutpoints_pct=[10, 30])  # only the bin and percentile stages are recalculated
+    print(session.evaluate().summary_df)
+    session.plot('output/session')
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import os
+import sys
+import copy
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy.integrate import trapz
+
+import cti_common as cti
+import cti_data_source_profile as omdsp
+import cti_signal_table as signal_table
+import cti_cutpoints as cutpoints
+import cti_process_TBW as tbw
+
+# stage name: (upstream stage name, options the stage output depends on).  Options that only select how a result is
+# calculated, such as the window search or the number of workers, do not change the output and are not listed
+session_stages = OrderedDict([
+    ('load', (None, ['hdiut'])),
+    ('scale', ('load', ['hdiut', 'species', 'window_pctiles', 'time_align_emissions', 'time_align_reference',
+                        'time_align_max_lag_secs', 'resample_Hz', 'resample_method'])),
+    ('integrate', ('scale', [])),
+    ('window', ('integrate', ['window_length_secs', 'window_step_secs', 'window_min_secs', 'max_dt', 'species',
+                              'window_pctiles', 'operating_modes', 'idle_speed_mph', 'cruise_speed_mph',
+                              'idle_rpm_threshold', 'mode_min_secs'])),
+    ('bin', ('window', ['species', 'co2_normalization', 'ftp_co2_gphphr', 'idle_speed_thresh_mph', 'true_idle_bin',
+                        'hp_cutpoints_frac'])),
+    ('percentile', ('bin', ['species', 'co2_normalization', 'ftp_co2_gphphr', 'true_idle_bin', 'cutpoint_sweep_pct',
+                            'cutpoint_sweep_frac', 'bootstrap_samples', 'bootstrap_ci_pct', 'bootstrap_seed'])),
+    ('plot', ('percentile', ['hp_cutpoints_pct', 'save_windows', 'output_path'])),
+])
+
+# defaults for options used by the session that ``TBWOptions`` does not have
+session_option_defaults = {
+    'hdiut': False,
+    'time_align_emissions': False,
+    'time_align_reference': 'power',
+    'time_align_max_lag_secs': 20.0,
+    'chunk_rows': 0,
+    'save_windows': False,
+    'output_path': '',
+}
+
+
+def _option_key(value):
+    """
+    Convert an option value to a hashable cache key value
+
+    :param value: option value, e.g. number, string, list, dict or NumPy array
+    :return: hashable value
+    """
+    if isinstance(value, np.ndarray):
+        return tuple(value.tolist())
+    elif isinstance(value, dict):
+        return tuple((k, _option_key(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_option_key(v) for v in value)
+    else:
+        return value
+
+
+def _nbytes(value):
+    """
+    Estimate the memory used by a stage output, arrays shared by several outputs are counted in each
+
+    :param value: stage output
+    :return: estimated size (bytes)
+    """
+    if isinstance(value, signal_table.SignalTable):
+        return value.nbytes()
+    elif isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    elif isinstance(value, (pd.Series, np.ndarray)):
+        return int(value.nbytes)
+    elif isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    elif isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    else:
+        return sys.getsizeof(value)
+
+
+class TBWSession(object):
+    """
+    Time-based window processing of one data file with a size-limited cache of stage outputs, see the module
+    description
+    """
+    def __init__(self, data_filename, options, data_profile=None, hdiut=None, max_cache_mb=1000):
+        """
+        Create ``TBWSession`` object, no processing is done until a stage output is requested
+
+        :param data_filename: Name of file to process
+        :param options: ``TBWOptions`` or command line runtime options, the session keeps its own copy
+        :param data_profile: ``DataSourceProfile`` object or data source profile filename, default is
+            ``options.data_profile``
+        :param hdiut: if not ``None`` then sets ``options.hdiut``, HDIUT data source file
+        :param max_cache_mb: cache size limit (MB), least recently used stage outputs are evicted over this limit
+        """
+        options = copy.deepcopy(options)
+        for option_name, value in session_option_defaults.items():
+            if not hasattr(options, option_name):
+                setattr(options, option_name, value)
+        if hdiut is not None:
+            options.hdiut = hdiut
+
+        if isinstance(data_profile, str):
+            data_profile = omdsp.DataSourceProfile(data_profile)
+        if data_profile is not None:
+            options.data_profile = data_profile
+        if getattr(options, 'data_profile', None) is None:
+            raise Exception('TBWSession requires a data source profile')
+
+        self.data_filename = data_filename
+        self.max_cache_bytes = max_cache_mb * 1e6
+
+        # options before the per-file settings are applied, and the options changed by set_options(), in order
+        self._base_options = options
+        self._option_values = OrderedDict()
+        self._update_options()
+
+        self._cache = OrderedDict()  # stage key: (stage output, size bytes), least recently used first
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stage_log = []  # (stage name, calculation secs) of each stage calculated
+
+    def set_options(self, **option_values):
+        """
+        Change options, the cached outputs of stages that depend on them are no longer used.  Values use the
+        ``TBWOptions`` types, derived options such as ``hp_cutpoints_frac`` are updated to match
+
+        .. code-block:: python
+
+            session.set_options(hp_cutpoints_pct=[10, 30], true_idle_bin=True)
+
+        :param option_values: option name=value keyword arguments
+        """
+        for option_name, value in option_values.items():
+            if not hasattr(self._base_options, option_name):
+                raise Exception('unknown option %s' % option_name)
+
+            # the latest of the two cutpoint options is used
+            paired_option = {'hp_cutpoints_pct': 'hp_cutpoints_frac',
+                             'hp_cutpoints_frac': 'hp_cutpoints_pct'}.get(option_name)
+            self._option_values.pop(paired_option, None)
+            self._option_values.pop(option_name, None)
+            self._option_values[option_name] = value
+
+        self._update_options()
+
+    def _update_options(self):
+        """
+        Apply the changed options to the base options then the per-file engine power rating and FTP CO2 g/hp-hr, as for
+        ``tbw_processor()``.  An FTP CO2 g/hp-hr set by ``set_options()`` is kept
+        """
+        options = copy.deepcopy(self._base_options)
+
+        for option_name, value in self._option_values.items():
+            if option_name == 'hp_cutpoints_pct':
+                if isinstance(value, str):
+                    value = [float(c) for c in value.split(',')]
+                value = list(value)
+                options.hp_cutpoints_frac = np.array(value, dtype=float) / 100
+            elif option_name == 'hp_cutpoints_frac':
+                value = np.array(value, dtype=float)
+                options.hp_cutpoints_pct = (value * 100).tolist()
+            elif option_name == 'cutpoint_sweep_pct':
+                if value:
+                    if isinstance(value, str):
+                        value = [float(s) for s in value.split(':')]
+                    sweep_start, sweep_stop, sweep_step = value
+                    options.cutpoint_sweep_frac = np.arange(sweep_start, sweep_stop + sweep_step / 2,
+                                                            sweep_step) / 100
+                else:
+                    options.cutpoint_sweep_frac = None
+            elif option_name == 'window_pctiles':
+                value = tbw.get_window_pctiles(value)
+            elif option_name == 'species':
+                value = tbw.get_species_list(value)
+
+            setattr(options, option_name, value)
+
+        if options.chunk_rows or options.adaptive_step_factor:
+            raise Exception('chunked and adaptive windows are not available in a TBW session')
+
+        options, data_profile = tbw.get_file_options(self.data_filename, options)
+        if 'ftp_co2_gphphr' in self._option_values:
+            options.ftp_co2_gphphr = float(self._option_values['ftp_co2_gphphr'])
+        options.data_profile = data_profile
+
+        self.options, self.data_profile = options, data_profile
+
+    def stage_key(self, stage_name, *extra_key):
+        """
+        Get the cache key of a stage output for the current options
+
+        :param stage_name: stage name, see ``session_stages``
+        :param extra_key: optional stage arguments that also select the output, e.g. the plot output folder
+        :return: hashable key
+        """
+        upstream_stage, option_names = session_stages[stage_name]
+
+        if upstream_stage is None:
+            stat = os.stat(self.data_filename)
+            upstream_key = (os.path.abspath(self.data_filename), stat.st_size, stat.st_mtime_ns,
+                            self.data_profile.engine_power_rating_hp)
+        else:
+            upstream_key = self.stage_key(upstream_stage)
+
+        return (stage_name, upstream_key,
+                tuple((option_name, _option_key(getattr(self.options, option_name, None)))
+                      for option_name in option_names)) + extra_key
+
+    def stage(self, stage_name, *stage_args):
+        """
+        Get a stage output, from the cache if possible, else calculated from the upstream stage output
+
+        :param stage_name: stage name, see ``session_stages``
+        :param stage_args: optional stage arguments, e.g. the plot output folder
+        :return: stage output, see the ``_<stage name>_stage()`` methods
+        """
+        key = self.stage_key(stage_name, *stage_args)
+
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key][0]
+
+        self.misses += 1
+        upstream_stage = session_stages[stage_name][0]
+        upstream_output = self.stage(upstream_stage) if upstream_stage is not None else None
+
+        start_time = time.time()
+        output = getattr(self, '_%s_stage' % stage_name)(upstream_output, *stage_args)
+        self.stage_log.append((stage_name, time.time() - start_time))
+        if self.options.verbose:
+            print('%s stage %.2f secs' % (stage_name, self.stage_log[-1][1]))
+
+        self._store(key, output)
+
+        return output
+
+    def _store(self, key, output):
+        """
+        Add a stage output to the cache then evict least recently used outputs until the cache fits its size limit
+
+        :param key: stage key from ``stage_key()``
+        :param output: stage output
+        """
+        nbytes = _nbytes(output)
+        self._cache[key] = (output, nbytes)
+        self.cache_bytes += nbytes
+
+        while self.cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+            _, (_, evicted_nbytes) = self._cache.popitem(last=False)
+            self.cache_bytes -= evicted_nbytes
+
+        if self.cache_bytes > self.max_cache_bytes:
+            self.clear_cache()  # a single output larger than the limit is not kept
+
+    def clear_cache(self):
+        """
+        Remove all cached stage outputs
+        """
+        self._cache.clear()
+        self.cache_bytes = 0
+
+    def cache_info(self):
+        """
+        :return: dict of cache 'hits', 'misses', 'entries', 'MB' and 'max MB'
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._cache),
+                'MB': self.cache_bytes / 1e6, 'max MB': self.max_cache_bytes / 1e6}
+
+    def _load_stage(self, upstream_output):
+        """
+        Read the source data file
+
+        :param upstream_output: ``None``, first stage
+        :return: (df, calcs_dataframe) tuple from ``tbw.read_tbw_source()``, converted to numeric values
+        """
+        df, calcs_dataframe = tbw.read_tbw_source(self.data_filename, self.options, self.data_profile)
+
+        return cti.dataframe_to_numeric(df), calcs_dataframe
+
+    def _scale_stage(self, load_output):
+        """
+        Prepare, time align and resample signals
+
+        :param load_output: load stage output
+        :return: (signals, data_rate_Hz, time_align_lags) tuple from ``tbw.scale_tbw_signals()``
+        """
+        df, calcs_dataframe = load_output
+
+        return tbw.scale_tbw_signals(df, calcs_dataframe, self.data_filename, self.options, self.data_profile)
+
+    def _integrate_stage(self, scale_output):
+        """
+        Integrate cycle engine work and NOx
+
+        :param scale_output: scale stage output
+        :return: (work_hphr, nox_g, nox_gphphr) tuple, nox_gphphr is ``None`` if cycle work is NaN or negative
+        """
+        signals = scale_output[0]
+        work_hphr = trapz(np.maximum(0, signals['Power hp']), signals['Time secs']) / 3600
+        nox_g = trapz(signals['Tailpipe NOX g/s'], signals['Time secs'])
+
+        return work_hphr, nox_g, tbw.check_cycle_work(work_hphr, nox_g)
+
+    def _window_stage(self, integrate_output):
+        """
+        Calculate time-based windows and window operating mode fractions, if labeled
+
+        :param integrate_output: integrate stage output
+        :return: (window_table, sample operating modes) tuple, windows culled to the minimum duration, or ``None`` if
+            cycle work is NaN or negative
+        """
+        if integrate_output[2] is None:
+            return None
+
+        signals, data_rate_Hz, _ = self.stage('scale')
+        max_dt = self.options.max_dt or 1 / data_rate_Hz
+
+        wp_window_df = tbw.find_tbw_windows(tbw.tbw_window_signals(signals, self.options), self.options, max_dt)
+
+        sample_modes = None
+        if self.options.operating_modes:
+            sample_modes = tbw.label_tbw_operating_modes(signals, wp_window_df, self.options, max_dt)
+
+        return wp_window_df.loc[wp_window_df['duration'] >= self.options.window_min_secs], sample_modes
+
+    def _bin_stage(self, window_output):
+        """
+        Calculate window rates and bin windows
+
+        :param window_output: window stage output
+        :return: (window_df, bin_window_df, true_idle_pts, bins) tuple, from ``tbw.calc_window_rates()`` and
+            ``tbw.bin_windows()``, or ``None`` if cycle work is NaN or negative
+        """
+        if window_output is None:
+            return None
+
+        max_co2_rate_gphr = self.options.ftp_co2_gphphr * self.data_profile.engine_power_rating_hp
+        window_df = tbw.calc_window_rates(window_output[0].copy(), self.options, max_co2_rate_gphr)
+
+        return (window_df,) + tbw.bin_windows(window_df, self.options)
+
+    def _percentile_stage(self, bin_output):
+        """
+        Calculate bin results, window percentiles, cutpoint sweeps and confidence intervals, if requested, and the
+        results summary
+
+        :param bin_output: bin stage output
+        :return: dict of 'true_idle_results', 'bin_results', 'cutpoint_sweep1_df', 'cutpoint_sweep2_df' and
+            'summary_df', or ``None`` if cycle work is NaN or negative
+        """
+        if bin_output is None:
+            return None
+
+        _, bin_window_df, true_idle_pts, bins = bin_output
+        outputs = dict()
+
+        outputs['true_idle_results'], outputs['bin_results'] = tbw.calc_bin_results(true_idle_pts, bins,
+                                                                                    self.options)
+
+        outputs['cutpoint_sweep1_df'] = outputs['cutpoint_sweep2_df'] = None
+        if self.options.cutpoint_sweep_pct:
+            analyzer = cutpoints.CutpointAnalyzer(bin_window_df, self.options.co2_normalization,
+                                                  self.options.ftp_co2_gphphr)
+            outputs['cutpoint_sweep1_df'] = analyzer.sweep1(self.options.cutpoint_sweep_frac)
+            outputs['cutpoint_sweep2_df'] = analyzer.sweep2(self.options.cutpoint_sweep_frac)
+
+        if self.options.bootstrap_samples:
+            outputs['bin_results'].update(tbw.calc_bin_ci(true_idle_pts, bins, self.options))
+
+        outputs['summary_df'] = tbw.tbw_summary(self.data_filename, outputs['true_idle_results'],
+                                                outputs['bin_results'], self.stage('scale')[2])
+
+        return outputs
+
+    def _plot_stage(self, percentile_output, output_folder):
+        """
+        Write the window table, cutpoint sweep tables and plots
+
+        :param percentile_output: percentile stage output
+        :param output_folder: Name of output file folder
+        :return: output_folder
+        """
+        results = self.evaluate()
+        if results is not None:
+            tbw.write_tbw_outputs(results, self.stage('scale')[0], self.data_filename, output_folder, self.options,
+                                  self.data_profile)
+
+        return output_folder
+
+    def evaluate(self):
+        """
+        Get the time-based window results for the current options, only stages with changed options are calculated
+
+        :return: ``tbw.TBWResults`` object, or ``None`` if cycle work is NaN or negative
+        """
+        percentile_output = self.stage('percentile')
+        if percentile_output is None:
+            return None
+
+        results = tbw.TBWResults()
+        results.work_hphr, results.nox_g, results.nox_gphphr = self.stage('integrate')
+        results.time_align_lags = self.stage('scale')[2]
+        results.window_table, results.operating_modes = self.stage('window')
+        results.window_df, results.bin_window_df, results.true_idle_pts, results.bins = self.stage('bin')
+        for attribute_name, value in percentile_output.items():
+            setattr(results, attribute_name, value)
+
+        return results
+
+    def plot(self, output_folder):
+        """
+        Write the window table, cutpoint sweep tables and plots for the current options, unless already written
+
+        :param output_folder: Name of output file folder, a figure folder is created for the file
+        """
+        self.stage('plot', output_folder)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_time_align.py
+=================
+
+Emissions time alignment, estimates and removes the measurement delay of each emissions channel relative to a
+reference signal (engine power or CO2)
+
+Each delay is the lag of the cross-correlation peak between the reference and the emissions channel, calculated by
+FFT (O(n log n)) on a uniform time grid and refined to a fraction of a sample by fitting a parabola through the peak.
+Emissions channels are then shifted earlier by their delay using linear interpolation.
+
+Lag estimates are cached per data file, in memory and optionally as small JSON files, keyed by the file size and
+modification time and the alignment settings, so repeated runs only apply the shifts.
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import os
+import json
+import numpy as np
+import cti_file_io as file_io
+
+# in-memory lag cache, cache key: {channel: (lag secs, correlation)}
+_lag_cache = dict()
+
+
+def estimate_lag(time_secs, reference, signal, max_lag_secs):
+    """
+    Estimate the delay of a signal relative to a reference signal from the peak of their cross-correlation
+
+    :param time_secs: numpy array of sample times (seconds), monotonically increasing
+    :param reference: numpy array of reference signal values, e.g. engine power
+    :param signal: numpy array of signal values, e.g. NOx g/s
+    :param max_lag_secs: maximum delay to search either side of zero (seconds)
+    :return: (lag secs, correlation) tuple, a positive lag means the signal is delayed, correlation is the normalized
+        cross-correlation at the peak
+    """
+    # uniform time grid at the median sample rate
+    dt = np.median(np.diff(time_secs))
+    time_grid = time_secs[0] + np.arange(int(np.floor((time_secs[-1] - time_secs[0]) / dt)) + 1) * dt
+    reference = np.interp(time_grid, time_secs, np.nan_to_num(reference))
+    signal = np.interp(time_grid, time_secs, np.nan_to_num(signal))
+    reference = reference - reference.mean()
+    signal = signal - signal.mean()
+
+    norm = np.sqrt(np.sum(reference ** 2) * np.sum(signal ** 2))
+    if norm == 0:
+        return 0.0, np.nan
+
+    # zero padded FFT cross-correlation, xcorr[k] = sum(reference[i] * signal[i + k]), negative lags wrap around
+    num_samples = len(time_grid)
+    fft_size = 1 << int(np.ceil(np.log2(2 * num_samples)))
+    xcorr = np.fft.irfft(np.conj(np.fft.rfft(reference, fft_size)) * np.fft.rfft(signal, fft_size), fft_size)
+
+    max_lag = int(min(num_samples - 1, np.floor(max_lag_secs / dt)))
+    lags = np.arange(-max_lag, max_lag + 1)
+    xcorr = xcorr[lags] / norm
+
+    peak = int(np.argmax(xcorr))
+    lag = float(lags[peak])
+
+    # parabolic sub-sample peak refinement
+    if 0 < peak < len(lags) - 1:
+        y0, y1, y2 = xcorr[peak - 1], xcorr[peak], xcorr[peak + 1]
+        curvature = y0 - 2 * y1 + y2
+        if curvature < 0:
+            lag = lag + 0.5 * (y0 - y2) / curvature
+
+    return lag * dt, float(xcorr[peak])
+
+
+def shift_signal(time_secs, values, lag_secs):
+    """
+    Shift a signal earlier by a (sub-sample) delay using linear interpolation, end values are held
+
+    :param time_secs: numpy array of sample times (seconds), monotonically increasing
+    :param values: numpy array of signal values
+    :param lag_secs: delay to remove (seconds)
+    :return: numpy array of shifted signal values
+    """
+    return np.interp(time_secs + lag_secs, time_secs, values)
+
+
+def get_cache_key(data_filename, settings):
+    """
+    Generate lag cache key for a data file, changes if the file or the alignment settings change
+
+    :param data_filename: name of the source data file
+    :param settings: dict of alignment settings
+    :return: cache key string
+    """
+    stat = os.stat(data_filename)
+    return json.dumps({'file': os.path.abspath(data_filename), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                       'settings': settings}, sort_keys=True)
+
+
+def get_cached_lags(data_filename, settings, cache_folder=''):
+    """
+    Get cached lag estimates for a data file
+
+    :param data_filename: name of the source data file
+    :param settings: dict of alignment settings
+    :param cache_folder: optional folder of JSON lag cache files
+    :return: dict of channel: (lag secs, correlation), or ``None`` if not cached
+    """
+    cache_key = get_cache_key(data_filename, settings)
+    if cache_key in _lag_cache:
+        return _lag_cache[cache_key]
+
+    if cache_folder:
+        cache_filename = cache_folder + os.sep + file_io.get_filename(data_filename) + '_lags.json'
+        if file_io.file_exists(cache_filename):
+            try:
+                with open(cache_filename, 'r') as f:
+                    cache = json.load(f)
+            except ValueError:
+                return None  # partial or corrupt cache file, lags are estimated again
+            if cache.get('key') == cache_key:
+                _lag_cache[cache_key] = {channel: tuple(lag) for channel, lag in cache['lags'].items()}
+                return _lag_cache[cache_key]
+
+    return None
+
+
+def cache_lags(data_filename, settings, lags, cache_folder=''):
+    """
+    Cache lag estimates for a data file
+
+    :param data_filename: name of the source data file
+    :param settings: dict of alignment settings
+    :param lags: dict of channel: (lag secs, correlation)
+    :param cache_folder: optional folder of JSON lag cache files
+    """
+    cache_key = get_cache_key(data_filename, settings)
+    _lag_cache[cache_key] = lags
+
+    if cache_folder:
+        file_io.validate_folder(cache_folder)
+        cache_filename = cache_folder + os.sep + file_io.get_filename(data_filename) + '_lags.json'
+        # write then rename so concurrent runs never read a partial file
+        temp_filename = file_io.get_temp_filename(cache_filename)
+        with open(temp_filename, 'w') as f:
+            json.dump({'key': cache_key, 'lags': lags}, f, indent=2)
+        file_io.replace_file(temp_filename, cache_filename)
+
+
+def align_emissions(df, time_chan, reference_chan, channels, max_lag_secs, lags=None):
+    """
+    Time align emissions channels to a reference channel, estimating each channel's delay unless lags are provided
+
+    :param df: ``SignalTable`` or pandas dataframe of prepared signals
+    :param time_chan: name of the time channel (seconds)
+    :param reference_chan: name of the reference channel, e.g. 'Power hp' or 'Tailpipe CO2 g/s'
+    :param channels: list of channels to align, the reference channel is never shifted
+    :param max_lag_secs: maximum delay to search either side of zero (seconds)
+    :param lags: optional dict of channel: (lag secs, correlation), e.g. from ``get_cached_lags()``
+    :return: (df, lags) tuple, copy of df with shifted channels and dict of channel: (lag secs, correlation)
+    """
+    df = df.copy()
+    time_secs = np.asarray(df[time_chan], dtype=float)
+
+    if lags is None:
+        reference = np.asarray(df[reference_chan], dtype=float)
+        if reference_chan == 'Power hp':
+            reference = np.maximum(0, reference)  # emissions follow positive power
+        lags = dict()
+        for channel in channels:
+            if channel != reference_chan:
+                lags[channel] = estimate_lag(time_secs, reference, np.asarray(df[channel], dtype=float), max_lag_secs)
+
+    for channel, (lag_secs, correlation) in lags.items():
+        df[channel] = shift_signal(time_secs, np.asarray(df[channel], dtype=float), lag_secs)
+
+    return df, lags
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""
+cti_watch_TBW.py
+================
+
+Time-based window watch folder daemon, processes source data files as they arrive in the source folder and adds
+their results to the results summary and fleet statistics as each file finishes
+
+The source folder is polled, so no operating-system specific file notification APIs are needed.  A file is ready once
+its size and modification time have not changed for ``--settle_secs``, so files that are still being copied are not
+read.  Ready files are processed by a pool of warm worker processes, which import the processing modules once, using
+the same time-based window options as ``cti_process_TBW.py``.
+
+Each file's contents are hashed (SHA-256) and recorded in the watch index, ``<output folder>_watch_index.json``, when
+the file is done.  Files with the same contents as a file already in the index are skipped, including renamed or
+re-copied files and files processed before the daemon was restarted.  Delete a file's index entry, or the index, to
+process it again.
+
+.. code-block:: bash
+
+    python cti_watch_TBW.py --source_path incoming --hdiut --window_step_secs 1 --hp_cutpoints_pct 8,25
+
+Stop the daemon with Ctrl-C, or use ``--idle_exit_polls`` to stop once the source folder has been idle for a number of
+polls, e.g. when run from a scheduled task.
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+import os
+import io
+import json
+import time
+import signal
+import hashlib
+import contextlib
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import cti_file_io as file_io
+import cti_common as cti
+import cti_preflight as preflight
+import cti_scheduler as scheduler
+import cti_sketch as sketch
+import cti_results_db as results_db
+import cti_process_TBW as tbw
+
+watch_index_version = 1
+
+
+def _worker_init():
+    """
+    Worker process initializer, imports the processing modules so the first file doesn't pay the start-up cost.
+    Workers ignore Ctrl-C, the daemon decides whether running files are finished or stopped
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import matplotlib
+    matplotlib.use('Agg')  # no display in worker processes
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import cti_process_TBW
+
+
+def file_sha256(filename, block_size=1 << 20):
+    """
+    Hash the contents of a file
+
+    :param filename: file name, including path to file as required
+    :param block_size: read block size (bytes)
+    :return: SHA-256 hex digest string
+    """
+    file_hash = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class FolderWatcher(object):
+    """
+    Poll a folder for new or changed files, a file is ready once its size and modification time have not changed
+    for the settle time
+
+    .. code-block:: python
+
+        watcher = FolderWatcher('incoming', ['*.csv'], ['*calcs.csv'], settle_secs=10)
+        while True:
+            for data_filename in watcher.poll():
+                ...
+            time.sleep(5)
+
+    """
+    def __init__(self, source_path, include_filter, exclude_filter, settle_secs=10.0):
+        """
+        Create ``FolderWatcher`` object
+
+        :param source_path: path to folder to watch
+        :param include_filter: list of file filters, files to include/accept, e.g. ['*.csv']
+        :param exclude_filter: list of file filters, files to exclude/reject, e.g. ['*calcs.csv']
+        :param settle_secs: a file's size and modification time must not change for this long (seconds)
+        """
+        self.source_path = source_path
+        self.include_filter = include_filter
+        self.exclude_filter = exclude_filter
+        self.settle_secs = settle_secs
+
+        self.pending = dict()  # file name: ((size, modification time), time first seen in that state)
+        self.ready = dict()  # file name: (size, modification time) when it was last reported ready
+
+    def poll(self):
+        """
+        Check the folder for files that are ready, each file is reported once until it changes or is ``forget()``-ed
+
+        :return: list of file names that became ready since the last poll, in name order
+        """
+        now = time.time()
+        file_list = cti.get_file_list(self.source_path, self.include_filter, self.exclude_filter)[0]
+
+        ready_files = []
+        for data_filename in sorted(file_list):
+            try:
+                stat = os.stat(data_filename)
+            except OSError:
+                continue  # removed since the folder was listed
+
+            state = (stat.st_size, stat.st_mtime_ns)
+            if self.ready.get(data_filename) == state:
+                continue
+
+            prior_state, since = self.pending.get(data_filename, (None, now))
+            if state != prior_state:
+                self.pending[data_filename] = (state, now)
+            elif stat.st_size > 0 and now - since >= self.settle_secs:
+                del self.pending[data_filename]
+                self.ready[data_filename] = state
+                ready_files.append(data_filename)
+
+        # stop tracking files that were removed
+        for data_filename in set(self.pending).difference(file_list):
+            del self.pending[data_filename]
+        for data_filename in set(self.ready).difference(file_list):
+            del self.ready[data_filename]
+
+        return ready_files
+
+    def forget(self, data_filename):
+        """
+        Forget that a file was ready, so it is reported again once it has settled, e.g. to retry a file
+
+        :param data_filename: file name
+        """
+        self.ready.pop(data_filename, None)
+
+
+class WatchIndex(object):
+    """
+    Index of processed files by content hash, kept in a JSON file that is locked while it is updated and replaced
+    atomically, so the index is never left partially written
+    """
+    def __init__(self, index_filename):
+        """
+        Create ``WatchIndex`` object, loading the index file if it exists
+
+        :param index_filename: path and file name of the JSON index file
+        """
+        self.index_filename = index_filename
+        self.files = OrderedDict()  # content hash: dict of file name, status, error and time
+
+        if file_io.file_exists(index_filename):
+            self.load()
+
+    def __contains__(self, file_hash):
+        return file_hash in self.files
+
+    def load(self):
+        """
+        Load the index file
+        """
+        with open(self.index_filename, 'r') as f:
+            index_file = json.load(f, object_pairs_hook=OrderedDict)
+
+        if index_file.get('watch_index_version') != watch_index_version:
+            raise Exception('unsupported watch index version in %s' % self.index_filename)
+
+        self.files = index_file['files']
+
+    def record(self, file_hash, data_filename, status, error=''):
+        """
+        Record a processed file and rewrite the index file, entries added to the index file by other processes are
+        kept
+
+        :param file_hash: content hash from ``file_sha256()``
+        :param data_filename: file name
+        :param status: file status, e.g. 'ok', 'no results', 'failed' or 'rejected'
+        :param error: error message, if any
+        """
+        with file_io.FileLock(self.index_filename):
+            if file_io.file_exists(self.index_filename):
+                self.load()
+            self.files[file_hash] = OrderedDict([('file', data_filename), ('status', status), ('error', error),
+                                                 ('time', datetime.now().isoformat(timespec='seconds'))])
+            temp_filename = file_io.get_temp_filename(self.index_filename)
+            with open(temp_filename, 'w') as f:
+                json.dump({'watch_index_version': watch_index_version, 'files': self.files}, f, indent=2)
+            file_io.replace_file(temp_filename, self.index_filename)
+
+
+def update_fleet_outputs(file_results, output_folder, tbw_folder_name):
+    """
+    Add one file's results to the results summary, fleet sketches and fleet percentiles table in the output folder
+
+    :param file_results: single row pandas dataframe of one file's results, from ``tbw.tbw_file_job()``
+    :param output_folder: name of output folder
+    :param tbw_folder_name: output folder name, from ``tbw.get_tbw_folder_name()``
+    """
+    csv_summary_filename = output_folder + os.sep + tbw_folder_name + '_results_summary.csv'
+    tbw.append_results_summary(file_results, csv_summary_filename)
+
+    sketch_filename = output_folder + os.sep + tbw_folder_name + '_fleet_sketches.json'
+    pctile_filename = output_folder + os.sep + tbw_folder_name + '_fleet_percentiles.csv'
+    with file_io.FileLock(sketch_filename):
+        if file_io.file_exists(sketch_filename):
+            fleet_sketches = sketch.load_sketches(sketch_filename)
+        else:
+            fleet_sketches = OrderedDict()
+
+        sketch.update_sketches(fleet_sketches, file_results)
+
+        temp_filename = file_io.get_temp_filename(sketch_filename)
+        sketch.save_sketches(temp_filename, fleet_sketches)
+        file_io.replace_file(temp_filename, sketch_filename)
+
+        temp_filename = file_io.get_temp_filename(pctile_filename)
+        sketch.sketch_percentile_table(fleet_sketches, tbw.pctile_range).to_csv(temp_filename)
+        file_io.replace_file(temp_filename, pctile_filename)
+
+
+def watch_folder(options, output_folder, tbw_folder_name, poll_secs=5.0, settle_secs=10.0, num_workers=1,
+                 max_attempts=3, idle_exit_polls=0):
+    """
+    Process files as they arrive in the source folder until interrupted, or until the folder has been idle for
+    ``idle_exit_polls`` polls
+
+    :param options: Data structure of command line / runtime options settings
+    :param output_folder: name of output folder
+    :param tbw_folder_name: output folder name, from ``tbw.get_tbw_folder_name()``
+    :param poll_secs: source folder polling interval (seconds)
+    :param settle_secs: a file's size and modification time must not change for this long (seconds) before it's read
+    :param num_workers: number of files processed at once
+    :param max_attempts: number of tries for files that fail with transient I/O errors or lose their worker process
+    :param idle_exit_polls: stop after this many polls with no files waiting or running, 0 = run until interrupted
+    :return: dict of file status: number of files
+    """
+    watcher = FolderWatcher(options.source_path, options.file_include_filter, options.file_exclude_filter,
+                            settle_secs)
+    watch_index = WatchIndex(output_folder + os.sep + tbw_folder_name + '_watch_index.json')
+    staging_folder = tbw.get_staging_folder(output_folder)
+
+    executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_worker_init)
+    running = dict()  # future: (file name, content hash)
+    attempts = dict()  # content hash: number of tries
+    file_counts = OrderedDict()
+    idle_polls = 0
+
+    def finish_file(future):
+        """
+        Record a file that has finished, or set it up for a retry
+
+        :param future: finished ``tbw.tbw_file_job()`` future
+        :return: ``True`` if the file's worker process died and the pool needs to be replaced
+        """
+        data_filename, file_hash = running.pop(future)
+        try:
+            file_results, stats = future.result()
+        except BaseException as error:
+            error_str = ('%s: %s' % (type(error).__name__, error)).replace('\n', ' ')
+            if (isinstance(error, BrokenProcessPool) or scheduler.is_transient_error(error)) and \
+                    attempts[file_hash] < max_attempts:
+                print('*** %s failed, will retry: %s ***' % (data_filename, error_str))
+                watcher.forget(data_filename)
+            else:
+                print('*** %s failed: %s ***' % (data_filename, error_str))
+                watch_index.record(file_hash, data_filename, 'failed', error_str)
+                file_counts['failed'] = file_counts.get('failed', 0) + 1
+            return isinstance(error, BrokenProcessPool)
+
+        if file_results is None:
+            status = 'no results'
+        else:
+            update_fleet_outputs(file_results, output_folder, tbw_folder_name)
+            status = 'ok'
+        watch_index.record(file_hash, data_filename, status)
+        file_counts[status] = file_counts.get(status, 0) + 1
+        print('%s %s, %.1f secs' % (status, data_filename, sum(v for k, v in stats.items() if k.endswith(' secs'))))
+        return False
+
+    print('watching %s for %s, results in %s' % (options.source_path, ','.join(options.file_include_filter),
+                                                 output_folder))
+    try:
+        while True:
+            ready_files = watcher.poll()
+
+            for data_filename in ready_files:
+                try:
+                    file_hash = file_sha256(data_filename)
+                except OSError as error:
+                    print('*** could not read %s, %s ***' % (data_filename, error))
+                    watcher.forget(data_filename)
+                    continue
+
+                running_hashes = {h: f for f, h in running.values()}
+                if file_hash in watch_index or file_hash in running_hashes:
+                    duplicate_filename = watch_index.files[file_hash]['file'] if file_hash in watch_index else \
+                        running_hashes[file_hash]
+                    if duplicate_filename == data_filename:
+                        print('skipping %s, already processed' % data_filename)
+                    else:
+                        print('skipping %s, same contents as %s' % (data_filename, duplicate_filename))
+                    file_counts['duplicate'] = file_counts.get('duplicate', 0) + 1
+                    continue
+
+                if options.preflight:
+                    report_df, passed_file_list = preflight.preflight_files([data_filename], options.data_profile,
+                                                                            options.hdiut,
+                                                                            int(options.preflight_sample_rows))
+                    if not passed_file_list:
+                        print('*** %s failed pre-flight check ***' % data_filename)
+                        preflight.print_preflight_summary(report_df)
+                        watch_index.record(file_hash, data_filename, 'rejected', 'failed pre-flight check')
+                        file_counts['rejected'] = file_counts.get('rejected', 0) + 1
+                        continue
+
+                print('processing %s' % data_filename)
+                attempts[file_hash] = attempts.get(file_hash, 0) + 1
+                future = executor.submit(tbw.tbw_file_job, data_filename, output_folder, staging_folder, options)
+                running[future] = (data_filename, file_hash)
+
+            if running:
+                idle_polls = 0
+                done, _ = wait(running, timeout=poll_secs, return_when=FIRST_COMPLETED)
+            else:
+                if ready_files or watcher.pending:
+                    idle_polls = 0
+                else:
+                    idle_polls += 1
+                    if idle_exit_polls and idle_polls >= idle_exit_polls:
+                        break
+                time.sleep(poll_secs)
+                done = []
+
+            pool_broken = False
+            for future in done:
+                pool_broken |= finish_file(future)
+
+            if pool_broken:
+                # a worker process died (e.g. out of memory) and the pool can't run any more files, files that were
+                # still running are retried in a new pool
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_worker_init)
+
+    except KeyboardInterrupt:
+        # files that haven't started are processed when the daemon is restarted, running files are finished and
+        # recorded so their outputs aren't produced again
+        for future in [future for future in running if future.cancel()]:
+            running.pop(future)
+        try:
+            if running:
+                print('\nstopping, waiting for %d running file(s) to finish, press Ctrl-C again to stop them' %
+                      len(running))
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish_file(future)
+        except KeyboardInterrupt:
+            # the executor has no public way to stop running files
+            for process in list((executor._processes or dict()).values()):
+                process.terminate()
+            print('\nstopped %d running file(s), they will be processed when the daemon is restarted' % len(running))
+
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        tbw.remove_staging_folder(staging_folder)
+
+    return file_counts
+
+
+# command line arguments for the watch folder daemon
+watch_args = [
+    "parser.add_argument('--poll_secs', type=str, help='Source folder polling interval (seconds) [default: 5]', default='5')",
+    "parser.add_argument('--settle_secs', type=str, help='Files are processed once their size and modification time have not changed for this long (seconds) [default: 10]', default='10')",
+    "parser.add_argument('--watch_workers', type=str, help='Number of files to process at once [default: 1]', default='1')",
+    "parser.add_argument('--watch_attempts', type=str, help='Number of tries for files that fail with transient I/O errors [default: 3]', default='3')",
+    "parser.add_argument('--idle_exit_polls', type=str, help='Stop after this many polls with no files waiting or running, 0 = run until interrupted [default: 0]', default='0')",
+    "parser.add_argument('--quiet', action='store_true', help='Suppress per-file processing messages')",
+]
+
+watch_options = ["options.poll_secs = float(args.poll_secs)",
+                 "options.settle_secs = float(args.settle_secs)",
+                 "options.watch_workers = int(args.watch_workers)",
+                 "options.watch_attempts = int(args.watch_attempts)",
+                 "options.idle_exit_polls = int(args.idle_exit_polls)",
+                 "options.quiet = args.quiet",
+                 ]
+
+
+# entry point for script when called from command line
+if __name__ == '__main__':
+
+    additional_args = tbw.tbw_window_args + tbw.tbw_bin_args + preflight.preflight_args + \
+        results_db.results_db_args + watch_args
+
+    additional_options = tbw.tbw_window_options + tbw.tbw_bin_options + preflight.preflight_options + \
+        results_db.results_db_options + watch_options
+
+    # process script-specific and common (see cti_common.py) command line options, the source folder may be empty
+    options = cti.handle_command_line_options(
+        app_description='Time-Based Window Watch Folder Daemon, processes source data files as they arrive',
+        additional_args=additional_args,
+        additional_options=additional_options,
+        require_files=False)
+
+    tbw.process_window_options(options)
+
+    tbw_folder_name = tbw.get_tbw_folder_name(options)
+    output_folder = options.output_path + os.sep + tbw_folder_name
+    if options.clean_output_folder:
+        file_io.delete_folder(output_folder)  # delete folder so there's no old data, including the watch index
+    file_io.validate_folder(output_folder)
+
+    # add this daemon run to the results database, file results are added as each file finishes
+    if options.results_db:
+        options.results_db_run_id = results_db.add_run(options.results_db, options, tbw_folder_name)
+
+    file_counts = watch_folder(options, output_folder, tbw_folder_name, options.poll_secs, options.settle_secs,
+                               options.watch_workers, options.watch_attempts, options.idle_exit_polls)
+
+    print('\n%s' % ', '.join('%d %s' % (count, status) for status, count in file_counts.items()))
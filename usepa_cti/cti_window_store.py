@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+
+cti_window_store.py
+===================
+
+Save and load window tables (``find_windows()`` results) as compact binary files so bins, percentiles and summaries
+can be recalculated without recalculating the windows
+
+Window tables are stored as compressed NumPy ``.npz`` files, one array per window column plus a JSON metadata record
+of the settings that produced the windows (window length, step and minimum duration, engine power rating, etc).
+
+.. note::
+
+    This is development code written by EPA staff and
+    is intended only for evaluation purposes—it does not
+    represent how we may or may not use the resulting
+    output in the development or promulgation of future rules
+
+@author: US EPA
+
+"""
+
+from __init__ import *
+
+if cti_verbose:
+    print('Loading %s...' % __name__)
+
+import json
+import numpy as np
+import pandas as pd
+import cti_file_io as file_io
+
+window_table_version = 1
+
+
+def get_window_table_filename(data_filename, window_length_secs, window_step_secs, window_min_secs, tag_str=''):
+    """
+    Generate window table file name tagged with the window settings, e.g. somefile_w300_s1_m30.npz
+
+    :param data_filename: name of the source data file
+    :param window_length_secs: window length (seconds)
+    :param window_step_secs: window step (seconds)
+    :param window_min_secs: window minimum duration (seconds)
+    :param tag_str: optional additional tag, e.g. resampling descriptor
+    :return: window table file name, without path
+    """
+    return file_io.get_filename(data_filename) + '_w%g_s%g_m%g%s.npz' % (window_length_secs, window_step_secs,
+                                                                        window_min_secs, tag_str)
+
+
+def save_window_table(filename, window_df, metadata):
+    """
+    Save window table and metadata to a compressed .npz file
+
+    :param filename: path and file name of the window table to write
+    :param window_df: pandas dataframe of windows
+    :param metadata: dict of JSON-serializable window settings
+    """
+    metadata = dict(metadata)
+    metadata['window_table_version'] = window_table_version
+    metadata['columns'] = list(window_df.columns)
+
+    arrays = dict()
+    for i, column in enumerate(window_df.columns):
+        arrays['col_%d' % i] = window_df[column].values
+
+    file_io.validate_folder(file_io.get_filepath(filename))
+    temp_filename = file_io.get_temp_filename(filename)
+    np.savez_compressed(temp_filename, metadata=np.array(json.dumps(metadata)), **arrays)
+    file_io.replace_file(temp_filename, filename)
+
+
+def load_window_table(filename):
+    """
+    Load window table and metadata from a .npz file
+
+    :param filename: path and file name of the window table to read
+    :return: (window_df, metadata) tuple
+    """
+    with np.load(filename, allow_pickle=False) as npz:
+        metadata = json.loads(str(npz['metadata']))
+        window_df = pd.DataFrame()
+        for i, column in enumerate(metadata['columns']):
+            window_df[column] = npz['col_%d' % i]
+
+    return window_df, metadata